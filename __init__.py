@@ -1,10 +1,14 @@
+import asyncio
 import json
 import os
+import time
 from urllib.parse import urlparse, parse_qs
 
 import requests
+from nonebot import get_driver, get_plugin_config
 from nonebot.adapters.onebot.v11 import MessageEvent, Message, MessageSegment
 from nonebot.adapters.onebot.v11.bot import Bot
+from nonebot.matcher import Matcher
 from nonebot.params import CommandArg
 from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
@@ -13,8 +17,11 @@ from nonebot.rule import to_me
 from requests import session
 
 from .character.character_card_parser import CharacterCardParser
-from .chat.chat import Chat
+from .chat.chat import Chat, chat_data_path
+from .chat.chat_storage import SqliteChatStorage, create_chat_storage
+from .chat.nickname_directory import NicknameDirectory
 from .chat.chat_session import ChatSession
+from .chat.session_snapshot import SessionSnapshot
 from .config import Config
 
 __plugin_meta__ = PluginMetadata(
@@ -25,22 +32,144 @@ __plugin_meta__ = PluginMetadata(
 )
 
 from .messages.messages import Messages
-from .open_ai.open_ai import OpenAi
+from .messages.stream_splitter import StreamSplitter
+from .messages.token_counter import TokenCounter
+from .open_ai.open_ai import ContextOverflowError, OpenAi, StreamError
 from .preset.RegexProcess import RegexProcessor
 from .preset.preset_convert import SillyTavernPreset
 from .preset.QLPreset_manage import QLPresetManager
 
 from .util.character_util import CharacterUtil
 from .chat.chat_session_manager import ChatSessionManager
+from .util.metrics import Metrics
 
 #实例对象
+plugin_config=get_plugin_config(Config)
 char_util=CharacterUtil()
-chat=Chat()
-chat_util=ChatSessionManager()
-messages=Messages()
-regex_process=RegexProcessor()
-open_ai=OpenAi()
+chat=Chat(
+    create_chat_storage(
+        plugin_config.qilian_history_backend,
+        chat_data_path,
+        plugin_config.qilian_history_fsync
+    ),
+    plugin_config.qilian_history_buffer_size,
+    plugin_config.qilian_history_flush_interval
+)
+session_snapshot=SessionSnapshot(
+    os.path.join(os.path.dirname(chat_data_path),"session_snapshot.msgpack"),
+    plugin_config.qilian_session_snapshot_interval
+)
+
+
+def release_session(message_type:str,session_id:str,session:ChatSession):
+    """会话移出内存时释放其聊天记录缓存,并在快照中保留会话状态"""
+    chat.release_buffer(message_type,session_id,session.get_character_name())
+    session_snapshot.remember(message_type,session)
+
+
+chat_util=ChatSessionManager(
+    plugin_config.qilian_session_busy_policy,
+    NicknameDirectory(plugin_config.qilian_nickname_ttl, plugin_config.qilian_nickname_negative_ttl),
+    plugin_config.qilian_session_max,
+    plugin_config.qilian_session_idle_ttl,
+    release_session,
+    char_util
+)
+token_counter=TokenCounter()
+messages=Messages(token_counter,plugin_config.qilian_world_info_depth,plugin_config.qilian_world_info_budget)
+regex_process=RegexProcessor(plugin_config.qilian_regex_timeout)
+metrics=Metrics()
+open_ai=OpenAi(metrics,token_counter)
 character_list=char_util.get_character_card_list()
+driver=get_driver()
+
+#上下文超长时缩减预算重试的次数
+CONTEXT_RETRIES=2
+#启动时预热会话的后台任务
+warm_up_tasks=set()
+
+
+@driver.on_startup
+async def start_history_writer():
+    chat.start_writer()
+
+
+@driver.on_startup
+async def restore_sessions():
+    #恢复上次保存的昵称,预热在后台进行,不阻塞启动
+    restored=session_snapshot.load()
+    session_snapshot.restore_nicknames(chat_util.nickname_directory)
+    session_snapshot.start(chat_util)
+    if restored and plugin_config.qilian_session_warm_count>0:
+        task=asyncio.create_task(warm_sessions(plugin_config.qilian_session_warm_count))
+        warm_up_tasks.add(task)
+        task.add_done_callback(warm_up_tasks.discard)
+
+
+@driver.on_shutdown
+async def close_clients():
+    for task in list(warm_up_tasks):
+        task.cancel()
+    await session_snapshot.close(chat_util)
+    await chat.close()
+    await open_ai.close()
+
+
+def open_session(message_type:str,session_id:str,user_id:str="") -> ChatSession:
+    """建立会话,快照中有该会话的记录时恢复最后发言的用户、昵称和会话变量"""
+    character = char_util.get_character_by_id(message_type, session_id)
+    #只为从未设置过预设的会话设置默认预设,会话被移出内存后重建时保留原来的预设
+    if session_id not in chat_util.preset_manage.preset_config.get(message_type, {}):
+        chat_util.preset_manage.set_preset_config(message_type, session_id, "Gemini!_It's_MyGO!!!!!_1.9.2版")
+    chat_session = chat_util.create_session(message_type, character, session_id)
+    chat_session.set_preset_regex(regex_process.get_patterns(chat_session.preset_name))
+    record = session_snapshot.get_record(message_type, session_id)
+    if record is not None:
+        chat_session.set_user_id(record.user_id)
+        chat_session.set_nick_name(record.nick_name)
+        #会话变量属于保存时的角色,角色已更换时不恢复
+        if record.character_name == chat_session.get_character_name():
+            chat_session.variables.update(record.variables)
+    if user_id:
+        chat_session.set_user_id(user_id)
+    return chat_session
+
+
+def get_chat_session(message_type:str,session_id:str,user_id:str) -> ChatSession:
+    """获取会话,角色或预设的版本号变化时只更新该会话实际改变的部分,会话不在内存中时建立会话"""
+    chat_session = chat_util.get_session(message_type, session_id)
+    if not chat_session:
+        return open_session(message_type, session_id, user_id)
+    character_name = chat_session.get_character_name()
+    if chat_util.revalidate_session(message_type, session_id, chat_session):
+        #正则流水线按预设文件状态缓存,预设未变化时得到同一个对象
+        chat_session.set_preset_regex(regex_process.get_patterns(chat_session.preset_name))
+        if chat_session.get_character_name() != character_name:
+            chat.release_buffer(message_type, session_id, character_name)
+    return chat_session
+
+
+async def warm_sessions(limit:int):
+    """按快照从新到旧预热最近访问的会话: 角色卡、预设、正则规则、宏模板和聊天记录缓存,
+    每个会话之间让出事件循环,期间到达的消息不需要等待预热完成"""
+    start = time.perf_counter()
+    if chat_util.max_sessions > 0:
+        limit = min(limit, chat_util.max_sessions)
+    warmed = 0
+    for record in session_snapshot.recent_records(limit, chat_util.idle_ttl):
+        await asyncio.sleep(0)
+        if chat_util.peek_session(record.message_type, record.session_id) is not None:
+            continue
+        try:
+            chat_session = open_session(record.message_type, record.session_id)
+            messages.precompile(chat_session)
+            await chat.get_context(record.message_type, record.session_id, chat_session.get_character_name(), 1)
+        except Exception as e:
+            print(f"预热会话失败({record.message_type}-{record.session_id}): {e}")
+            continue
+        warmed += 1
+    metrics.record_since("session_warm_up", start)
+    print(f"已按快照预热{warmed}个会话,耗时{(time.perf_counter()-start)*1000:.1f}ms")
 
 
 #tigger=on_startswith(("怜祈"),ignorecase=True)
@@ -71,6 +200,8 @@ async def handle_help():
 
 **聊天管理 (Superuser权限):**
 - clear: 清空当前群聊/私聊的角色聊天记忆。
+- 查看性能统计: 查看首条消息延迟、API密钥状态等性能指标。
+- 迁移聊天记录: 将JSONL聊天记录迁移到SQLite,之后将qilian_history_backend设置为sqlite并重启。
 
 **OpenAI/模型设置 (Superuser权限):**
 - 设置聊天服务来源 <来源类型>: 设置文本补全服务来源，可选: OpenAI, Claude, Google AI Studio, DeepSeek, Others。
@@ -107,12 +238,12 @@ async def appoint_chat_character(event:MessageEvent,args:Message=CommandArg()):
     else:
         chat_session_id = str(event.user_id)
 
-    if character_name not in character_list:
-        appoint_character.finish("不存在此角色，请重新指定角色")
+    if character_name not in char_util.character_card_path:
+        await appoint_character.finish("不存在此角色，请重新指定角色")
+    #角色配置的版本号递增,该会话在下一条消息时换用新角色,不重新载入其他角色
     await char_util.appoint_character(message_type,character_name,chat_session_id)
     await appoint_character.send(f"已指定聊天角色{character_name}")
     #await chat.new_chat()
-    char_util.set_init()
 
 
 
@@ -128,57 +259,156 @@ def privateMessage(event:MessageEvent):
     return event.message_type=="private" and not message.startswith('/')
 
 
-role_play=on_message(rule=groupMessage & to_me(),priority=10,block=True)
-@role_play.handle()
-async def group_chat(event:MessageEvent,bot:Bot):
+async def handle_role_play(matcher:Matcher,event:MessageEvent,bot:Bot,session_id:str):
+    received_time = time.perf_counter()
+    #同一会话的消息按到达顺序逐轮处理,不同会话并行
+    async with chat_util.session_turn(event.message_type,session_id,event.get_plaintext()) as message:
+        if message is None:
+            await matcher.finish()
+        metrics.record_since("session_turn_wait", received_time)
+        await run_role_play_turn(matcher,event,bot,session_id,message,received_time)
+
+
+async def run_role_play_turn(matcher:Matcher,event:MessageEvent,bot:Bot,session_id:str,message:str,received_time:float):
     message_type = event.message_type
-    group_id=str(event.group_id)
-    user_id=str(event.user_id)
-    message=event.get_plaintext()
-    chat_session = chat_util.get_session(message_type,group_id)
-    if not chat_session:
-        character=char_util.get_character_by_id(message_type,group_id)
-        chat_util.preset_manage.set_preset_config(message_type, group_id, "Gemini!_It's_MyGO!!!!!_1.9.2版")
-        chat_session = chat_util.create_session(message_type,character,group_id)
-        chat_session.set_user_id(user_id)
-        chat_session.set_preset_regex(regex_process.get_patterns(chat_session.preset_name))
-        chat_util.set_group_session(group_id,chat_session)
+    user_id = str(event.user_id)
+    chat_session = get_chat_session(message_type, session_id, user_id)
+
+    #作用于用户输入的正则规则在保存和构造提示之前执行
+    message = regex_process.process_input(chat_session.get_preset_regex(),message)
+    group_id = str(event.group_id) if message_type == "group" else None
+    chat_session.set_nick_name(await chat_util.get_nick_name(bot, user_id, group_id, event.sender))
+    budget = chat_session.get_context_budget()
+    chat_history = await chat.get_context(message_type,session_id,chat_session.get_character_name(),chat.max_depth if budget else None)
+    static_prefix = messages.get_static_prefix(chat_session,message,chat_history)
+    #缓存键不含用户昵称,Gemini缓存内容只包含前缀中不依赖用户昵称的部分,同一角色的所有用户共享
+    cache_key = (chat_session.preset_name,chat_session.get_character_name())
+    shared_prefix_length = messages.get_shared_prefix_length(chat_session)
+
+    #超出模型上下文长度时缩减预算重新构造消息,最多重试CONTEXT_RETRIES次
+    for attempt in range(CONTEXT_RETRIES+1):
+        chat_messages = await messages.construct_messages(message,chat_session,chat_history,static_prefix,budget)
+        try:
+            if chat_session.stream_openai:
+                assistant_reply = await send_stream_reply(matcher,chat_session,user_id,chat_messages,received_time,len(static_prefix),cache_key,shared_prefix_length)
+            else:
+                assistant_reply = await open_ai.start_chat(chat_messages,len(static_prefix),cache_key,chat_session.get_generation_settings(),shared_prefix_length)
+            break
+        except ContextOverflowError as e:
+            if attempt == CONTEXT_RETRIES:
+                await matcher.finish(f"错误: 上下文超出模型限制 - {e}")
+            budget = e.reduce_budget(token_counter.count_messages(chat_messages))
+            print(f"上下文超出模型限制,缩减预算至{budget}tokens后重试 ({attempt+1}/{CONTEXT_RETRIES})")
+
+    if chat_session.stream_openai:
+        #流式回复出错时只保存已收到的部分,没有收到任何内容时不保存本轮对话
+        if assistant_reply:
+            await chat.save_chat_message(message_type,session_id,chat_session.get_nick_name(),chat_session.get_character_name(),message,assistant_reply)
+        await matcher.finish()
+
+    #保存经过正则处理的回复,发送时再执行只在显示时生效的规则
+    assistant_reply = "\n"+regex_process.process_output(chat_session.get_preset_regex(),assistant_reply)
+    await chat.save_chat_message(message_type,session_id,chat_session.get_nick_name(),chat_session.get_character_name(),message,assistant_reply)
+    display_reply = "\n"+regex_process.process_display(chat_session.get_preset_regex(),assistant_reply)
+    metrics.record_since("time_to_first_message.full", received_time)
+    await matcher.finish(MessageSegment.at(user_id) + Message(display_reply))
+
+
+async def send_stream_reply(matcher:Matcher,chat_session:ChatSession,user_id:str,chat_messages:list,received_time:float,static_prefix_length:int,cache_key:tuple,shared_prefix_length:int) -> str:
+    """流式生成回复,经过流式正则处理后按段落/句子切分逐条发送,返回完整回复用于保存
+
+    流中途出错时先发送已收到的部分,再单独发送错误提示,返回已收到的部分;没有收到任何内容时返回空字符串
+    """
+    splitter = StreamSplitter()
+    #正则规则在完整的回复流上执行,可能匹配到后续文本的部分等待更多文本后再发送
+    stream_regex = regex_process.stream_display(chat_session.get_preset_regex())
+    reply_parts = []
+    sent_count = 0
+
+    async def send_segment(text: str) -> None:
+        nonlocal sent_count
+        if sent_count == 0:
+            await matcher.send(MessageSegment.at(user_id) + Message("\n" + text))
+            metrics.record_since("time_to_first_message.stream", received_time)
+        else:
+            await matcher.send(Message(text))
+        sent_count += 1
+
+    stream_error = None
+    try:
+        async for text in open_ai.stream_chat(chat_messages,static_prefix_length,cache_key,chat_session.get_generation_settings(),shared_prefix_length):
+            reply_parts.append(text)
+            for segment in splitter.feed(stream_regex.feed(text)):
+                await send_segment(segment)
+    except StreamError as e:
+        stream_error = e
+    for segment in splitter.feed(stream_regex.flush()) + splitter.flush():
+        await send_segment(segment)
+    if stream_error is not None:
+        await matcher.send(f"错误: {stream_error}")
+
+    metrics.record_since("stream_reply_total", received_time)
+    if not reply_parts:
+        return ""
+    return "\n"+regex_process.process_output(chat_session.get_preset_regex(), "".join(reply_parts))
 
-    chat_session.set_nick_name(await chat_util.get_nick_name(bot, user_id))
-    chat_history = await chat.get_context(message_type,group_id,chat_session.get_character_name())
-    chat_messages = await messages.construct_messages(message,chat_session,chat_history)
-    assistant_reply = await open_ai.start_chat(chat_messages)
 
-    assistant_reply ="\n"+regex_process.process_by_regex(chat_session.get_preset_regex(),assistant_reply)
-    await chat.save_chat_message(message_type,group_id,chat_session.get_nick_name(),chat_session.get_character_name(),message,assistant_reply)
-    await role_play.finish(MessageSegment.at(user_id) + Message(assistant_reply))
+role_play=on_message(rule=groupMessage & to_me(),priority=10,block=True)
+@role_play.handle()
+async def group_chat(matcher:Matcher,event:MessageEvent,bot:Bot):
+    await handle_role_play(matcher,event,bot,str(event.group_id))
 
 
 
 role_play1=on_message(rule=privateMessage,priority=10,block=True)
 @role_play1.handle()
-async def private_chat(event:MessageEvent,bot:Bot):
-    message_type = event.message_type
-    #group_id = str(event.group_id)
-    user_id = str(event.user_id)
-    message = event.get_plaintext()
-    chat_session = chat_util.get_session(message_type,user_id)
-    if not chat_session:
-        character = char_util.get_character_by_id(message_type, user_id)
-        chat_util.preset_manage.set_preset_config(message_type, user_id, "Gemini!_It's_MyGO!!!!!_1.9.2版")
-        chat_session = chat_util.create_session(message_type, character,user_id)
-        chat_session.set_user_id(user_id)
-        chat_session.set_preset_regex(regex_process.get_patterns(chat_session.preset_name))
-        chat_util.set_private_session(user_id,chat_session)
-
-    chat_session.set_nick_name(await chat_util.get_nick_name(bot, user_id))
-    chat_history = await chat.get_context(message_type,user_id,chat_session.get_character_name())
-    chat_messages = await messages.construct_messages(message, chat_session, chat_history)
-    assistant_reply = await open_ai.start_chat(chat_messages)
-
-    assistant_reply = "\n"+regex_process.process_by_regex(chat_session.get_preset_regex(), assistant_reply)
-    await chat.save_chat_message(message_type,user_id,chat_session.get_nick_name(),chat_session.get_character_name(),message,assistant_reply)
-    await role_play.finish(MessageSegment.at(user_id) + Message(assistant_reply))
+async def private_chat(matcher:Matcher,event:MessageEvent,bot:Bot):
+    await handle_role_play(matcher,event,bot,str(event.user_id))
+
+
+
+#查看性能统计
+check_metrics=on_command("查看性能统计",permission=SUPERUSER)
+@check_metrics.handle()
+async def check_metrics_stats():
+    key_stats = "\n".join(str(stat) for stat in open_ai.get_key_stats())
+    session_stats = chat_util.get_session_stats()
+    session_summary = (
+        f"\n\n会话缓存: {session_stats['total_sessions']}个会话,约{session_stats['estimated_bytes'] // 1024}KB,"
+        f"命中{session_stats['hits']}次,未命中{session_stats['misses']}次,"
+        f"空闲移出{session_stats['idle_evictions']}次,超量移出{session_stats['lru_evictions']}次"
+    )
+    regex_stats = "\n".join(
+        f"{stat['name']}: n={stat['calls']} avg={stat['avg_ms']:.3f}ms max={stat['max_ms']:.3f}ms "
+        f"超时{stat['timeouts']}次 出错{stat['errors']}次"
+        for stat in regex_process.get_rule_stats()[:5]
+    )
+    await check_metrics.finish(
+        metrics.format_stats()
+        + session_summary
+        + (f"\n\n最慢的正则规则:\n{regex_stats}" if regex_stats else "")
+        + (f"\n\nAPI密钥状态:\n{key_stats}" if key_stats else "")
+    )
+
+
+
+#迁移聊天记录到SQLite
+migrate_chat=on_command("迁移聊天记录",permission=SUPERUSER)
+@migrate_chat.handle()
+async def migrate_chat_history():
+    if isinstance(chat.storage, SqliteChatStorage):
+        await migrate_chat.finish("当前已在使用SQLite存储聊天记录")
+    target = create_chat_storage("sqlite", chat_data_path, plugin_config.qilian_history_fsync)
+    try:
+        result = await chat.migrate_to(target)
+    finally:
+        target.close()
+    await migrate_chat.finish(
+        f"已迁移{result['sessions']}个会话,继续迁移{result['resumed']}个部分迁移的会话,共{result['records']}条聊天记录,"
+        f"跳过{result['skipped']}个已完整迁移的会话。\n"
+        + (f"{result['conflicts']}个会话的目标记录与源记录不一致,未迁移,详见日志。\n" if result['conflicts'] else "")
+        + "将qilian_history_backend设置为sqlite并重启后生效"
+    )
 
 
 
@@ -246,7 +476,7 @@ async def update_file(event:MessageEvent):
             character_card_paser=CharacterCardParser()
             img_path= await character_card_paser.download_file(image_url, file_name)
             character_card_paser.extract_character_card(img_path)
-            await append_character_card.send(char_util.get_character_list())
+            await append_character_card.send(str(char_util.get_character_card_list()))
             char_util.set_init()
             await append_character_card.finish("收到PNG数据")
         elif file_type == "json":
@@ -258,7 +488,7 @@ async def update_file(event:MessageEvent):
                     dst.write(src.read())
 
                 #await init()
-                await append_character_card.send(char_util.get_character_list())
+                await append_character_card.send(str(char_util.get_character_card_list()))
 
                 await append_character_card.finish(f"收到 JSON 数据")
             except json.JSONDecodeError:
@@ -455,6 +685,8 @@ async def upload_preset(event: MessageEvent, args: Message = CommandArg()):
                     order = {"order": sillytavern_preset.get_prompt_order()["100001"]}
                     sillytavern_preset.save_prompt_order("private", file_name, order)
                     sillytavern_preset.save_prompt_order("group", file_name, order)
+                #只有使用该预设的会话在下一条消息时重新取得预设
+                chat_util.preset_manage.invalidate(file_name)
 
                 await upload_preset_file.send("已上传预设")
             except json.JSONDecodeError:
@@ -492,6 +724,8 @@ async def upload_preset(event: MessageEvent):
                     order = {"order": sillytavern_preset.get_prompt_order()["100001"]}
                     sillytavern_preset.save_prompt_order("private",file_name,order)
                     sillytavern_preset.save_prompt_order("group",file_name,order)
+                #只有使用该预设的会话在下一条消息时重新取得预设
+                chat_util.preset_manage.invalidate(file_name)
 
                 #await upload_preset_file.send(private_prompt_manage.get_preset_list())
                 await upload_preset_file.send("已上传预设")
@@ -518,17 +752,13 @@ set_preset=on_command("设置预设")
 async def set_Preset(event: MessageEvent,args: Message = CommandArg()):
     message_type=event.message_type
     preset_name=args.extract_plain_text().strip()
-    script_dir = os.path.dirname(__file__)
-    preset_config_path=os.path.join(script_dir,f'./config/preset/preset_config/preset_config.json')
-    with open(preset_config_path,'r+',encoding='utf-8') as rf:
-        preset_config:dict =json.load(rf)
-    with open(preset_config_path,'w+',encoding='utf-8') as wf:
-        if message_type=="group":
-            session_id=str(event.group_id)
-        else:
-            session_id=str(event.user_id)
-        preset_config[message_type][session_id] = preset_name
-        json.dump(preset_config, wf, indent=4, ensure_ascii=False)
-        chat_session=chat_util.get_session(message_type,session_id)
-        chat_session.set_preset_order_prompts(chat_util.preset_manage.get_order_prompts(message_type, session_id))
-        chat_session.preset_name = chat_util.preset_manage.get_preset_name(message_type, session_id)
\ No newline at end of file
+    if message_type=="group":
+        session_id=str(event.group_id)
+    else:
+        session_id=str(event.user_id)
+    #预设管理器先校验预设再写入配置文件,预设配置的版本号递增,会话在下一条消息时换用新的预设和正则规则
+    try:
+        chat_util.preset_manage.set_preset_config(message_type, session_id, preset_name)
+    except (ValueError, FileNotFoundError) as e:
+        await set_preset.finish(f"错误: {e}")
+    await set_preset.finish(f"已设置预设{preset_name}")
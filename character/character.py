@@ -1,20 +1,50 @@
-from typing import List, Optional
+import sys
+from typing import Any, List, Optional, Tuple, Union
 from pathlib import Path
 from .character_card import CharacterCard
+from .lorebook import Lorebook
+
+
+def _intern(value: Any) -> Any:
+    """驻留字符串,列表转换为元组,使相同内容在所有角色之间只保存一份
+
+    Args:
+        value: 角色卡字段值
+
+    Returns:
+        Any: 驻留后的字符串、元组或原值
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(_intern(item) for item in value)
+    return value
+
 
 class Character:
     """角色类,用于管理角色的基本信息和属性
+
+    角色对象创建后不可修改,由CharacterRegistry按角色卡文件缓存,
+    所有使用同一角色卡的会话共享同一个对象。
     
     Attributes:
         name (str): 角色名称
         description (str): 角色描述
         personality (str): 角色性格特征
-        mes_example (List[str]): 对话示例列表
+        mes_example (Union[str, Tuple[str, ...]]): 对话示例
         scenario (str): 场景设定
         first_message (str): 初始对话消息
-        depth (int): 对话历史深度
+        depth (int): 角色备注(depth_prompt)插入聊天历史的深度
+        depth_prompt (str): 角色备注内容
+        depth_prompt_role (str): 角色备注的消息角色
+        lorebook (Optional[Lorebook]): 编译后的角色世界书,没有条目时为None
     """
 
+    __slots__ = (
+        "name", "description", "personality", "mes_example", "scenario", "first_message",
+        "depth", "depth_prompt", "depth_prompt_role", "lorebook"
+    )
+
     def __init__(self, character_card_path: str) -> None:
         """初始化角色对象
         
@@ -27,24 +57,67 @@ class Character:
         """
         try:
             character_card = CharacterCard.from_json(character_card_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"角色卡文件不存在: {character_card_path}")
+        except Exception as e:
+            raise ValueError(f"加载角色卡时发生错误: {str(e)}")
+        self._load(character_card)
+
+    @classmethod
+    def from_card(cls, character_card: CharacterCard) -> "Character":
+        """从已解析的角色卡创建角色对象
+        
+        Args:
+            character_card: 角色卡对象
+            
+        Returns:
+            Character: 角色对象
+            
+        Raises:
+            ValueError: 角色卡数据无效
+        """
+        character = cls.__new__(cls)
+        character._load(character_card)
+        return character
+
+    def _load(self, character_card: CharacterCard) -> None:
+        """从角色卡读取字段
+        
+        Args:
+            character_card: 角色卡对象
             
+        Raises:
+            ValueError: 角色卡数据无效
+        """
+        try:
             # 验证角色卡数据
             is_valid, message = character_card.validate()
             if not is_valid:
                 raise ValueError(f"角色卡数据无效: {message}")
-                
-            self.name: str = character_card.get_character_name()
-            self.description: str = character_card.get_description()
-            self.personality: str = character_card.get_personality()
-            self.mes_example: List[str] = character_card.get_mes_example()
-            self.scenario: str = character_card.get_scenario()
-            self.first_message: str = character_card.get_first_message()
-            self.depth: int = character_card.get_depth()
-            
-        except FileNotFoundError:
-            raise FileNotFoundError(f"角色卡文件不存在: {character_card_path}")
+
+            fields = {
+                "name": character_card.get_character_name(),
+                "description": character_card.get_description(),
+                "personality": character_card.get_personality(),
+                "mes_example": character_card.get_mes_example(),
+                "scenario": character_card.get_scenario(),
+                "first_message": character_card.get_first_message(),
+                "depth": character_card.get_depth()
+            }
+            fields["depth_prompt"], fields["depth_prompt_role"] = character_card.get_depth_prompt()
+            character_book = character_card.get_from_character_book()
+            lorebook = Lorebook(character_book) if character_book and character_book.get("entries") else None
         except Exception as e:
             raise ValueError(f"加载角色卡时发生错误: {str(e)}")
+        object.__setattr__(self, "lorebook", lorebook if lorebook else None)
+        for key, value in fields.items():
+            object.__setattr__(self, key, _intern(value))
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError(f"Character是不可变对象,不能修改属性: {key}")
+
+    def __delattr__(self, key: str) -> None:
+        raise AttributeError(f"Character是不可变对象,不能删除属性: {key}")
 
     def get_name(self) -> str:
         """获取角色名称
@@ -70,11 +143,11 @@ class Character:
         """
         return self.personality
 
-    def get_mes_example(self) -> List[str]:
-        """获取对话示例列表
+    def get_mes_example(self) -> Union[str, Tuple[str, ...]]:
+        """获取对话示例
         
         Returns:
-            List[str]: 对话示例列表
+            Union[str, Tuple[str, ...]]: 对话示例
         """
         return self.mes_example
 
@@ -102,6 +175,22 @@ class Character:
         """
         return self.depth
 
+    def get_depth_prompt(self) -> Tuple[str, str]:
+        """获取插入聊天历史中的角色备注
+        
+        Returns:
+            Tuple[str, str]: (提示词内容, 角色)
+        """
+        return self.depth_prompt, self.depth_prompt_role
+
+    def get_lorebook(self) -> Optional[Lorebook]:
+        """获取编译后的角色世界书
+        
+        Returns:
+            Optional[Lorebook]: 角色世界书,没有条目时为None
+        """
+        return self.lorebook
+
     def get_character_info(self) -> dict:
         """获取角色完整信息
         
@@ -115,23 +204,30 @@ class Character:
             "scenario": self.scenario,
             "first_message": self.first_message,
             "depth": self.depth,
-            "mes_example_count": len(self.mes_example)
+            "mes_example_count": len(self.mes_example),
+            "lorebook_entries": len(self.lorebook) if self.lorebook else 0
         }
 
-    def update_character(self, **kwargs) -> None:
-        """更新角色属性
+    def update_character(self, **kwargs) -> "Character":
+        """创建更新了部分属性的新角色对象,原对象不变
         
         Args:
             **kwargs: 要更新的属性键值对
             
+        Returns:
+            Character: 新的角色对象
+            
         Raises:
             AttributeError: 属性不存在
         """
+        character = Character.__new__(Character)
+        for key in self.__slots__:
+            object.__setattr__(character, key, getattr(self, key))
         for key, value in kwargs.items():
-            if hasattr(self, key):
-                setattr(self, key, value)
-            else:
+            if key not in self.__slots__:
                 raise AttributeError(f"Character没有属性: {key}")
+            object.__setattr__(character, key, _intern(value))
+        return character
 
 if __name__ == '__main__':
     try:
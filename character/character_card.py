@@ -91,6 +91,15 @@ class CharacterCard:
         except KeyError as e:
             raise KeyError("深度设置不存在") from e
 
+    def get_depth_prompt(self) -> Tuple[str, str]:
+        """获取插入聊天历史中的角色备注
+        
+        Returns:
+            Tuple[str, str]: (提示词内容, 角色),未设置时为("", "system")
+        """
+        depth_prompt = self.data.get("extensions", {}).get("depth_prompt") or {}
+        return depth_prompt.get("prompt") or "", depth_prompt.get("role") or "system"
+
 
     # 2. 高级功能 - 字段编辑
     def set_character_name(self, name: str) -> None:
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+from .character import Character
+from .character_card import CharacterCard
+
+
+class CharacterEntry:
+    """角色注册表条目
+
+    Attributes:
+        mtime_ns (int): 载入时角色卡文件的修改时间
+        size (int): 载入时角色卡文件的字节数
+        digest (str): 角色卡文件内容的SHA-256
+        character (Character): 角色对象
+    """
+
+    __slots__ = ("mtime_ns", "size", "digest", "character")
+
+    def __init__(self, mtime_ns: int, size: int, digest: str, character: Character) -> None:
+        """初始化条目
+
+        Args:
+            mtime_ns: 角色卡文件的修改时间
+            size: 角色卡文件的字节数
+            digest: 角色卡文件内容的SHA-256
+            character: 角色对象
+        """
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.character = character
+
+
+class CharacterRegistry:
+    """角色注册表,每张角色卡只解析一次,所有会话共享同一个不可变的角色对象
+
+    每次获取时检查文件的修改时间和大小,两者都未变化时直接返回缓存的对象;
+    变化时重新读取文件,内容哈希相同则继续使用原对象,否则重新解析。
+
+    Attributes:
+        entries (Dict[str, CharacterEntry]): 角色卡文件路径到条目的映射
+        loads (int): 解析角色卡的次数
+    """
+
+    def __init__(self) -> None:
+        """初始化角色注册表"""
+        self.entries: Dict[str, CharacterEntry] = {}
+        self.loads = 0
+
+    def get(self, character_card_path: str) -> Character:
+        """获取角色卡对应的角色对象
+
+        Args:
+            character_card_path: 角色卡JSON文件路径
+
+        Returns:
+            Character: 角色对象,角色卡未变化时总是同一个对象
+
+        Raises:
+            FileNotFoundError: 角色卡文件不存在
+            ValueError: 角色卡数据无效
+        """
+        key = os.path.abspath(character_card_path)
+        try:
+            stat = os.stat(key)
+        except FileNotFoundError:
+            self.entries.pop(key, None)
+            raise FileNotFoundError(f"角色卡文件不存在: {character_card_path}")
+
+        entry = self.entries.get(key)
+        if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            return entry.character
+
+        with open(key, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if entry is not None and entry.digest == digest:
+            # 文件被重新写入但内容未变
+            entry.mtime_ns = stat.st_mtime_ns
+            entry.size = stat.st_size
+            return entry.character
+
+        try:
+            card_data = json.loads(data.decode('utf-8'))
+            character = Character.from_card(CharacterCard(
+                spec=card_data.get("spec", ""),
+                spec_version=card_data.get("spec_version", ""),
+                data=card_data.get("data", {})
+            ))
+        except (UnicodeDecodeError, json.JSONDecodeError, AttributeError) as e:
+            raise ValueError(f"加载角色卡时发生错误: {str(e)}") from e
+        self.loads += 1
+        self.entries[key] = CharacterEntry(stat.st_mtime_ns, stat.st_size, digest, character)
+        return character
+
+    def invalidate(self, character_card_path: Optional[str] = None) -> None:
+        """删除缓存的角色对象,下次获取时重新解析
+
+        Args:
+            character_card_path: 角色卡文件路径,为None时删除全部
+        """
+        if character_card_path is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(os.path.abspath(character_card_path), None)
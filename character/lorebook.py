@@ -0,0 +1,516 @@
+import random
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import regex
+
+# 世界书条目的插入位置
+WORLD_INFO_BEFORE = 0
+WORLD_INFO_AFTER = 1
+WORLD_INFO_AT_DEPTH = 4
+# SillyTavern的extensions.position到插入位置的映射,
+# 作者注释(2/3)、示例对话前后(5/6)和outlet(7)没有对应的标记,并入worldInfoAfter
+_POSITIONS = {0: WORLD_INFO_BEFORE, 1: WORLD_INFO_AFTER, 4: WORLD_INFO_AT_DEPTH}
+# 世界书条目标记到插入位置的映射
+WORLD_INFO_MARKERS = {"worldInfoBefore": WORLD_INFO_BEFORE, "worldInfoAfter": WORLD_INFO_AFTER}
+# 次要关键词逻辑(selectiveLogic)
+AND_ANY = 0
+NOT_ALL = 1
+NOT_ANY = 2
+AND_ALL = 3
+# 深度插入条目的角色(extensions.role)
+ROLES = ("system", "user", "assistant")
+# 递归扫描的最大轮数
+MAX_RECURSION_STEPS = 8
+# JS正则中\w只包含ASCII字符,全词匹配时中文等字符视为单词边界
+_WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+_REGEX_KEY = regex.compile(r"^/(.+)/([gimsuy]*)$", regex.S)
+
+
+class AhoCorasick:
+    """Aho–Corasick多模式匹配自动机
+
+    一次扫描文本即可找出所有模式的出现位置,耗时与文本长度和匹配数成正比,与模式数量无关。
+
+    Attributes:
+        transitions (List[Dict[str, int]]): 每个状态的字符转移
+        fail (List[int]): 每个状态的失败链接
+        outputs (List[Tuple[int, ...]]): 到达每个状态时结束的模式序号,包括沿失败链接可达的模式
+        lengths (List[int]): 每个模式的长度
+    """
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        """构建自动机
+
+        Args:
+            patterns: 模式列表,空字符串被忽略
+        """
+        self.transitions: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        outputs: List[List[int]] = [[]]
+        self.lengths = [len(pattern) for pattern in patterns]
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(index)
+
+        # 按广度优先顺序计算失败链接,并合并失败链接上的输出
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, next_state in self.transitions[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                target = self.transitions[fail].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                outputs[next_state].extend(outputs[self.fail[next_state]])
+                queue.append(next_state)
+        self.outputs: List[Tuple[int, ...]] = [tuple(output) for output in outputs]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """遍历文本中所有模式的出现位置
+
+        Args:
+            text: 文本
+
+        Yields:
+            Tuple[int, int]: (出现的起始位置, 模式序号)
+        """
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for index in outputs[state]:
+                yield position + 1 - self.lengths[index], index
+
+
+class LorebookEntry:
+    """编译后的世界书条目
+
+    Attributes:
+        uid (int): 条目序号
+        comment (str): 条目备注
+        content (str): 条目内容
+        primary (Tuple[int, ...]): 主要关键词序号
+        secondary (Tuple[int, ...]): 次要关键词序号
+        logic (int): 次要关键词逻辑
+        constant (bool): 是否常驻
+        order (int): 插入顺序,数值大的在预算不足时优先保留,插入时排在后面
+        position (int): 插入位置
+        depth (int): 深度插入时距离聊天末尾的消息数
+        role (str): 深度插入时的消息角色
+        probability (int): 触发概率(百分比)
+        scan_depth (Optional[int]): 条目自己的扫描深度,为None时使用世界书的设置
+        exclude_recursion (bool): 不能被递归扫描触发
+        prevent_recursion (bool): 内容不参与递归扫描
+        delay_until_recursion (bool): 只能被递归扫描触发
+        content_hits (FrozenSet[int]): 内容中出现的关键词序号,用于递归扫描
+    """
+
+    __slots__ = (
+        "uid", "comment", "content", "primary", "secondary", "logic", "constant", "order",
+        "position", "depth", "role", "probability", "scan_depth",
+        "exclude_recursion", "prevent_recursion", "delay_until_recursion", "content_hits"
+    )
+
+    def matches(self, hits: Set[int]) -> bool:
+        """判断关键词命中情况是否触发条目
+
+        Args:
+            hits: 扫描文本中出现的关键词序号
+
+        Returns:
+            bool: 是否触发
+        """
+        if not any(key in hits for key in self.primary):
+            return False
+        if not self.secondary:
+            return True
+        if self.logic == NOT_ALL:
+            return not all(key in hits for key in self.secondary)
+        if self.logic == NOT_ANY:
+            return not any(key in hits for key in self.secondary)
+        if self.logic == AND_ALL:
+            return all(key in hits for key in self.secondary)
+        return any(key in hits for key in self.secondary)
+
+
+class WorldInfo:
+    """一次扫描触发的世界书条目
+
+    Attributes:
+        before (List[LorebookEntry]): 插入worldInfoBefore的条目,按插入顺序排列
+        after (List[LorebookEntry]): 插入worldInfoAfter的条目,按插入顺序排列
+        at_depth (List[LorebookEntry]): 插入聊天历史中的条目,按插入顺序排列
+    """
+
+    __slots__ = ("before", "after", "at_depth")
+
+    def __init__(self, entries: List[LorebookEntry]) -> None:
+        """按插入位置和插入顺序分组
+
+        Args:
+            entries: 触发的条目
+        """
+        entries = sorted(entries, key=lambda entry: (entry.order, entry.uid))
+        self.before = [entry for entry in entries if entry.position == WORLD_INFO_BEFORE]
+        self.after = [entry for entry in entries if entry.position == WORLD_INFO_AFTER]
+        self.at_depth = [entry for entry in entries if entry.position == WORLD_INFO_AT_DEPTH]
+
+    def get_entries(self, position: int) -> List[LorebookEntry]:
+        """获取插入指定标记位置的条目
+
+        Args:
+            position: WORLD_INFO_BEFORE或WORLD_INFO_AFTER
+
+        Returns:
+            List[LorebookEntry]: 条目列表
+        """
+        return self.before if position == WORLD_INFO_BEFORE else self.after
+
+
+class Lorebook:
+    """编译后的角色世界书(character_book),随角色对象一起由所有会话共享
+
+    所有条目的纯文本关键词编译为两个Aho–Corasick自动机(区分和不区分大小写),
+    扫描一条消息的耗时与条目数量无关;/pattern/flags形式的关键词逐个用正则匹配。
+    每条消息的扫描结果按原文缓存,每轮只扫描新出现的消息。
+    条目内容中出现的关键词在编译时算好,递归扫描不需要再扫描文本。
+
+    常驻条目总是插入,预算只限制关键词触发的条目;
+    只包含常驻条目的标记位置内容固定,可以放入静态前缀。
+
+    Attributes:
+        name (str): 世界书名称
+        scan_depth (Optional[int]): 扫描最近多少条消息,为None时使用全局设置
+        token_budget (Optional[int]): 关键词触发条目的token预算,为None时使用全局设置
+        recursive (bool): 是否递归扫描触发条目的内容
+        entries (List[LorebookEntry]): 启用的条目,按插入顺序从大到小排列
+        keys (List[Tuple[str, bool, bool]]): 关键词(文本, 区分大小写, 全词匹配)
+        key_entries (Dict[int, Tuple[int, ...]]): 关键词序号到以其为主要关键词的条目序号的映射
+        constant_entries (Tuple[int, ...]): 常驻条目的序号
+        dynamic_positions (FrozenSet[int]): 内容随对话变化的标记位置
+        cache_size (int): 扫描结果缓存的最大条目数
+    """
+
+    def __init__(
+        self,
+        book: Dict[str, Any],
+        case_sensitive: bool = False,
+        match_whole_words: bool = False,
+        cache_size: int = 1024
+    ) -> None:
+        """编译世界书
+
+        Args:
+            book: 角色卡中的character_book
+            case_sensitive: 条目未设置时是否区分大小写
+            match_whole_words: 条目未设置时是否全词匹配
+            cache_size: 扫描结果缓存的最大条目数
+        """
+        self.name = str(book.get("name") or "")
+        self.scan_depth = _to_int(book.get("scan_depth"))
+        self.token_budget = _to_int(book.get("token_budget"))
+        recursive = book.get("recursive_scanning")
+        self.recursive = True if recursive is None else bool(recursive)
+        self.keys: List[Tuple[str, bool, bool]] = []
+        self.key_ids: Dict[Tuple[str, bool, bool], int] = {}
+        self.regex_keys: List[Tuple[int, Any]] = []
+
+        entries = []
+        for uid, data in enumerate(book.get("entries") or []):
+            if not isinstance(data, dict) or data.get("enabled") is False or not data.get("content"):
+                continue
+            extensions = data.get("extensions") or {}
+            entry_case = extensions.get("case_sensitive", data.get("case_sensitive"))
+            entry_case = case_sensitive if entry_case is None else bool(entry_case)
+            whole_words = extensions.get("match_whole_words")
+            whole_words = match_whole_words if whole_words is None else bool(whole_words)
+            position = extensions.get("position")
+            if position is None:
+                position = 0 if data.get("position") == "before_char" else 1
+
+            entry = LorebookEntry()
+            entry.uid = _to_int(data.get("id"))
+            entry.uid = uid if entry.uid is None else entry.uid
+            entry.comment = str(data.get("comment") or "")
+            entry.content = str(data["content"])
+            entry.primary = self._add_keys(data.get("keys"), entry_case, whole_words)
+            entry.secondary = (
+                self._add_keys(data.get("secondary_keys"), entry_case, whole_words)
+                if data.get("selective", True) else ()
+            )
+            entry.logic = _to_int(extensions.get("selectiveLogic")) or AND_ANY
+            entry.constant = bool(data.get("constant", False))
+            entry.order = _to_int(data.get("insertion_order")) or 0
+            entry.position = _POSITIONS.get(_to_int(position), WORLD_INFO_AFTER)
+            entry.depth = max(_to_int(extensions.get("depth")) or 0, 0)
+            role = _to_int(extensions.get("role")) or 0
+            entry.role = ROLES[role] if 0 <= role < len(ROLES) else "system"
+            probability = _to_int(extensions.get("probability"))
+            entry.probability = (
+                100 if probability is None or extensions.get("useProbability") is False
+                else probability
+            )
+            entry.scan_depth = _to_int(extensions.get("scan_depth"))
+            entry.exclude_recursion = bool(extensions.get("exclude_recursion", False))
+            entry.prevent_recursion = bool(extensions.get("prevent_recursion", False))
+            entry.delay_until_recursion = bool(extensions.get("delay_until_recursion", False))
+            entries.append(entry)
+
+        entries.sort(key=lambda entry: (-entry.order, entry.uid))
+        self.entries = entries
+        self.folded = AhoCorasick([key if not case else "" for key, case, _ in self.keys])
+        self.exact = AhoCorasick([key if case else "" for key, case, _ in self.keys])
+        self.cache_size = cache_size
+        self.scan_cache: "OrderedDict[str, FrozenSet[int]]" = OrderedDict()
+
+        key_entries: Dict[int, List[int]] = {}
+        for index, entry in enumerate(entries):
+            entry.content_hits = self._scan_text(entry.content)
+            if not entry.constant:
+                for key in entry.primary:
+                    key_entries.setdefault(key, []).append(index)
+        self.key_entries = {key: tuple(indexes) for key, indexes in key_entries.items()}
+        self.constant_entries = tuple(index for index, entry in enumerate(entries) if entry.constant)
+        self.scan_depths = frozenset(entry.scan_depth for entry in entries if entry.scan_depth is not None)
+        self.dynamic_positions = frozenset(
+            entry.position for entry in entries
+            if entry.position != WORLD_INFO_AT_DEPTH and (not entry.constant or entry.probability < 100)
+        )
+        self.static_world_info = WorldInfo([
+            entry for entry in entries
+            if entry.constant and entry.position not in self.dynamic_positions
+        ])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _add_keys(self, keys: Any, case_sensitive: bool, whole_words: bool) -> Tuple[int, ...]:
+        """登记条目的关键词
+
+        Args:
+            keys: 关键词列表
+            case_sensitive: 是否区分大小写
+            whole_words: 是否全词匹配
+
+        Returns:
+            Tuple[int, ...]: 关键词序号
+        """
+        ids = []
+        for key in keys or ():
+            key = str(key).strip()
+            if not key:
+                continue
+            spec = (key, case_sensitive, whole_words)
+            key_id = self.key_ids.get(spec)
+            if key_id is None:
+                key_id = self.key_ids[spec] = len(self.keys)
+                pattern = _compile_regex_key(key)
+                if pattern is not None:
+                    # 正则关键词不进入自动机
+                    self.regex_keys.append((key_id, pattern))
+                    self.keys.append(("", case_sensitive, whole_words))
+                else:
+                    self.keys.append((key if case_sensitive else key.lower(), case_sensitive, whole_words))
+            ids.append(key_id)
+        return tuple(dict.fromkeys(ids))
+
+    def _scan_text(self, text: str) -> FrozenSet[int]:
+        """扫描文本中出现的关键词
+
+        Args:
+            text: 文本
+
+        Returns:
+            FrozenSet[int]: 出现的关键词序号
+        """
+        hits: Set[int] = set()
+        for automaton, target in ((self.folded, text.lower()), (self.exact, text)):
+            for start, key_id in automaton.iter_matches(target):
+                if key_id in hits:
+                    continue
+                key, _, whole_words = self.keys[key_id]
+                if whole_words and not _is_whole_word(target, start, start + len(key)):
+                    continue
+                hits.add(key_id)
+        for key_id, pattern in self.regex_keys:
+            if pattern.search(text) is not None:
+                hits.add(key_id)
+        return frozenset(hits)
+
+    def scan(self, text: str) -> FrozenSet[int]:
+        """扫描文本中出现的关键词,结果按原文缓存
+
+        Args:
+            text: 文本
+
+        Returns:
+            FrozenSet[int]: 出现的关键词序号
+        """
+        hits = self.scan_cache.get(text)
+        if hits is not None:
+            self.scan_cache.move_to_end(text)
+            return hits
+        hits = self.scan_cache[text] = self._scan_text(text)
+        if len(self.scan_cache) > self.cache_size:
+            self.scan_cache.popitem(last=False)
+        return hits
+
+    def activate(
+        self,
+        window: Iterable[str],
+        budget: int,
+        count_tokens: Callable[[str], int],
+        default_scan_depth: int = 2
+    ) -> WorldInfo:
+        """扫描最近的消息,返回触发的条目
+
+        Args:
+            window: 最近的消息内容,最新的在前,只读取扫描深度内的部分
+            budget: 关键词触发条目的token预算,世界书设置了token_budget时以其为准,为0时不限制
+            count_tokens: token计数函数
+            default_scan_depth: 世界书未设置scan_depth时扫描的消息数
+
+        Returns:
+            WorldInfo: 触发的条目
+        """
+        scan_depth = self.scan_depth if self.scan_depth is not None else default_scan_depth
+        max_depth = max(self.scan_depths | {scan_depth})
+        message_hits = [self.scan(text) for text in islice(window, max(max_depth, 0))]
+        hits_by_depth: Dict[int, Set[int]] = {}
+
+        def hits_at(depth: int) -> Set[int]:
+            hits = hits_by_depth.get(depth)
+            if hits is None:
+                hits = hits_by_depth[depth] = set().union(*message_hits[:max(depth, 0)])
+            return hits
+
+        activated: Set[int] = set()
+        rejected: Set[int] = set()
+        recursion_hits: Set[int] = set()
+        new_hits: Set[int] = set(hits_at(max_depth))
+        candidates: Set[int] = set(self.constant_entries)
+
+        for step in range(MAX_RECURSION_STEPS + 1):
+            for key in new_hits:
+                candidates.update(self.key_entries.get(key, ()))
+            new_entries = []
+            for index in sorted(candidates - activated - rejected):
+                entry = self.entries[index]
+                if step == 0:
+                    if not entry.constant:
+                        if entry.delay_until_recursion:
+                            continue
+                        depth = scan_depth if entry.scan_depth is None else entry.scan_depth
+                        if not entry.matches(hits_at(depth)):
+                            continue
+                else:
+                    if entry.constant or entry.exclude_recursion:
+                        continue
+                    depth = scan_depth if entry.scan_depth is None else entry.scan_depth
+                    if not entry.matches(hits_at(depth) | recursion_hits):
+                        continue
+                if entry.probability < 100 and random.random() * 100 >= entry.probability:
+                    rejected.add(index)
+                    continue
+                new_entries.append(index)
+            activated.update(new_entries)
+            if not self.recursive:
+                break
+            new_hits = set()
+            for index in new_entries:
+                entry = self.entries[index]
+                if not entry.prevent_recursion:
+                    new_hits |= entry.content_hits - recursion_hits
+            if not new_hits:
+                break
+            recursion_hits |= new_hits
+
+        if self.token_budget is not None:
+            budget = self.token_budget
+        selected = []
+        used = 0
+        overflow = False
+        for index in sorted(activated):
+            entry = self.entries[index]
+            if not entry.constant and budget > 0:
+                if overflow:
+                    continue
+                used += count_tokens(entry.content)
+                if used > budget:
+                    # 与SillyTavern相同,预算用尽后不再加入插入顺序更小的条目
+                    overflow = True
+                    continue
+            selected.append(entry)
+        return WorldInfo(selected)
+
+
+def _to_int(value: Any) -> Optional[int]:
+    """将配置值转换为整数
+
+    Args:
+        value: 配置值,可能为None、空字符串或数字
+
+    Returns:
+        Optional[int]: 整数,无法转换时为None
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _compile_regex_key(key: str) -> Optional[Any]:
+    """编译/pattern/flags形式的关键词
+
+    Args:
+        key: 关键词
+
+    Returns:
+        Optional[Pattern]: 编译后的正则,不是正则形式或无法编译时为None
+    """
+    match = _REGEX_KEY.match(key)
+    if match is None:
+        return None
+    flags = 0
+    for flag, value in (("i", regex.I), ("m", regex.M), ("s", regex.S)):
+        if flag in match.group(2):
+            flags |= value
+    try:
+        return regex.compile(match.group(1), flags)
+    except regex.error as e:
+        print(f"世界书关键词正则无效,按普通文本匹配: {key} - {e}")
+        return None
+
+
+def _is_whole_word(text: str, start: int, end: int) -> bool:
+    """判断text[start:end]两侧是否为单词边界
+
+    Args:
+        text: 文本
+        start: 起始位置
+        end: 结束位置
+
+    Returns:
+        bool: 是否为完整的单词
+    """
+    return (
+        (start == 0 or text[start - 1] not in _WORD_CHARS) and
+        (end >= len(text) or text[end] not in _WORD_CHARS)
+    )
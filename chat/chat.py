@@ -1,12 +1,14 @@
-import json
+import asyncio
 import os
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional, Union
+from typing import Any, Deque, Dict, List, Optional, Union
 from pathlib import Path
 
 from nonebot.plugin import Plugin
 
 from ..character.character import Character
+from .chat_storage import ChatKey, ChatStorage, JsonlChatStorage, migrate_chat_storage
 #from ..user.user import User
 
 # 设置聊天记录文件保存地址
@@ -14,6 +16,7 @@ from ..character.character import Character
 script_dir = os.path.dirname(os.path.realpath(__file__))
 group_chatmessage_path = os.path.join(script_dir, "../data/chat_data/group_chat")
 private_chatmessage_path = os.path.join(script_dir, "../data/chat_data/private_chat")
+chat_data_path = os.path.join(script_dir, "../data/chat_data")
 
 
 class Chat:
@@ -27,10 +30,27 @@ class Chat:
         nickname (str): 用户昵称
         message (str): 消息内容
         depth (int): 对话深度
+        max_depth (int): 按token预算截取上下文时最多读取的记录数
+        storage (ChatStorage): 聊天记录存储
+        buffer_size (int): 每个会话在内存中保留的最近记录数
+        flush_interval (float): 后台写入间隔秒数,为0时每次保存立即写入
+        buffers (Dict[ChatKey, Deque[Dict[str, Union[str, bool]]]]): 会话到最近记录的映射
+        pending (Dict[ChatKey, List[Dict[str, Any]]]): 会话到尚未写入存储的记录的映射
     """
 
-    def __init__(self) -> None:
-        """初始化聊天记录管理器"""
+    def __init__(
+        self,
+        storage: Optional[ChatStorage] = None,
+        buffer_size: int = 200,
+        flush_interval: float = 1.0
+    ) -> None:
+        """初始化聊天记录管理器
+        
+        Args:
+            storage: 聊天记录存储,默认为data/chat_data下的JSONL文件
+            buffer_size: 每个会话在内存中保留的最近记录数
+            flush_interval: 后台写入间隔秒数,为0时每次保存立即写入
+        """
         self.message_type: str = ''
         self.chat_user_id: str = ''
         self.user_id: str = ''
@@ -38,6 +58,14 @@ class Chat:
         self.nickname: str = ''
         self.message: str = ''
         self.depth: int = 8
+        self.max_depth: int = 200
+        self.storage = storage or JsonlChatStorage(chat_data_path)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffers: Dict[ChatKey, Deque[Dict[str, Union[str, bool]]]] = {}
+        self.pending: Dict[ChatKey, List[Dict[str, Any]]] = {}
+        self.write_lock = asyncio.Lock()
+        self.writer_task: Optional[asyncio.Task] = None
 
 
 
@@ -62,7 +90,7 @@ class Chat:
         chat_user_id: str,
         character_name: str
     ) -> None:
-        """创建新的聊天记录文件
+        """创建新的聊天记录
         
         Args:
             message_type: 消息类型(group/private)
@@ -71,22 +99,15 @@ class Chat:
             
         Raises:
             ValueError: 消息类型无效
-            IOError: 文件创建失败
+            IOError: 创建失败
         """
         if message_type not in ["group", "private"]:
             raise ValueError(f"无效的消息类型: {message_type}")
 
         try:
-            chat_dir = self._get_chat_dir(message_type)
-            filename = f"{message_type}-{chat_user_id}-{character_name}.jsonl"
-            
-            if filename not in os.listdir(chat_dir):
-                filepath = os.path.join(chat_dir, filename)
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    print(f"创建新聊天记录文件: {filepath}")
-                    
-        except IOError as e:
-            raise IOError(f"创建聊天记录文件失败: {str(e)}") from e
+            await asyncio.to_thread(self.storage.create, (message_type, chat_user_id, character_name))
+        except OSError as e:
+            raise IOError(f"创建聊天记录失败: {str(e)}") from e
 
 
 
@@ -105,6 +126,8 @@ class Chat:
     ) -> None:
         """保存聊天消息
         
+        消息立即加入内存中的最近记录,由后台任务每flush_interval秒批量写入存储。
+        
         Args:
             message_type: 消息类型
             chat_user_id: 聊天用户ID
@@ -120,38 +143,85 @@ class Chat:
         if message_type not in ["group", "private"]:
             raise ValueError(f"无效的消息类型: {message_type}")
 
+        key = (message_type, chat_user_id, character_name)
+        now = datetime.now().strftime("%Y-%m-%d@%H:%M:%S")
+        
+        # 保存用户消息
+        user_msg = {
+            "name": nickname,
+            "is_user": True,
+            "user_id": chat_user_id,
+            "is_system": False,
+            "msg": message,
+            "create_date": now
+        }
+        
+        # 保存助手回复
+        assistant_msg = {
+            "name": character_name,
+            "is_user": False,
+            "user_id": chat_user_id,
+            "msg": assistant_reply,
+            "create_date": now
+        }
+
         try:
-            chat_dir = self._get_chat_dir(message_type)
-            filename = f"{message_type}-{chat_user_id}-{character_name}.jsonl"
-            
-            if filename in os.listdir(chat_dir):
-                filepath = os.path.join(chat_dir, filename)
-                with open(filepath, 'a+', encoding='utf-8') as f:
-                    now = datetime.now().strftime("%Y-%m-%d@%H:%M:%S")
-                    
-                    # 保存用户消息
-                    user_msg = {
-                        "name": nickname,
-                        "is_user": True,
-                        "user_id": chat_user_id,
-                        "is_system": False,
-                        "msg": message,
-                        "create_date": now
-                    }
-                    f.write(json.dumps(user_msg, ensure_ascii=False) + '\n')
-                    
-                    # 保存助手回复
-                    assistant_msg = {
-                        "name": character_name,
-                        "is_user": False,
-                        "user_id": chat_user_id,
-                        "msg": assistant_reply,
-                        "create_date": now
-                    }
-                    f.write(json.dumps(assistant_msg, ensure_ascii=False) + '\n')
-                    
-        except IOError as e:
+            buffer = await self._get_buffer(key)
+        except (OSError, ValueError) as e:
             raise IOError(f"保存聊天记录失败: {str(e)}") from e
+        buffer.append(self._to_context(user_msg))
+        buffer.append(self._to_context(assistant_msg))
+        self.pending.setdefault(key, []).extend([user_msg, assistant_msg])
+
+        if self.flush_interval <= 0:
+            await self.flush()
+        else:
+            self.start_writer()
+
+    def start_writer(self) -> None:
+        """启动后台写入任务,已在运行时不重复启动"""
+        if self.flush_interval <= 0:
+            return
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        """每flush_interval秒将待写入的记录写入存储"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except IOError as e:
+                print(f"后台写入聊天记录失败,将在下次重试: {e}")
+
+    async def flush(self) -> None:
+        """将待写入的记录写入存储
+        
+        Raises:
+            IOError: 写入失败,未写入的记录保留到下次重试
+        """
+        async with self.write_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            try:
+                await asyncio.to_thread(self.storage.append_batch, batch)
+            except Exception as e:
+                for key, records in batch.items():
+                    self.pending[key] = records + self.pending.get(key, [])
+                raise IOError(f"保存聊天记录失败: {str(e)}") from e
+
+    async def close(self) -> None:
+        """停止后台写入任务,写入剩余记录并关闭存储"""
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+            self.writer_task = None
+        await self.flush()
+        self.storage.close()
 
 
 
@@ -162,7 +232,8 @@ class Chat:
         self,
         message_type: str,
         chat_user_id: str,
-        character_name: str
+        character_name: str,
+        depth: Optional[int] = None
     ) -> List[Dict[str, Union[str, bool]]]:
         """获取聊天上下文
         
@@ -170,6 +241,7 @@ class Chat:
             message_type: 消息类型
             chat_user_id: 聊天用户ID
             character_name: 角色名称
+            depth: 读取的最近记录数,默认为self.depth
             
         Returns:
             List[Dict[str, Union[str, bool]]]: 聊天上下文列表
@@ -181,36 +253,92 @@ class Chat:
         if message_type not in ["group", "private"]:
             raise ValueError(f"无效的消息类型: {message_type}")
 
-        context = []
+        key = (message_type, chat_user_id, character_name)
+        depth = depth or self.depth
         try:
-            chat_dir = self._get_chat_dir(message_type)
-            filename = f"{message_type}-{chat_user_id}-{character_name}.jsonl"
-            filepath = os.path.join(chat_dir, filename)
-            
-            if not os.path.exists(filepath):
+            if key not in self.buffers:
                 await self.new_chat(message_type, chat_user_id, character_name)
-                return context
                 
-            if os.path.getsize(filepath) == 0:
-                return context
+            if depth > self.buffer_size:
+                # 超出内存记录数时写入待写记录后从存储读取
+                await self.flush()
+                records = await asyncio.to_thread(self.storage.read_tail, key, depth)
+                return [self._to_context(record) for record in records]
                 
-            with open(filepath, 'r', encoding='utf-8') as f:
-                lines = f.readlines()[-self.depth:]  # 获取最近的depth条记录
-                for line in lines:
-                    chat_note = json.loads(line)
-                    context.append({
-                        "name": chat_note["name"],
-                        "is_user": chat_note["is_user"],
-                        "msg": chat_note["msg"]
-                    })
-                    
-            return context
+            # 获取最近的depth条记录
+            buffer = await self._get_buffer(key)
+            start = max(len(buffer) - depth, 0)
+            return [dict(buffer[index]) for index in range(start, len(buffer))]
             
-        except IOError as e:
+        except OSError as e:
             raise IOError(f"读取聊天记录失败: {str(e)}") from e
-        except json.JSONDecodeError as e:
+        except (ValueError, KeyError) as e:
             raise ValueError(f"聊天记录格式错误: {str(e)}") from e
 
+    async def _get_buffer(self, key: ChatKey) -> Deque[Dict[str, Union[str, bool]]]:
+        """获取会话的内存记录,首次访问时从存储载入
+        
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+            
+        Returns:
+            Deque[Dict[str, Union[str, bool]]]: 最近buffer_size条记录
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            records = await asyncio.to_thread(self.storage.read_tail, key, self.buffer_size)
+            # 载入期间其他协程可能已经建立了内存记录
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = deque(
+                    (self._to_context(record) for record in records),
+                    maxlen=self.buffer_size
+                )
+                self.buffers[key] = buffer
+        return buffer
+
+    @staticmethod
+    def _to_context(chat_note: Dict[str, Any]) -> Dict[str, Union[str, bool]]:
+        """提取聊天记录中构造上下文需要的字段
+        
+        Args:
+            chat_note: 聊天记录
+            
+        Returns:
+            Dict[str, Union[str, bool]]: 包含name/is_user/msg/create_date的字典
+        """
+        return {
+            "name": chat_note["name"],
+            "is_user": chat_note["is_user"],
+            "msg": chat_note["msg"],
+            "create_date": chat_note.get("create_date", "")
+        }
+
+
+
+    def release_buffer(
+        self,
+        message_type: str,
+        chat_user_id: str,
+        character_name: str
+    ) -> bool:
+        """释放会话的内存记录,下次访问时从存储重新载入
+        
+        还有记录尚未写入存储时不释放,否则重新载入会丢失这些记录。
+        
+        Args:
+            message_type: 消息类型
+            chat_user_id: 聊天用户ID
+            character_name: 角色名称
+            
+        Returns:
+            bool: 是否已释放
+        """
+        key = (message_type, chat_user_id, character_name)
+        if key in self.pending or self.write_lock.locked():
+            return False
+        return self.buffers.pop(key, None) is not None
+
 
 
     #清空聊天记录
@@ -234,37 +362,25 @@ class Chat:
         if message_type not in ["group", "private"]:
             raise ValueError(f"无效的消息类型: {message_type}")
 
+        key = (message_type, chat_user_id, character_name)
         try:
-            chat_dir = self._get_chat_dir(message_type)
-            filename = f"{message_type}-{chat_user_id}-{character_name}.jsonl"
-            filepath = os.path.join(chat_dir, filename)
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
+            async with self.write_lock:
+                self.pending.pop(key, None)
+                self.buffers[key] = deque(maxlen=self.buffer_size)
+                await asyncio.to_thread(self.storage.clear, key)
                 print("聊天记录已清除")
                 
-        except IOError as e:
+        except OSError as e:
             raise IOError(f"清除聊天记录失败: {str(e)}") from e
 
-    def _get_chat_dir(self, message_type: str) -> str:
-        """获取聊天记录目录路径
+    async def migrate_to(self, target: ChatStorage) -> Dict[str, int]:
+        """写入待写记录后将全部聊天记录迁移到另一个存储
         
         Args:
-            message_type: 消息类型
+            target: 目标存储
             
         Returns:
-            str: 目录路径
-            
-        Raises:
-            ValueError: 消息类型无效
+            Dict[str, int]: 迁移的会话数、记录数,继续迁移的部分会话数、跳过的会话数和冲突的会话数
         """
-        if message_type not in ["group", "private"]:
-            raise ValueError(f"无效的消息类型: {message_type}")
-            
-        base_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        return os.path.join(
-            base_dir,
-            "data/chat_data",
-            f"{message_type}_chat"
-        )
-
-
+        await self.flush()
+        return await asyncio.to_thread(migrate_chat_storage, self.storage, target)
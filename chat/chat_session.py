@@ -1,5 +1,36 @@
+import sys
 from typing import List, Optional, Dict, Any
 from ..character.character import Character
+from ..preset.RegexProcess import RegexPipeline
+from ..preset.generation import GenerationSettings
+
+
+def _estimate_size(value: Any) -> int:
+    """递归估算对象及其包含的字符串、列表和字典占用的字节数
+
+    使用__slots__的对象不计入其shared_attributes中列出的共享属性。
+
+    Args:
+        value: 对象
+
+    Returns:
+        int: 估算的字节数
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_estimate_size(key) + _estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(item) for item in value)
+    elif hasattr(value, "__dict__"):
+        size += _estimate_size(vars(value))
+    elif hasattr(type(value), "__slots__"):
+        shared = getattr(type(value), "shared_attributes", ())
+        size += sum(
+            _estimate_size(getattr(value, name, None))
+            for name in type(value).__slots__
+            if name not in shared
+        )
+    return size
 
 
 class ChatSession:
@@ -12,7 +43,16 @@ class ChatSession:
         nick_name (str): 用户昵称
         preset_name (str): 预设配置名称
         preset_order_prompts (List[Dict[str, Any]]): 预设提示词顺序列表
-        preset_regex (List[Dict[str, Any]]): 预设正则表达式列表
+        preset_injection_prompts (List[Dict[str, Any]]): 预设中插入聊天历史的提示词
+        preset_regex (Optional[RegexPipeline]): 预设的正则规则流水线
+        stream_openai (bool): 是否以流式方式逐条发送回复
+        max_context (int): 预设的上下文token上限(openai_max_context),0表示不限制
+        max_tokens (int): 预设为回复预留的token数(openai_max_tokens)
+        generation (Optional[GenerationSettings]): 预设中与生成相关的设置,未设置时使用默认设置
+        variables (Dict[str, Any]): {{setvar}}等宏使用的会话变量
+        character_version (int): 取得角色时CharacterUtil的版本号,-1表示需要检查
+        preset_version (int): 取得预设时QLPresetManager的版本号,-1表示需要检查
+        prompt_cache (Optional[Any]): 构造提示时缓存的静态前缀和聊天历史消息,由Messages维护
     """
 
     def __init__(self, character: Character, session_id: str) -> None:
@@ -28,7 +68,16 @@ class ChatSession:
         self.nick_name: str = ""
         self.preset_name: str = ""
         self.preset_order_prompts: List[Dict[str, Any]] = []
-        self.preset_regex: List[Dict[str, Any]] = []
+        self.preset_injection_prompts: List[Dict[str, Any]] = []
+        self.preset_regex: Optional[RegexPipeline] = None
+        self.stream_openai: bool = False
+        self.max_context: int = 0
+        self.max_tokens: int = 0
+        self.generation: Optional[GenerationSettings] = None
+        self.variables: Dict[str, Any] = {}
+        self.character_version: int = -1
+        self.preset_version: int = -1
+        self.prompt_cache: Optional[Any] = None
 
     def set_character(self, character: Character) -> None:
         """设置角色
@@ -62,14 +111,66 @@ class ChatSession:
         """
         self.preset_order_prompts = preset_order_prompts
 
-    def set_preset_regex(self, preset_regex: List[Dict[str, Any]]) -> None:
-        """设置预设正则表达式
+    def set_preset_injection_prompts(self, preset_injection_prompts: List[Dict[str, Any]]) -> None:
+        """设置预设中插入聊天历史的提示词
+        
+        Args:
+            preset_injection_prompts: 新的提示词列表
+        """
+        self.preset_injection_prompts = preset_injection_prompts
+
+    def set_preset_regex(self, preset_regex: Optional[RegexPipeline]) -> None:
+        """设置预设正则规则
         
         Args:
-            preset_regex: 新的预设正则表达式列表
+            preset_regex: 新的正则规则流水线
         """
         self.preset_regex = preset_regex
 
+    def set_stream_openai(self, stream_openai: bool) -> None:
+        """设置是否流式发送回复
+        
+        Args:
+            stream_openai: 是否流式发送
+        """
+        self.stream_openai = stream_openai
+
+    def set_global_settings(self, global_settings: Dict[str, Any]) -> None:
+        """根据预设的全局设置更新流式发送和上下文预算
+        
+        Args:
+            global_settings: 预设的global_settings
+        """
+        self.stream_openai = bool(global_settings.get("stream_openai", False))
+        self.max_context = int(global_settings.get("openai_max_context") or 0)
+        self.max_tokens = int(global_settings.get("openai_max_tokens") or 0)
+
+    def set_generation_settings(self, generation: Optional[GenerationSettings]) -> None:
+        """设置预设中与生成相关的设置
+        
+        Args:
+            generation: 编译预设时转换的生成设置
+        """
+        self.generation = generation
+
+    def get_generation_settings(self) -> Optional[GenerationSettings]:
+        """获取预设中与生成相关的设置
+        
+        Returns:
+            Optional[GenerationSettings]: 生成设置,未设置时为None
+        """
+        return self.generation
+
+    def get_context_budget(self) -> int:
+        """获取提示可用的token预算
+        
+        Returns:
+            int: openai_max_context减去为回复预留的token数,未设置上限时为0
+        """
+        if self.max_context <= 0:
+            return 0
+        return max(self.max_context - self.max_tokens, 1)
+
     def set_nick_name(self, nick_name: str) -> None:
         """设置用户昵称
         
@@ -118,11 +219,19 @@ class ChatSession:
         """
         return self.preset_order_prompts
 
-    def get_preset_regex(self) -> List[Dict[str, Any]]:
-        """获取预设正则表达式
+    def get_preset_injection_prompts(self) -> List[Dict[str, Any]]:
+        """获取预设中插入聊天历史的提示词
         
         Returns:
-            List[Dict[str, Any]]: 预设正则表达式列表
+            List[Dict[str, Any]]: 提示词列表
+        """
+        return self.preset_injection_prompts
+
+    def get_preset_regex(self) -> Optional[RegexPipeline]:
+        """获取预设正则规则
+        
+        Returns:
+            Optional[RegexPipeline]: 正则规则流水线,未设置时为None
         """
         return self.preset_regex
 
@@ -145,9 +254,27 @@ class ChatSession:
             "user_id": self.user_id,
             "nick_name": self.nick_name,
             "character_name": self.get_character_name(),
-            "preset_name": self.preset_name
+            "preset_name": self.preset_name,
+            "stream_openai": self.stream_openai,
+            "max_context": self.max_context,
+            "max_tokens": self.max_tokens
         }
 
+    # 由多个会话共享的对象,不计入单个会话的内存占用
+    shared_attributes = ("character", "preset_order_prompts", "preset_injection_prompts", "preset_regex", "generation")
+
+    def estimate_size(self) -> int:
+        """估算会话自身占用的内存字节数,不包括与其他会话共享的角色、预设提示词和正则
+        
+        Returns:
+            int: 估算的字节数
+        """
+        return sys.getsizeof(self) + sum(
+            _estimate_size(key) + _estimate_size(value)
+            for key, value in vars(self).items()
+            if key not in self.shared_attributes
+        )
+
     def update_session(self, **kwargs: Any) -> None:
         """更新会话属性
         
@@ -169,4 +296,13 @@ class ChatSession:
         self.nick_name = ""
         self.preset_name = ""
         self.preset_order_prompts = []
-        self.preset_regex = []
\ No newline at end of file
+        self.preset_injection_prompts = []
+        self.preset_regex = None
+        self.stream_openai = False
+        self.max_context = 0
+        self.max_tokens = 0
+        self.generation = None
+        self.variables = {}
+        self.character_version = -1
+        self.preset_version = -1
+        self.prompt_cache = None
\ No newline at end of file
@@ -1,9 +1,31 @@
-from typing import Dict, List, Optional, Any
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional, Any, Tuple
 from nonebot.adapters.onebot.v11 import Bot
 
 from ..character.character import Character
 from .chat_session import ChatSession
+from .nickname_directory import NicknameDirectory
 from ..preset.QLPreset_manage import QLPresetManager
+from ..util.character_util import CharacterUtil
+
+class SessionTurnState:
+    """单个会话的轮次状态
+    
+    Attributes:
+        lock (asyncio.Lock): 轮次锁,等待者按到达顺序获得
+        users (int): 正在执行或等待的轮次数
+        merged (Optional[List[str]]): merge策略下等待合并的消息,没有等待者时为None
+    """
+
+    def __init__(self) -> None:
+        """初始化轮次状态"""
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.merged: Optional[List[str]] = None
+
 
 class ChatSessionManager:
     """聊天会话管理器类,用于管理所有会话
@@ -11,16 +33,127 @@ class ChatSessionManager:
     Attributes:
         group_session_list (Dict[str, ChatSession]): 群聊会话字典
         private_session_list (Dict[str, ChatSession]): 私聊会话字典
-        session_keys (List[str]): 活跃会话ID列表
+        session_keys (OrderedDict[Tuple[str, str], float]): (消息类型, 会话ID)到最后访问时间的映射,
+            按访问时间从旧到新排列
         preset_manage (QLPresetManager): 预设管理器实例
+        busy_policy (str): 会话正在回复时收到新消息的处理方式(queue/merge/drop)
+        turn_states (Dict[Tuple[str, str], SessionTurnState]): 会话到轮次状态的映射
+        nickname_directory (NicknameDirectory): 用户昵称目录
+        max_sessions (int): 内存中保留的最大会话数,0表示不限制
+        idle_ttl (float): 会话空闲多少秒后被移出内存,0表示不过期
+        on_evict (Optional[Callable[[str, str, ChatSession], None]]): 会话被移出内存时的回调
+        character_util (Optional[CharacterUtil]): 角色工具,用于在角色配置变化后重新取得会话的角色
+        counters (Dict[str, int]): 命中、未命中、移出和更新次数
     """
 
-    def __init__(self) -> None:
-        """初始化会话管理器"""
+    busy_policies = ("queue", "merge", "drop")
+
+    def __init__(
+        self,
+        busy_policy: str = "queue",
+        nickname_directory: Optional[NicknameDirectory] = None,
+        max_sessions: int = 0,
+        idle_ttl: float = 0.0,
+        on_evict: Optional[Callable[[str, str, ChatSession], None]] = None,
+        character_util: Optional[CharacterUtil] = None
+    ) -> None:
+        """初始化会话管理器
+        
+        会话只是角色卡、预设和昵称的内存缓存,聊天记录和预设选择都已持久化,
+        被移出内存的会话在下一条消息到达时由create_session重新建立。
+        
+        Args:
+            busy_policy: 会话正在回复时收到新消息的处理方式
+                queue: 排队,按到达顺序逐条回复
+                merge: 回复期间到达的消息合并为下一轮的一条消息
+                drop: 丢弃回复期间到达的消息
+            nickname_directory: 用户昵称目录
+            max_sessions: 内存中保留的最大会话数,超出时移出最久未访问的会话,0表示不限制
+            idle_ttl: 会话空闲多少秒后被移出内存,0表示不过期
+            on_evict: 会话被移出内存时的回调,参数为消息类型、会话ID和会话对象
+            character_util: 角色工具,为None时会话的角色不随角色配置更新
+                
+        Raises:
+            ValueError: 处理方式无效
+        """
+        if busy_policy not in self.busy_policies:
+            raise ValueError(f"无效的会话繁忙处理方式: {busy_policy}")
         self.group_session_list: Dict[str, ChatSession] = {}
         self.private_session_list: Dict[str, ChatSession] = {}
-        self.session_keys: List[str] = []
+        self.session_keys: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
         self.preset_manage = QLPresetManager()
+        self.busy_policy = busy_policy
+        self.turn_states: Dict[Tuple[str, str], SessionTurnState] = {}
+        self.nickname_directory = nickname_directory or NicknameDirectory()
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.character_util = character_util
+        self.counters: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "idle_evictions": 0,
+            "lru_evictions": 0,
+            "character_updates": 0,
+            "preset_updates": 0
+        }
+
+    @asynccontextmanager
+    async def session_turn(
+        self,
+        message_type: str,
+        session_id: str,
+        message: str
+    ) -> AsyncIterator[Optional[str]]:
+        """在会话内按到达顺序独占执行一轮对话,不同会话之间互不阻塞
+        
+        用法:
+            async with chat_util.session_turn(message_type, session_id, message) as turn_message:
+                if turn_message is None:
+                    return  # 消息已被合并到其他轮次或被丢弃
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            message: 本轮的用户消息
+            
+        Yields:
+            Optional[str]: 本轮要回复的消息(merge策略下为合并后的消息),
+            消息被合并到其他轮次或被丢弃时为None
+        """
+        key = (message_type, session_id)
+        state = self.turn_states.get(key)
+        if state is None:
+            state = self.turn_states[key] = SessionTurnState()
+
+        if state.lock.locked():
+            if self.busy_policy == "drop":
+                yield None
+                return
+            if self.busy_policy == "merge" and state.merged is not None:
+                state.merged.append(message)
+                yield None
+                return
+
+        # merge策略下第一个等待者负责收集后续消息
+        leader = self.busy_policy == "merge" and state.lock.locked()
+        if leader:
+            state.merged = [message]
+        state.users += 1
+        try:
+            async with state.lock:
+                if leader:
+                    message = "\n".join(state.merged)
+                    state.merged = None
+                    leader = False
+                yield message
+        finally:
+            if leader:
+                # 等待期间被取消,后续消息不再合并到本轮
+                state.merged = None
+            state.users -= 1
+            if state.users == 0 and self.turn_states.get(key) is state:
+                del self.turn_states[key]
 
     def get_session(self, message_type: str, session_id: str) -> Optional[ChatSession]:
         """获取指定会话
@@ -42,8 +175,111 @@ class ChatSessionManager:
             self.group_session_list if message_type == "group" 
             else self.private_session_list
         )
+        session = session_list.get(session_id)
+        if session is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        self._touch((message_type, session_id))
+        self.evict_sessions()
+        return session
+
+    def peek_session(self, message_type: str, session_id: str) -> Optional[ChatSession]:
+        """获取内存中的会话,不记录访问,也不计入命中统计
+        
+        Args:
+            message_type: 消息类型(group/private)
+            session_id: 会话ID
+            
+        Returns:
+            Optional[ChatSession]: 会话对象,不在内存中时返回None
+        """
+        session_list = (
+            self.group_session_list if message_type == "group"
+            else self.private_session_list
+        )
         return session_list.get(session_id)
 
+    def _touch(self, key: Tuple[str, str], now: Optional[float] = None) -> None:
+        """记录会话的访问时间并移到最近访问的位置
+        
+        Args:
+            key: (消息类型, 会话ID)
+            now: 当前时间(time.monotonic()),为None时读取当前时间
+        """
+        self.session_keys[key] = time.monotonic() if now is None else now
+        self.session_keys.move_to_end(key)
+
+    def _add_session(self, message_type: str, session_id: str, session: ChatSession) -> None:
+        """将会话放入内存并按需移出其他会话
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            session: 会话对象
+        """
+        if message_type == "group":
+            self.group_session_list[session_id] = session
+        else:
+            self.private_session_list[session_id] = session
+        self._touch((message_type, session_id))
+        self.evict_sessions()
+
+    def evict_sessions(self) -> int:
+        """移出空闲超时的会话,并在超出max_sessions时移出最久未访问的会话
+        
+        session_keys按访问时间排列,只需从最旧的一端检查,每次调用的开销与移出的会话数成正比。
+        正在回复或排队的会话不会被移出,视为刚刚访问过。
+        
+        Returns:
+            int: 移出的会话数
+        """
+        now = time.monotonic()
+        evicted = 0
+        if self.idle_ttl > 0:
+            while self.session_keys:
+                key, last_access = next(iter(self.session_keys.items()))
+                if now - last_access < self.idle_ttl:
+                    break
+                if key in self.turn_states:
+                    self._touch(key, now)
+                    continue
+                self._evict(key)
+                self.counters["idle_evictions"] += 1
+                evicted += 1
+
+        if self.max_sessions > 0:
+            busy = 0
+            while len(self.session_keys) > self.max_sessions and busy < len(self.session_keys):
+                key = next(iter(self.session_keys))
+                if key in self.turn_states:
+                    self._touch(key, now)
+                    busy += 1
+                    continue
+                self._evict(key)
+                self.counters["lru_evictions"] += 1
+                evicted += 1
+        return evicted
+
+    def _evict(self, key: Tuple[str, str]) -> None:
+        """将会话移出内存并通知on_evict
+        
+        Args:
+            key: (消息类型, 会话ID)
+        """
+        message_type, session_id = key
+        del self.session_keys[key]
+        session_list = (
+            self.group_session_list if message_type == "group"
+            else self.private_session_list
+        )
+        session = session_list.pop(session_id, None)
+        if session is not None and self.on_evict is not None:
+            try:
+                self.on_evict(message_type, session_id, session)
+            except Exception as e:
+                print(f"会话移出回调失败({message_type}-{session_id}): {e}")
+
     def create_session(
         self,
         message_type: str,
@@ -72,50 +308,105 @@ class ChatSessionManager:
             character=character,
             session_id=session_id
         )
+        if self.character_util is not None:
+            session.character_version = self.character_util.version
+        self._apply_preset(message_type, session_id, session)
+        self._add_session(message_type, session_id, session)
+        return session
+
+    def _apply_preset(self, message_type: str, session_id: str, session: ChatSession) -> None:
+        """将会话当前选择的预设写入会话,并记录预设管理器的版本号
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            session: 会话对象
+        """
+        preset_name = self.preset_manage.get_preset_name(message_type, session_id)
+        compiled = self.preset_manage.get_compiled_preset(preset_name, message_type)
         session.update_session(
-            # user_id=user_id,
-            # nick_name=nickname,
-            preset_order_prompts=self.preset_manage.get_order_prompts(
-                message_type, 
-                session_id
-            ),
-            preset_name=self.preset_manage.get_preset_name(
-                message_type,
-                session_id
-            )
+            preset_order_prompts=compiled.order_prompts,
+            preset_injection_prompts=compiled.injection_prompts,
+            preset_name=preset_name,
+            preset_version=self.preset_manage.version
         )
+        session.set_global_settings(compiled.global_settings)
+        session.set_generation_settings(compiled.generation)
+
+    def revalidate_session(self, message_type: str, session_id: str, session: ChatSession) -> bool:
+        """角色或预设的版本号变化后更新会话,版本号未变化时只比较两个整数
         
-        if message_type == "group":
-            self.group_session_list[session_id] = session
-        else:
-            self.private_session_list[session_id] = session
-            
-        if session_id not in self.session_keys:
-            self.session_keys.append(session_id)
+        版本号变化时重新取得会话的角色和编译后的预设,两者由注册表和预设管理器按文件状态缓存,
+        只有角色卡、角色指定或预设实际改变的会话才换用新的对象,其余会话的对象和提示缓存保持不变。
+        更换为其他角色时清空会话变量,会话变量属于原来的角色。
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            session: 会话对象
             
-        return session
+        Returns:
+            bool: 是否重新检查了角色或预设,调用方据此更新会话的正则规则和聊天记录缓存
+        """
+        checked = False
+        character_util = self.character_util
+        if character_util is not None and session.character_version != character_util.version:
+            checked = True
+            try:
+                character = character_util.get_character_by_id(message_type, session_id)
+            except (KeyError, FileNotFoundError, ValueError) as e:
+                # 角色卡被删除或无效时继续使用原来的角色
+                print(f"更新会话角色失败({message_type}-{session_id}): {e}")
+                character = session.get_character()
+            if character is not session.get_character():
+                if character.get_name() != session.get_character_name():
+                    session.variables = {}
+                session.set_character(character)
+                self.counters["character_updates"] += 1
+            session.character_version = character_util.version
 
-    async def get_nick_name(self, bot: Bot, user_id: str) -> str:
-        """获取用户昵称
+        if session.preset_version != self.preset_manage.version:
+            checked = True
+            preset_name = self.preset_manage.get_preset_name(message_type, session_id)
+            try:
+                compiled = self.preset_manage.get_compiled_preset(preset_name, message_type)
+            except FileNotFoundError as e:
+                print(f"更新会话预设失败({message_type}-{session_id}): {e}")
+                session.preset_version = self.preset_manage.version
+                return checked
+            if (
+                preset_name != session.preset_name
+                or compiled.order_prompts is not session.get_preset_order_prompts()
+                or compiled.injection_prompts is not session.get_preset_injection_prompts()
+                or compiled.generation is not session.get_generation_settings()
+            ):
+                self._apply_preset(message_type, session_id, session)
+                self.counters["preset_updates"] += 1
+            else:
+                session.preset_version = self.preset_manage.version
+        return checked
+
+    async def get_nick_name(
+        self,
+        bot: Bot,
+        user_id: str,
+        group_id: Optional[str] = None,
+        sender: Any = None
+    ) -> str:
+        """获取用户昵称,群聊中优先使用群名片
+        
+        名称来自事件的发送者信息或昵称目录缓存,只有从未见过的用户才会调用接口查询。
         
         Args:
             bot: Bot实例
             user_id: 用户ID
+            group_id: 群号,私聊时为None
+            sender: 事件中的发送者信息
             
         Returns:
-            str: 用户昵称
-            
-        Raises:
-            RuntimeError: 获取用户信息失败
+            str: 用户昵称,无法获取时为"未知昵称"
         """
-        try:
-            user_info = await bot.call_api(
-                "get_stranger_info",
-                user_id=user_id
-            )
-            return user_info.get('nickname', '未知昵称')
-        except Exception as e:
-            raise RuntimeError(f"获取用户昵称失败: {str(e)}") from e
+        return await self.nickname_directory.get_nick_name(bot, user_id, group_id, sender)
 
     def remove_session(self, message_type: str, session_id: str) -> bool:
         """移除指定会话
@@ -140,8 +431,7 @@ class ChatSessionManager:
         
         if session_id in session_list:
             del session_list[session_id]
-            if session_id in self.session_keys:
-                self.session_keys.remove(session_id)
+            self.session_keys.pop((message_type, session_id), None)
             return True
         return False
 
@@ -154,19 +444,36 @@ class ChatSessionManager:
     def get_session_stats(self) -> Dict[str, Any]:
         """获取会话统计信息
         
+        会话的字节数为估算值,每次调用都会遍历全部会话,不应在消息处理路径上调用。
+        
         Returns:
             Dict[str, Any]: 会话统计信息
         """
+        self.evict_sessions()
+        session_bytes = {}
+        for message_type, session_id in self.session_keys:
+            session_list = (
+                self.group_session_list if message_type == "group"
+                else self.private_session_list
+            )
+            session = session_list.get(session_id)
+            if session is not None:
+                session_bytes[f"{message_type}-{session_id}"] = session.estimate_size()
         return {
             "total_sessions": len(self.session_keys),
             "group_sessions": len(self.group_session_list),
             "private_sessions": len(self.private_session_list),
-            "active_sessions": self.session_keys
+            "active_sessions": [session_id for _, session_id in self.session_keys],
+            "max_sessions": self.max_sessions,
+            "idle_ttl": self.idle_ttl,
+            **self.counters,
+            "estimated_bytes": sum(session_bytes.values()),
+            "largest_sessions": sorted(session_bytes.items(), key=lambda item: item[1], reverse=True)[:5]
         }
 
     def set_group_session(self, group_id, chat_session):
-        self.group_session_list[group_id] = chat_session
+        self._add_session("group", group_id, chat_session)
 
     def set_private_session(self, user_id, chat_session):
-        self.private_session_list[user_id] = chat_session
+        self._add_session("private", user_id, chat_session)
 
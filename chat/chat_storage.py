@@ -0,0 +1,414 @@
+import json
+import os
+import sqlite3
+import threading
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Tuple
+
+# (消息类型, 会话ID, 角色名称)
+ChatKey = Tuple[str, str, str]
+
+
+def read_tail_lines(filepath: str, count: int, block_size: int = 65536) -> List[str]:
+    """从文件末尾向前按块读取,返回最后count行
+
+    只读取包含最后count行的若干块,读取量与文件大小无关。
+    UTF-8中换行符不会出现在多字节字符内部,因此可以直接在字节上切分。
+
+    Args:
+        filepath: 文件路径
+        count: 需要的行数
+        block_size: 每次向前读取的字节数
+
+    Returns:
+        List[str]: 最后count个非空行,按文件中的顺序排列
+    """
+    if count <= 0:
+        return []
+    with open(filepath, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        # 多读一个换行,保证最前面的一行是完整的
+        while position > 0 and data.count(b"\n") <= count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+
+    lines = data.split(b"\n")
+    if position > 0:
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip()]
+    return [line.decode('utf-8') for line in lines[-count:]]
+
+
+class ChatStorage:
+    """聊天记录存储接口
+
+    每个(消息类型, 会话ID, 角色名称)对应一条按时间排列的记录序列。
+    方法均为同步调用,由Chat在线程中执行。
+    """
+
+    def create(self, key: ChatKey) -> None:
+        """创建空的聊天记录,已存在时不做任何事
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+        """
+        raise NotImplementedError
+
+    def append(self, key: ChatKey, records: List[Dict[str, Any]]) -> None:
+        """追加一批记录,同一批记录要么全部写入要么全部不写入
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+            records: 聊天记录列表
+        """
+        raise NotImplementedError
+
+    def append_batch(self, batch: Dict[ChatKey, List[Dict[str, Any]]]) -> None:
+        """追加多个会话的记录
+
+        Args:
+            batch: 键到聊天记录列表的映射
+        """
+        for key, records in batch.items():
+            self.append(key, records)
+
+    def read_tail(self, key: ChatKey, count: int) -> List[Dict[str, Any]]:
+        """读取最后count条记录
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+            count: 记录数
+
+        Returns:
+            List[Dict[str, Any]]: 记录列表,按时间从旧到新排列
+        """
+        raise NotImplementedError
+
+    def clear(self, key: ChatKey) -> None:
+        """清空聊天记录
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+        """
+        raise NotImplementedError
+
+    def iter_keys(self) -> Iterator[ChatKey]:
+        """遍历所有聊天记录的键
+
+        Yields:
+            ChatKey: (消息类型, 会话ID, 角色名称)
+        """
+        raise NotImplementedError
+
+    def iter_records(self, key: ChatKey) -> Iterator[Dict[str, Any]]:
+        """按时间顺序逐条遍历聊天记录
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+
+        Yields:
+            Dict[str, Any]: 聊天记录
+        """
+        raise NotImplementedError
+
+    def count(self, key: ChatKey) -> int:
+        """获取记录条数
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+
+        Returns:
+            int: 记录条数,不存在时为0
+        """
+        return sum(1 for _ in self.iter_records(key))
+
+    def close(self) -> None:
+        """释放存储占用的资源"""
+
+
+class JsonlChatStorage(ChatStorage):
+    """JSONL文件存储,每个会话和角色一个{type}_chat/{type}-{id}-{角色}.jsonl文件
+
+    Attributes:
+        base_dir (str): 聊天记录根目录(data/chat_data)
+        fsync (bool): 每次追加后是否调用fsync
+    """
+
+    def __init__(self, base_dir: str, fsync: bool = False) -> None:
+        """初始化JSONL存储
+
+        Args:
+            base_dir: 聊天记录根目录
+            fsync: 每次追加后是否调用fsync
+        """
+        self.base_dir = base_dir
+        self.fsync = fsync
+
+    def get_path(self, key: ChatKey) -> str:
+        """获取聊天记录文件路径
+
+        Args:
+            key: (消息类型, 会话ID, 角色名称)
+
+        Returns:
+            str: 文件路径
+        """
+        message_type, session_id, character_name = key
+        return os.path.join(
+            self.base_dir,
+            f"{message_type}_chat",
+            f"{message_type}-{session_id}-{character_name}.jsonl"
+        )
+
+    def create(self, key: ChatKey) -> None:
+        filepath = self.get_path(key)
+        if not os.path.exists(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'w', encoding='utf-8'):
+                print(f"创建新聊天记录文件: {filepath}")
+
+    def append(self, key: ChatKey, records: List[Dict[str, Any]]) -> None:
+        # 一次write写入整批记录,避免只写入一部分
+        data = "".join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        filepath = self.get_path(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'a', encoding='utf-8') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_tail(self, key: ChatKey, count: int) -> List[Dict[str, Any]]:
+        filepath = self.get_path(key)
+        if not os.path.exists(filepath):
+            return []
+        return [json.loads(line) for line in read_tail_lines(filepath, count)]
+
+    def clear(self, key: ChatKey) -> None:
+        with open(self.get_path(key), 'w', encoding='utf-8'):
+            pass
+
+    def iter_keys(self) -> Iterator[ChatKey]:
+        for message_type in ("group", "private"):
+            chat_dir = os.path.join(self.base_dir, f"{message_type}_chat")
+            if not os.path.isdir(chat_dir):
+                continue
+            for filename in sorted(os.listdir(chat_dir)):
+                parts = filename[:-len(".jsonl")].split("-", 2)
+                if filename.endswith(".jsonl") and len(parts) == 3 and parts[0] == message_type:
+                    yield parts[0], parts[1], parts[2]
+
+    def iter_records(self, key: ChatKey) -> Iterator[Dict[str, Any]]:
+        with open(self.get_path(key), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def count(self, key: ChatKey) -> int:
+        if not os.path.exists(self.get_path(key)):
+            return 0
+        return super().count(key)
+
+
+class SqliteChatStorage(ChatStorage):
+    """SQLite存储,使用WAL日志,按(消息类型, 会话ID, 角色名称, 序号)建立唯一索引
+
+    同一批记录在一个事务中写入。连接在线程间共享,由锁串行化访问。
+
+    Attributes:
+        db_path (str): 数据库文件路径
+        connection (sqlite3.Connection): 数据库连接
+    """
+
+    def __init__(self, db_path: str, synchronous: str = "NORMAL") -> None:
+        """初始化SQLite存储
+
+        Args:
+            db_path: 数据库文件路径
+            synchronous: PRAGMA synchronous取值,FULL时每次提交都落盘
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={synchronous}")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS chat_messages (
+                message_type TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                character TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                record TEXT NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            """CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_messages_key
+            ON chat_messages (message_type, session_id, character, seq)"""
+        )
+
+    def create(self, key: ChatKey) -> None:
+        # 记录在第一次追加时产生,不需要预先创建
+        pass
+
+    def append(self, key: ChatKey, records: List[Dict[str, Any]]) -> None:
+        self.append_batch({key: records})
+
+    def append_batch(self, batch: Dict[ChatKey, List[Dict[str, Any]]]) -> None:
+        # 整批记录在一个事务中写入
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for key, records in batch.items():
+                    cursor.execute(
+                        """SELECT COALESCE(MAX(seq), 0) FROM chat_messages
+                        WHERE message_type = ? AND session_id = ? AND character = ?""",
+                        key
+                    )
+                    seq = cursor.fetchone()[0]
+                    cursor.executemany(
+                        "INSERT INTO chat_messages VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (*key, seq + index, json.dumps(record, ensure_ascii=False))
+                            for index, record in enumerate(records, 1)
+                        ]
+                    )
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def read_tail(self, key: ChatKey, count: int) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT record FROM chat_messages
+                WHERE message_type = ? AND session_id = ? AND character = ?
+                ORDER BY seq DESC LIMIT ?""",
+                (*key, count)
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def clear(self, key: ChatKey) -> None:
+        with self.lock:
+            self.connection.execute(
+                """DELETE FROM chat_messages
+                WHERE message_type = ? AND session_id = ? AND character = ?""",
+                key
+            )
+
+    def iter_keys(self) -> Iterator[ChatKey]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT message_type, session_id, character FROM chat_messages"
+            ).fetchall()
+        for row in rows:
+            yield row[0], row[1], row[2]
+
+    def iter_records(self, key: ChatKey, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        seq = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    """SELECT seq, record FROM chat_messages
+                    WHERE message_type = ? AND session_id = ? AND character = ? AND seq > ?
+                    ORDER BY seq LIMIT ?""",
+                    (*key, seq, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[1])
+            seq = rows[-1][0]
+
+    def count(self, key: ChatKey) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                """SELECT COUNT(*) FROM chat_messages
+                WHERE message_type = ? AND session_id = ? AND character = ?""",
+                key
+            ).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def create_chat_storage(backend: str, base_dir: str, fsync: bool = False) -> ChatStorage:
+    """根据配置创建聊天记录存储
+
+    Args:
+        backend: 存储类型,jsonl或sqlite
+        base_dir: 聊天记录根目录
+        fsync: 每次写入是否落盘,SQLite对应synchronous=FULL
+
+    Returns:
+        ChatStorage: 聊天记录存储
+
+    Raises:
+        ValueError: 存储类型无效
+    """
+    match backend.lower():
+        case "jsonl":
+            return JsonlChatStorage(base_dir, fsync)
+        case "sqlite":
+            return SqliteChatStorage(
+                os.path.join(base_dir, "chat_history.db"),
+                "FULL" if fsync else "NORMAL"
+            )
+        case _:
+            raise ValueError(f"无效的聊天记录存储类型: {backend}")
+
+
+def migrate_chat_storage(source: ChatStorage, target: ChatStorage, batch_size: int = 1000) -> Dict[str, int]:
+    """将聊天记录从source逐批复制到target
+
+    逐条读取源记录,每batch_size条写入一次,内存占用与记录总数无关。
+    目标中已有部分记录的会话(例如上次迁移中途退出)从第一条缺少的记录继续迁移,
+    已完整迁移的会话被跳过,重复执行不会产生重复记录。
+    目标中的记录比源记录多,或最后一条与源记录中对应位置的记录不同时,
+    视为冲突,不修改该会话并打印其键。
+
+    Args:
+        source: 源存储
+        target: 目标存储
+        batch_size: 每批写入的记录数
+
+    Returns:
+        Dict[str, int]: 迁移的会话数、记录数,继续迁移的部分会话数、跳过的会话数和冲突的会话数
+    """
+    result = {"sessions": 0, "records": 0, "resumed": 0, "skipped": 0, "conflicts": 0}
+    for key in source.iter_keys():
+        existing = target.count(key)
+        records = source.iter_records(key)
+        if existing:
+            # 源记录的前existing条应已在目标中,比较其中最后一条
+            migrated = list(islice(records, existing - 1, existing))
+            if not migrated or migrated[0] != target.read_tail(key, 1)[0]:
+                print(f"聊天记录{key}的目标记录与源记录不一致,未迁移")
+                result["conflicts"] += 1
+                continue
+        copied = 0
+        batch: List[Dict[str, Any]] = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                target.append(key, batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            target.append(key, batch)
+            copied += len(batch)
+        result["records"] += copied
+        if not existing:
+            result["sessions"] += 1
+        elif copied:
+            print(f"聊天记录{key}已有{existing}条在目标中,继续迁移{copied}条")
+            result["resumed"] += 1
+        else:
+            result["skipped"] += 1
+    return result
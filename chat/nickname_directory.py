@@ -0,0 +1,212 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from nonebot.adapters.onebot.v11 import Bot
+
+DEFAULT_NICKNAME = "未知昵称"
+
+
+class NicknameEntry:
+    """昵称目录条目
+
+    Attributes:
+        name (str): 显示名称,群聊中优先为群名片
+        expire_time (float): 过期时间(time.monotonic())
+        negative (bool): 是否为查询失败的缓存
+    """
+
+    __slots__ = ("name", "expire_time", "negative")
+
+    def __init__(self, name: str, expire_time: float, negative: bool = False) -> None:
+        """初始化条目
+
+        Args:
+            name: 显示名称
+            expire_time: 过期时间
+            negative: 是否为查询失败的缓存
+        """
+        self.name = name
+        self.expire_time = expire_time
+        self.negative = negative
+
+
+class NicknameDirectory:
+    """用户昵称目录,缓存群名片和昵称,避免每条消息都调用OneBot接口
+
+    名称优先取自事件自带的发送者信息;首次见到某个群时在后台通过
+    get_group_member_list批量预取群成员;条目过期后先返回旧名称,
+    再在后台刷新。查询失败的用户在negative_ttl内不再查询,之后再次使用时重新查询。
+
+    Attributes:
+        ttl (float): 名称缓存秒数
+        negative_ttl (float): 查询失败缓存秒数
+        entries (Dict[Tuple[str, str], NicknameEntry]): (群号, 用户ID)到条目的映射,私聊群号为空
+        prefetched_groups (Set[str]): 已预取过成员的群号
+    """
+
+    def __init__(self, ttl: float = 3600.0, negative_ttl: float = 300.0) -> None:
+        """初始化昵称目录
+
+        Args:
+            ttl: 名称缓存秒数
+            negative_ttl: 查询失败缓存秒数
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: Dict[Tuple[str, str], NicknameEntry] = {}
+        self.prefetched_groups: Set[str] = set()
+        self.refreshing: Set[Tuple[str, str]] = set()
+        self.background_tasks: Set[asyncio.Task] = set()
+
+    def seed(self, group_id: str, user_id: str, card: Optional[str], nickname: Optional[str]) -> Optional[str]:
+        """用已知的群名片和昵称更新目录
+
+        Args:
+            group_id: 群号,私聊为空字符串
+            user_id: 用户ID
+            card: 群名片
+            nickname: 昵称
+
+        Returns:
+            Optional[str]: 写入的名称,两者都为空时返回None
+        """
+        name = (card if group_id else None) or nickname
+        if not name:
+            return None
+        self.entries[(group_id, user_id)] = NicknameEntry(name, time.monotonic() + self.ttl)
+        return name
+
+    async def get_nick_name(
+        self,
+        bot: Bot,
+        user_id: str,
+        group_id: Optional[str] = None,
+        sender: Any = None
+    ) -> str:
+        """获取用户在群聊或私聊中显示的名称
+
+        Args:
+            bot: Bot实例
+            user_id: 用户ID
+            group_id: 群号,私聊时为None
+            sender: 事件中的发送者信息,包含nickname和群聊中的card
+
+        Returns:
+            str: 显示名称,无法获取时为"未知昵称"
+        """
+        group_id = group_id or ""
+        if group_id and group_id not in self.prefetched_groups:
+            self.prefetched_groups.add(group_id)
+            self._run_in_background(self.prefetch_group(bot, group_id))
+
+        if sender is not None:
+            name = self.seed(
+                group_id,
+                user_id,
+                getattr(sender, "card", None),
+                getattr(sender, "nickname", None)
+            )
+            if name:
+                return name
+
+        key = (group_id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expired = entry.expire_time <= time.monotonic()
+            if entry.negative:
+                # 失败缓存过期后按未命中处理,重新查询
+                return await self._fetch(bot, key) if expired else DEFAULT_NICKNAME
+            if expired and key not in self.refreshing:
+                self.refreshing.add(key)
+                self._run_in_background(self._refresh(bot, key))
+            return entry.name
+        return await self._fetch(bot, key)
+
+    async def prefetch_group(self, bot: Bot, group_id: str) -> None:
+        """批量预取群成员的群名片和昵称
+
+        Args:
+            bot: Bot实例
+            group_id: 群号
+        """
+        try:
+            members = await bot.call_api("get_group_member_list", group_id=int(group_id))
+        except Exception as e:
+            print(f"预取群成员列表失败({group_id}): {e}")
+            return
+        for member in members or []:
+            self.seed(group_id, str(member.get("user_id", "")), member.get("card"), member.get("nickname"))
+
+    async def _fetch(self, bot: Bot, key: Tuple[str, str]) -> str:
+        """查询单个用户的名称并写入目录,失败时写入失败缓存
+
+        Args:
+            bot: Bot实例
+            key: (群号, 用户ID)
+
+        Returns:
+            str: 显示名称
+        """
+        group_id, user_id = key
+        try:
+            if group_id:
+                info = await bot.call_api(
+                    "get_group_member_info",
+                    group_id=int(group_id),
+                    user_id=int(user_id)
+                )
+            else:
+                info = await bot.call_api("get_stranger_info", user_id=int(user_id))
+        except Exception as e:
+            print(f"获取用户昵称失败({user_id}): {e}")
+            info = None
+
+        name = self.seed(group_id, user_id, (info or {}).get("card"), (info or {}).get("nickname"))
+        if name:
+            return name
+        entry = self.entries.get(key)
+        if entry is not None and not entry.negative:
+            # 查询失败时继续使用旧名称
+            entry.expire_time = time.monotonic() + self.negative_ttl
+            return entry.name
+        self.entries[key] = NicknameEntry(DEFAULT_NICKNAME, time.monotonic() + self.negative_ttl, True)
+        return DEFAULT_NICKNAME
+
+    async def _refresh(self, bot: Bot, key: Tuple[str, str]) -> None:
+        """在后台刷新过期条目
+
+        Args:
+            bot: Bot实例
+            key: (群号, 用户ID)
+        """
+        try:
+            await self._fetch(bot, key)
+        finally:
+            self.refreshing.discard(key)
+
+    def _run_in_background(self, coroutine: Any) -> None:
+        """在后台运行协程并保留任务引用
+
+        Args:
+            coroutine: 协程对象
+        """
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def invalidate(self, user_id: Optional[str] = None, group_id: Optional[str] = None) -> None:
+        """删除缓存的名称
+
+        Args:
+            user_id: 只删除该用户的条目,为None时不限用户
+            group_id: 只删除该群的条目,为None时不限群
+        """
+        for key in list(self.entries):
+            if (group_id is None or key[0] == group_id) and (user_id is None or key[1] == user_id):
+                del self.entries[key]
+        if user_id is None:
+            if group_id is None:
+                self.prefetched_groups.clear()
+            else:
+                self.prefetched_groups.discard(group_id)
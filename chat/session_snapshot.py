@@ -0,0 +1,357 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgpack
+
+from .chat_session import ChatSession
+from .nickname_directory import NicknameDirectory, NicknameEntry
+
+# 快照格式版本,格式不兼容时递增,旧版本的快照被忽略
+SNAPSHOT_VERSION = 1
+
+SessionKey = Tuple[str, str]
+
+
+class SessionRecord:
+    """快照中的单个会话
+
+    只保存无法从配置文件重新得到的会话状态;角色卡、预设和正则规则在恢复时
+    按当前的配置重新取得,因此快照过时也不会恢复出与配置不一致的会话。
+
+    Attributes:
+        message_type (str): 消息类型
+        session_id (str): 会话ID
+        character_name (str): 保存时的角色名称,与当前角色不同时不恢复会话变量
+        preset_name (str): 保存时的预设名称
+        user_id (str): 最后发言的用户ID
+        nick_name (str): 最后发言的用户昵称
+        variables (Dict[str, Any]): 会话变量
+        last_access (float): 最后访问时间(time.time())
+    """
+
+    __slots__ = (
+        "message_type", "session_id", "character_name", "preset_name",
+        "user_id", "nick_name", "variables", "last_access"
+    )
+
+    def __init__(
+        self,
+        message_type: str,
+        session_id: str,
+        character_name: str,
+        preset_name: str = "",
+        user_id: str = "",
+        nick_name: str = "",
+        variables: Optional[Dict[str, Any]] = None,
+        last_access: float = 0.0
+    ) -> None:
+        """初始化会话记录
+
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            character_name: 角色名称
+            preset_name: 预设名称
+            user_id: 用户ID
+            nick_name: 用户昵称
+            variables: 会话变量
+            last_access: 最后访问时间(time.time())
+        """
+        self.message_type = message_type
+        self.session_id = session_id
+        self.character_name = character_name
+        self.preset_name = preset_name
+        self.user_id = user_id
+        self.nick_name = nick_name
+        self.variables = variables or {}
+        self.last_access = last_access
+
+    @classmethod
+    def from_session(cls, message_type: str, session: ChatSession, last_access: float) -> "SessionRecord":
+        """从内存中的会话生成记录
+
+        Args:
+            message_type: 消息类型
+            session: 会话对象
+            last_access: 最后访问时间(time.time())
+
+        Returns:
+            SessionRecord: 会话记录,会话变量为浅拷贝
+        """
+        return cls(
+            message_type,
+            session.get_session_id(),
+            session.get_character_name(),
+            session.preset_name,
+            session.get_user_id(),
+            session.get_nick_name(),
+            dict(session.variables),
+            last_access
+        )
+
+    def to_list(self) -> List[Any]:
+        """转换为快照中保存的列表
+
+        Returns:
+            List[Any]: 按__slots__顺序排列的字段
+        """
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values: List[Any]) -> "SessionRecord":
+        """从快照中的列表恢复记录
+
+        Args:
+            values: to_list的结果
+
+        Returns:
+            SessionRecord: 会话记录
+
+        Raises:
+            ValueError: 字段数量或类型不正确
+        """
+        if not isinstance(values, (list, tuple)) or len(values) != len(cls.__slots__):
+            raise ValueError("会话记录字段数量不正确")
+        record = cls(*values)
+        if not isinstance(record.variables, dict):
+            raise ValueError("会话变量格式不正确")
+        return record
+
+
+class SessionSnapshot:
+    """会话状态快照,定期写入msgpack文件,重启后用于预热和恢复会话
+
+    快照中保存每个会话的角色、预设、最后发言的用户和昵称、会话变量,
+    以及昵称目录中查询成功的条目。被移出内存的会话保留其记录,
+    再次建立会话时仍可恢复会话变量;记录数超过max_records时丢弃最久未访问的记录。
+    内容没有变化时不写文件,写入先写临时文件再替换,写入中途退出不会损坏已有快照。
+
+    Attributes:
+        path (str): 快照文件路径
+        interval (float): 定期写入的间隔秒数,为0时不使用快照
+        max_records (int): 保留的最大会话记录数
+        records (OrderedDict[SessionKey, SessionRecord]): (消息类型, 会话ID)到记录的映射,按记录时间从旧到新排列
+        nicknames (List[List[Any]]): 载入的昵称条目[群号, 用户ID, 名称, 过期时间(time.time())]
+        last_data (Optional[bytes]): 上次写入或载入的快照内容
+        task (Optional[asyncio.Task]): 定期写入任务
+    """
+
+    def __init__(self, path: str, interval: float = 60.0, max_records: int = 5000) -> None:
+        """初始化快照
+
+        Args:
+            path: 快照文件路径
+            interval: 定期写入的间隔秒数,为0时不使用快照
+            max_records: 保留的最大会话记录数
+        """
+        self.path = path
+        self.interval = interval
+        self.max_records = max_records
+        self.records: "OrderedDict[SessionKey, SessionRecord]" = OrderedDict()
+        self.nicknames: List[List[Any]] = []
+        self.last_data: Optional[bytes] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def load(self) -> int:
+        """从文件载入快照,文件不存在或格式不正确时从空快照开始
+
+        Returns:
+            int: 载入的会话记录数,不使用快照时为0
+        """
+        if self.interval <= 0:
+            return 0
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            print(f"读取会话快照失败: {e}")
+            return 0
+        try:
+            payload = msgpack.unpackb(data, raw=False, strict_map_key=False)
+            if not isinstance(payload, dict) or payload.get("version") != SNAPSHOT_VERSION:
+                print("会话快照版本不匹配,已忽略")
+                return 0
+            records = [SessionRecord.from_list(values) for values in payload.get("sessions") or []]
+            nicknames = [list(values) for values in payload.get("nicknames") or [] if len(values) == 4]
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            print(f"会话快照格式错误,已忽略: {e}")
+            return 0
+        records.sort(key=lambda record: record.last_access)
+        self.records = OrderedDict(
+            ((record.message_type, record.session_id), record) for record in records
+        )
+        self.nicknames = nicknames
+        self.last_data = data
+        return len(self.records)
+
+    def get_record(self, message_type: str, session_id: str) -> Optional[SessionRecord]:
+        """获取会话的记录
+
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+
+        Returns:
+            Optional[SessionRecord]: 会话记录,不存在时为None
+        """
+        return self.records.get((message_type, session_id))
+
+    def recent_records(self, limit: int = 0, max_age: float = 0.0) -> List[SessionRecord]:
+        """按最后访问时间从新到旧获取会话记录
+
+        Args:
+            limit: 最多返回的记录数,为0时不限制
+            max_age: 只返回max_age秒内访问过的记录,为0时不限制
+
+        Returns:
+            List[SessionRecord]: 会话记录
+        """
+        now = time.time()
+        records = sorted(self.records.values(), key=lambda record: record.last_access, reverse=True)
+        if max_age > 0:
+            records = [record for record in records if now - record.last_access < max_age]
+        return records[:limit] if limit > 0 else records
+
+    def remember(self, message_type: str, session: ChatSession, last_access: Optional[float] = None) -> None:
+        """记录会话的当前状态,用于会话被移出内存时保留其状态
+
+        Args:
+            message_type: 消息类型
+            session: 会话对象
+            last_access: 最后访问时间(time.time()),为None时沿用上次记录的时间,没有记录时使用当前时间
+        """
+        key = (message_type, session.get_session_id())
+        if last_access is None:
+            previous = self.records.get(key)
+            last_access = previous.last_access if previous is not None else time.time()
+        self.records[key] = SessionRecord.from_session(message_type, session, last_access)
+        self.records.move_to_end(key)
+        while len(self.records) > self.max_records:
+            self.records.popitem(last=False)
+
+    def restore_nicknames(self, directory: NicknameDirectory) -> int:
+        """将快照中的昵称写入昵称目录,不覆盖目录中已有的条目
+
+        已过期的条目同样写入,使用时先返回旧名称再在后台刷新,不会阻塞首条回复。
+
+        Args:
+            directory: 昵称目录
+
+        Returns:
+            int: 写入的条目数
+        """
+        offset = time.monotonic() - time.time()
+        restored = 0
+        for group_id, user_id, name, expire_time in self.nicknames:
+            key = (str(group_id), str(user_id))
+            if not name or key in directory.entries:
+                continue
+            directory.entries[key] = NicknameEntry(str(name), float(expire_time) + offset)
+            restored += 1
+        self.nicknames = []
+        return restored
+
+    def capture(self, manager: Any) -> bytes:
+        """将会话管理器中的会话和昵称目录编码为快照
+
+        Args:
+            manager: 会话管理器(ChatSessionManager)
+
+        Returns:
+            bytes: msgpack编码的快照
+        """
+        offset = time.time() - time.monotonic()
+        for (message_type, session_id), last_access in manager.session_keys.items():
+            session = manager.peek_session(message_type, session_id)
+            if session is not None:
+                self.remember(message_type, session, last_access + offset)
+        nicknames = [
+            [group_id, user_id, entry.name, entry.expire_time + offset]
+            for (group_id, user_id), entry in manager.nickname_directory.entries.items()
+            if not entry.negative
+        ]
+        return msgpack.packb(
+            {
+                "version": SNAPSHOT_VERSION,
+                "sessions": [record.to_list() for record in self.records.values()],
+                "nicknames": nicknames
+            },
+            use_bin_type=True,
+            default=str
+        )
+
+    def write(self, data: bytes) -> bool:
+        """写入快照文件,内容与上次相同时跳过
+
+        Args:
+            data: capture的结果
+
+        Returns:
+            bool: 是否写入了文件
+        """
+        if data == self.last_data:
+            return False
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        self.last_data = data
+        return True
+
+    async def save(self, manager: Any) -> bool:
+        """编码并在线程中写入快照
+
+        Args:
+            manager: 会话管理器(ChatSessionManager)
+
+        Returns:
+            bool: 是否写入了文件
+        """
+        data = self.capture(manager)
+        try:
+            return await asyncio.to_thread(self.write, data)
+        except OSError as e:
+            print(f"写入会话快照失败: {e}")
+            return False
+
+    def start(self, manager: Any) -> None:
+        """启动定期写入任务,不使用快照时不启动
+
+        Args:
+            manager: 会话管理器(ChatSessionManager)
+        """
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self._run(manager))
+
+    async def _run(self, manager: Any) -> None:
+        """定期写入快照
+
+        Args:
+            manager: 会话管理器(ChatSessionManager)
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save(manager)
+
+    async def close(self, manager: Any) -> None:
+        """停止定期写入任务并写入最后一次快照
+
+        Args:
+            manager: 会话管理器(ChatSessionManager)
+        """
+        if self.interval <= 0:
+            return
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.save(manager)
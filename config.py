@@ -3,3 +3,32 @@ from pydantic import BaseModel
 
 class Config(BaseModel):
     """Plugin Config Here"""
+
+    # 聊天记录存储: jsonl(每个会话一个文件)或sqlite(data/chat_data/chat_history.db)
+    qilian_history_backend: str = "jsonl"
+    # 每个会话在内存中保留的最近聊天记录数
+    qilian_history_buffer_size: int = 200
+    # 聊天记录后台写入间隔秒数,为0时每次回复后立即写入
+    qilian_history_flush_interval: float = 1.0
+    # 每批写入聊天记录后是否落盘(JSONL调用fsync,SQLite使用synchronous=FULL)
+    qilian_history_fsync: bool = False
+    # 会话正在回复时收到新消息的处理方式: queue(排队)、merge(合并为下一轮)或drop(丢弃)
+    qilian_session_busy_policy: str = "queue"
+    # 用户昵称缓存秒数,过期后先使用旧昵称再在后台刷新
+    qilian_nickname_ttl: float = 3600.0
+    # 昵称查询失败后不再查询的秒数
+    qilian_nickname_negative_ttl: float = 300.0
+    # 内存中保留的最大会话数,超出时移出最久未访问的会话,0表示不限制
+    qilian_session_max: int = 500
+    # 会话空闲多少秒后移出内存,下一条消息到达时重新建立,0表示不过期
+    qilian_session_idle_ttl: float = 21600.0
+    # 会话状态快照(data/session_snapshot.msgpack)的写入间隔秒数,重启后用于恢复会话变量和昵称,为0时不使用快照
+    qilian_session_snapshot_interval: float = 60.0
+    # 启动时按快照在后台预热的最近会话数,为0时不预热,会话在收到消息时再按快照恢复
+    qilian_session_warm_count: int = 50
+    # 每条正则规则的超时秒数,超时的规则跳过不执行,为0时不限制
+    qilian_regex_timeout: float = 0.5
+    # 角色世界书未设置scan_depth时扫描的最近消息数(包括当前消息)
+    qilian_world_info_depth: int = 2
+    # 角色世界书关键词触发条目的token预算,世界书设置了token_budget时以其为准,为0时不限制
+    qilian_world_info_budget: int = 2048
@@ -0,0 +1,581 @@
+import random
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import regex
+
+# 宏的开始和结束标记,连续的"{"中只有最后两个作为开始标记
+_TOKEN = regex.compile(r"\{\{(?!\{)|\}\}")
+# {{trim}}删除自身和两侧的换行,在编译时处理
+_TRIM = regex.compile(r"(?:\r?\n)*\{\{trim\}\}(?:\r?\n)*", regex.I)
+_ROLL = regex.compile(r"^\s*(\d*)\s*d?\s*(\d+)\s*(?:([+-])\s*(\d+))?\s*$", regex.I)
+_TIME_UTC = regex.compile(r"^time_utc([+-]\d{1,2})$", regex.I)
+_NUMBER = regex.compile(r"^\s*-?\d+(?:\.\d+)?\s*$")
+_WEEKDAYS = ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日")
+_DATE_FORMAT = "%Y-%m-%d@%H:%M:%S"
+
+
+class MacroContext:
+    """渲染宏时使用的数据,每轮构造一次
+
+    Attributes:
+        user (str): 用户昵称
+        char (str): 角色名称
+        character (Any): 角色对象,用于{{description}}等角色卡字段
+        input (str): 当前消息
+        history (Sequence[Dict[str, Any]]): 聊天记录,包括当前消息,按时间从旧到新排列
+        variables (Dict[str, Any]): 会话变量
+        global_variables (Dict[str, Any]): 全局变量
+        now (datetime): 本轮的当前时间,同一轮中所有时间宏一致
+        seed (str): {{pick}}的随机种子,同一会话中结果固定
+        volatile (bool): 是否渲染过结果不只取决于用户昵称、角色名称和角色卡的宏
+    """
+
+    __slots__ = (
+        "user", "char", "character", "input", "history", "variables", "global_variables", "now", "seed", "volatile"
+    )
+
+    def __init__(
+        self,
+        user: str,
+        char: str,
+        character: Any = None,
+        input: str = "",
+        history: Sequence[Dict[str, Any]] = (),
+        variables: Optional[Dict[str, Any]] = None,
+        global_variables: Optional[Dict[str, Any]] = None,
+        now: Optional[datetime] = None,
+        seed: str = ""
+    ) -> None:
+        """初始化宏上下文
+
+        Args:
+            user: 用户昵称
+            char: 角色名称
+            character: 角色对象
+            input: 当前消息
+            history: 聊天记录,包括当前消息
+            variables: 会话变量
+            global_variables: 全局变量
+            now: 当前时间,默认为构造时的时间
+            seed: {{pick}}的随机种子
+        """
+        self.user = user
+        self.char = char
+        self.character = character
+        self.input = input
+        self.history = history
+        self.variables = {} if variables is None else variables
+        self.global_variables = {} if global_variables is None else global_variables
+        self.now = now or datetime.now()
+        self.seed = seed
+        self.volatile = False
+
+
+class Macro:
+    """模板中的一个宏
+
+    宏内容不包含嵌套的宏时,名称、参数和处理函数在编译时解析,无法识别的宏在编译时就作为文本保留;
+    否则每次渲染时先渲染内层的宏,再解析外层。
+
+    Attributes:
+        body (str): 宏内容,包含嵌套的宏时为空字符串
+        content (Optional[MacroTemplate]): 包含嵌套宏的宏内容
+        name (str): 宏名称(小写)
+        args (Tuple[str, ...]): 参数
+        handler (Optional[Callable]): 宏处理函数,无法识别时为None
+        stable (bool): 结果是否只取决于用户昵称、角色名称和角色卡
+    """
+
+    __slots__ = ("body", "content", "name", "args", "handler", "stable")
+
+    def __init__(self, segments: List[Union[str, "Macro"]]) -> None:
+        """初始化宏
+
+        Args:
+            segments: 宏内容的片段
+        """
+        if all(isinstance(segment, str) for segment in segments):
+            self.body = "".join(segments)
+            self.content = None
+            self.name, self.args = _split_macro(self.body)
+            self.handler = _get_handler(self.name)
+            self.stable = self.name in _STABLE_MACROS
+        else:
+            self.body = ""
+            self.content = MacroTemplate(segments)
+            self.name, self.args = "", ()
+            self.handler = None
+            self.stable = False
+
+    def render(self, context: MacroContext) -> str:
+        """渲染宏,无法识别的宏保留原文
+
+        Args:
+            context: 宏上下文
+
+        Returns:
+            str: 渲染结果
+        """
+        if self.content is None:
+            body, args, handler = self.body, self.args, self.handler
+        else:
+            body = self.content.render(context)
+            name, args = _split_macro(body)
+            handler = _get_handler(name)
+            if handler is None:
+                return "{{" + body + "}}"
+        value = handler(context, args, body)
+        return "{{" + body + "}}" if value is None else value
+
+
+class MacroTemplate:
+    """编译后的模板
+
+    文本片段和宏编译为片段列表,渲染时先计算各个宏的值填入对应位置,再一次拼接。
+    结果只取决于用户昵称、角色名称和角色卡的相同宏共用一个值,例如所有{{user}}只计算一次;
+    {{random}}等其他的宏每次出现都单独计算。
+    只包含这类宏的模板会记住最近一次的渲染结果,用户昵称、角色名称和角色对象都不变时直接返回。
+
+    Attributes:
+        static (Optional[str]): 不包含宏时的文本
+        parts (List[str]): 片段列表,宏的位置为空字符串
+        slots (Tuple[Tuple[int, int], ...]): (片段位置, 宏序号)
+        macros (Tuple[Macro, ...]): 需要计算的宏
+        stable (bool): 渲染结果是否只取决于用户昵称、角色名称和角色卡
+        memo_key (Optional[Tuple[str, str, Any]]): 最近一次渲染的(用户昵称, 角色名称, 角色对象)
+        memo (str): 最近一次的渲染结果
+    """
+
+    __slots__ = ("static", "parts", "slots", "macros", "stable", "memo_key", "memo")
+
+    def __init__(self, segments: List[Union[str, Macro]]) -> None:
+        """初始化模板
+
+        Args:
+            segments: 文本片段和宏
+        """
+        self.parts: List[str] = []
+        slots: List[Tuple[int, int]] = []
+        macros: List[Macro] = []
+        shared: Dict[str, int] = {}
+        # 上一个片段是否为文本,相邻的文本合并为一个片段
+        literal = False
+        for segment in segments:
+            if isinstance(segment, str):
+                if not segment:
+                    continue
+                if literal:
+                    self.parts[-1] += segment
+                else:
+                    self.parts.append(segment)
+                    literal = True
+                continue
+            literal = False
+            if segment.stable and segment.body in shared:
+                index = shared[segment.body]
+            else:
+                index = len(macros)
+                macros.append(segment)
+                if segment.stable:
+                    shared[segment.body] = index
+            slots.append((len(self.parts), index))
+            self.parts.append("")
+        self.slots = tuple(slots)
+        self.macros = tuple(macros)
+        self.static = "".join(self.parts) if not macros else None
+        self.stable = all(macro.stable for macro in macros)
+        self.memo_key = None
+        self.memo = ""
+
+    def render(self, context: MacroContext) -> str:
+        """渲染模板
+
+        Args:
+            context: 宏上下文
+
+        Returns:
+            str: 渲染结果
+        """
+        if self.static is not None:
+            return self.static
+        if self.stable:
+            key = (context.user, context.char, context.character)
+            if key == self.memo_key:
+                return self.memo
+        else:
+            context.volatile = True
+        values = [macro.render(context) for macro in self.macros]
+        parts = self.parts.copy()
+        for position, index in self.slots:
+            parts[position] = values[index]
+        result = "".join(parts)
+        if self.stable:
+            self.memo_key, self.memo = key, result
+        return result
+
+
+class MacroEngine:
+    """SillyTavern宏引擎
+
+    每段文本只编译一次,编译结果按原文缓存;渲染时不再扫描文本,只拼接片段和宏的值。
+    支持的宏包括{{user}}、{{char}}、角色卡字段、{{input}}、{{lastMessage}}等聊天记录宏、
+    {{time}}/{{date}}等时间宏、{{random}}、{{pick}}、{{roll}}、会话变量和全局变量、
+    {{newline}}、{{trim}}、{{noop}}和{{// 注释}}。宏可以嵌套,内层先渲染。
+
+    Attributes:
+        templates (OrderedDict[str, MacroTemplate]): 原文到编译结果的缓存
+        cache_size (int): 缓存的最大条目数
+        global_variables (Dict[str, Any]): 全局变量
+    """
+
+    def __init__(self, cache_size: int = 4096) -> None:
+        """初始化宏引擎
+
+        Args:
+            cache_size: 编译结果缓存的最大条目数
+        """
+        self.templates: "OrderedDict[str, MacroTemplate]" = OrderedDict()
+        self.cache_size = cache_size
+        self.global_variables: Dict[str, Any] = {}
+
+    def compile(self, text: str) -> MacroTemplate:
+        """编译文本,结果按原文缓存
+
+        Args:
+            text: 模板文本
+
+        Returns:
+            MacroTemplate: 编译后的模板
+        """
+        template = self.templates.get(text)
+        if template is not None:
+            self.templates.move_to_end(text)
+            return template
+        template = self.templates[text] = compile_template(text)
+        if len(self.templates) > self.cache_size:
+            self.templates.popitem(last=False)
+        return template
+
+    def render(self, text: str, context: MacroContext) -> str:
+        """渲染文本中的宏
+
+        Args:
+            text: 模板文本
+            context: 宏上下文
+
+        Returns:
+            str: 渲染结果
+        """
+        return self.compile(text).render(context)
+
+
+def compile_template(text: str) -> MacroTemplate:
+    """将文本编译为模板
+
+    Args:
+        text: 模板文本
+
+    Returns:
+        MacroTemplate: 编译后的模板,没有配对的"{{"按原文保留
+    """
+    if "{{" not in text:
+        return MacroTemplate([text])
+    text = _TRIM.sub("", text)
+    stack: List[List[Union[str, Macro]]] = [[]]
+    position = 0
+    for token in _TOKEN.finditer(text):
+        if token.group() == "{{":
+            stack[-1].append(text[position:token.start()])
+            stack.append([])
+        elif len(stack) > 1:
+            stack[-1].append(text[position:token.start()])
+            macro = Macro(stack.pop())
+            stack[-1].append("{{" + macro.body + "}}" if macro.handler is None and macro.content is None else macro)
+        else:
+            continue
+        position = token.end()
+    stack[-1].append(text[position:])
+    while len(stack) > 1:
+        segments = stack.pop()
+        stack[-1].append("{{")
+        stack[-1].extend(segments)
+    return MacroTemplate(stack[0])
+
+
+def _get_handler(name: str) -> Optional[Callable[[MacroContext, Tuple[str, ...], str], Optional[str]]]:
+    """获取宏的处理函数
+
+    Args:
+        name: 小写的宏名称
+
+    Returns:
+        Optional[Callable]: 处理函数,无法识别的宏为None
+    """
+    handler = _MACROS.get(name)
+    if handler is not None:
+        return handler
+    match = _TIME_UTC.match(name)
+    if match is None:
+        return None
+    offset = timedelta(hours=int(match.group(1)))
+    # 与其他时间宏使用同一个本轮时间,不带时区的时间按本地时间换算为UTC
+    return _no_args(lambda context: (context.now.astimezone(timezone.utc) + offset).strftime("%H:%M"))
+
+
+def _split_macro(body: str) -> Tuple[str, Tuple[str, ...]]:
+    """解析宏的名称和参数
+
+    支持name::arg1::arg2和name:arg两种写法。
+
+    Args:
+        body: 宏内容
+
+    Returns:
+        Tuple[str, Tuple[str, ...]]: (小写名称, 参数)
+    """
+    if body.startswith("//"):
+        return "//", ()
+    name, separator, rest = body.partition(":")
+    name = name.lower()
+    if not separator:
+        return name, ()
+    if rest.startswith(":"):
+        return name, tuple(rest[1:].split("::"))
+    # 单冒号写法,{{random:a,b}}按逗号分隔
+    return name, (rest,) if name not in ("random", "pick") else tuple(rest.split(","))
+
+
+def _history_message(context: MacroContext, is_user: Optional[bool]) -> str:
+    """获取最后一条符合条件的聊天记录内容
+
+    Args:
+        context: 宏上下文
+        is_user: 只查找用户(True)或角色(False)的消息,为None时不限
+
+    Returns:
+        str: 消息内容,没有时为空字符串
+    """
+    for message in reversed(context.history):
+        if is_user is None or bool(message.get("is_user")) == is_user:
+            return str(message.get("msg", ""))
+    return ""
+
+
+def _idle_duration(context: MacroContext) -> str:
+    """计算距离上一条用户消息的时间,当前消息除外
+
+    Args:
+        context: 宏上下文
+
+    Returns:
+        str: 类似"5 分钟"的时长,没有记录时为"刚刚"
+    """
+    for message in reversed(context.history[:-1] if context.input else context.history):
+        if message.get("is_user") and message.get("create_date"):
+            try:
+                seconds = (context.now - datetime.strptime(message["create_date"], _DATE_FORMAT)).total_seconds()
+            except ValueError:
+                continue
+            break
+    else:
+        return "刚刚"
+    minutes, hours, days = seconds / 60, seconds / 3600, seconds / 86400
+    # 四舍五入,0.5向上取整
+    round = lambda value: int(value + 0.5)
+    if seconds < 45:
+        return "几秒"
+    if seconds < 90:
+        return "1 分钟"
+    if minutes < 45:
+        return f"{round(minutes)} 分钟"
+    if minutes < 90:
+        return "1 小时"
+    if hours < 22:
+        return f"{round(hours)} 小时"
+    if hours < 36:
+        return "1 天"
+    if days < 26:
+        return f"{round(days)} 天"
+    if days < 45:
+        return "1 个月"
+    if days < 320:
+        return f"{round(days / 30)} 个月"
+    return f"{max(round(days / 365), 1)} 年"
+
+
+def _roll(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+    """{{roll:XdY+Z}}掷骰,只写Y时掷1dY"""
+    match = _ROLL.match(args[0]) if len(args) == 1 else None
+    if match is None:
+        return None
+    count, sides = int(match.group(1) or 1), int(match.group(2))
+    if not 0 < count <= 1000 or sides <= 0:
+        return None
+    total = sum(random.randint(1, sides) for _ in range(count))
+    if match.group(3):
+        total += int(match.group(4)) * (1 if match.group(3) == "+" else -1)
+    return str(total)
+
+
+def _to_number(value: Any) -> Optional[float]:
+    """将变量值转换为数字
+
+    Args:
+        value: 变量值
+
+    Returns:
+        Optional[float]: 数字,不是数字时为None
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and _NUMBER.match(value):
+        return float(value)
+    return None
+
+
+def _format_number(value: float) -> str:
+    """格式化数字,整数不带小数点
+
+    Args:
+        value: 数字
+
+    Returns:
+        str: 文本
+    """
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def _variable_macros(scope: Callable[[MacroContext], Dict[str, Any]]) -> Dict[str, Callable[..., Optional[str]]]:
+    """生成某一作用域的变量宏
+
+    Args:
+        scope: 从上下文中获取变量字典的函数
+
+    Returns:
+        Dict[str, Callable[..., Optional[str]]]: set/get/add/inc/dec宏的处理函数
+    """
+
+    def set_variable(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+        if len(args) < 2:
+            return None
+        scope(context)[args[0].strip()] = "::".join(args[1:])
+        return ""
+
+    def get_variable(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+        if len(args) != 1:
+            return None
+        value = scope(context).get(args[0].strip(), "")
+        return _format_number(value) if isinstance(value, float) else str(value)
+
+    def add_variable(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+        if len(args) < 2:
+            return None
+        variables = scope(context)
+        name, value = args[0].strip(), "::".join(args[1:])
+        current, increment = _to_number(variables.get(name, 0)), _to_number(value)
+        if current is not None and increment is not None:
+            variables[name] = _format_number(current + increment)
+        else:
+            variables[name] = str(variables.get(name, "")) + value
+        return ""
+
+    def step_variable(step: int) -> Callable[..., Optional[str]]:
+        def handler(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+            if len(args) != 1:
+                return None
+            variables = scope(context)
+            name = args[0].strip()
+            value = _format_number((_to_number(variables.get(name, 0)) or 0.0) + step)
+            variables[name] = value
+            return value
+        return handler
+
+    return {
+        "set": set_variable,
+        "get": get_variable,
+        "add": add_variable,
+        "inc": step_variable(1),
+        "dec": step_variable(-1)
+    }
+
+
+def _character_field(getter: str) -> Callable[..., Optional[str]]:
+    """生成读取角色卡字段的宏
+
+    Args:
+        getter: 角色对象的方法名
+
+    Returns:
+        Callable[..., Optional[str]]: 宏处理函数
+    """
+
+    def handler(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+        if args or context.character is None:
+            return None
+        value = getattr(context.character, getter)()
+        return value if isinstance(value, str) else "\n".join(value)
+
+    return handler
+
+
+def _no_args(function: Callable[[MacroContext], str]) -> Callable[..., Optional[str]]:
+    """包装不接受参数的宏,带参数时视为无法识别
+
+    Args:
+        function: 从上下文计算宏值的函数
+
+    Returns:
+        Callable[..., Optional[str]]: 宏处理函数
+    """
+    return lambda context, args, body: None if args else function(context)
+
+
+def _random(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+    """{{random::a::b}}每次渲染随机选择一项"""
+    return random.choice(args).strip() if args else None
+
+
+def _pick(context: MacroContext, args: Tuple[str, ...], body: str) -> Optional[str]:
+    """{{pick::a::b}}随机选择一项,同一会话中相同的宏结果固定"""
+    return random.Random(f"{context.seed}\0{body}").choice(args).strip() if args else None
+
+
+# 结果只取决于用户昵称、角色名称和角色卡的宏
+_STABLE_MACROS = frozenset((
+    "user", "char", "description", "personality", "scenario", "mesexamples", "persona",
+    "newline", "trim", "noop", "//"
+))
+_MACROS: Dict[str, Callable[[MacroContext, Tuple[str, ...], str], Optional[str]]] = {
+    "user": _no_args(lambda context: context.user),
+    "char": _no_args(lambda context: context.char),
+    "description": _character_field("get_description"),
+    "personality": _character_field("get_personality"),
+    "scenario": _character_field("get_scenario"),
+    "mesexamples": _character_field("get_mes_example"),
+    "persona": _no_args(lambda context: ""),
+    "input": _no_args(lambda context: context.input),
+    "lastmessage": _no_args(lambda context: _history_message(context, None)),
+    "lastusermessage": _no_args(lambda context: _history_message(context, True)),
+    "lastcharmessage": _no_args(lambda context: _history_message(context, False)),
+    "lastmessageid": _no_args(lambda context: str(len(context.history) - 1) if context.history else ""),
+    "time": _no_args(lambda context: context.now.strftime("%H:%M")),
+    "date": _no_args(lambda context: f"{context.now.year}年{context.now.month}月{context.now.day}日"),
+    "weekday": _no_args(lambda context: _WEEKDAYS[context.now.weekday()]),
+    "isotime": _no_args(lambda context: context.now.strftime("%H:%M")),
+    "isodate": _no_args(lambda context: context.now.strftime("%Y-%m-%d")),
+    "idle_duration": _no_args(_idle_duration),
+    "random": _random,
+    # 部分角色卡使用{{random@::a::b}}写法
+    "random@": _random,
+    "pick": _pick,
+    "roll": _roll,
+    "newline": _no_args(lambda context: "\n"),
+    "trim": _no_args(lambda context: ""),
+    "noop": _no_args(lambda context: ""),
+    "//": lambda context, args, body: ""
+}
+for _prefix, _scope in (("", lambda context: context.variables), ("global", lambda context: context.global_variables)):
+    for _operation, _handler in _variable_macros(_scope).items():
+        _MACROS[f"{_operation}{_prefix}var"] = _handler
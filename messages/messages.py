@@ -1,10 +1,111 @@
 import json
 import os
-from typing import List, Dict, Any, Optional
+from itertools import chain
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from pathlib import Path
 from pprint import pprint
 
 from ..chat.chat_session import ChatSession
+from ..character.lorebook import ROLES, WORLD_INFO_AFTER, WORLD_INFO_BEFORE, WORLD_INFO_MARKERS, WorldInfo
+from ..preset.RegexProcess import AI_OUTPUT, USER_INPUT
+from ..preset.generation import NAMES_COMPLETION, NAMES_CONTENT, NAMES_DEFAULT, sanitize_name
+from .macros import MacroContext, MacroEngine
+from .token_counter import TokenCounter
+
+# 判断静态前缀中哪些消息依赖用户昵称时,代替用户昵称渲染的名称
+NICKNAME_PROBE = "\x00"
+
+
+class InsertionPlan:
+    """预设中插入聊天历史的提示词和角色备注(depth_prompt)的插入计划,按(预设, 角色)计算一次
+
+    相同深度和角色的提示词合并为一个模板,预设提示词在前、角色备注在后,
+    与SillyTavern相同;每轮只渲染模板中的宏,再与触发的世界书条目按顺序归并。
+
+    Attributes:
+        groups (Tuple[Tuple[int, str, str], ...]): (深度, 角色, 模板),按深度从大到小、角色顺序排列
+    """
+
+    __slots__ = ("groups",)
+
+    def __init__(self, injection_prompts: Sequence[Dict[str, Any]], depth_prompt: Tuple[int, str, str]) -> None:
+        """根据提示词计算插入计划
+
+        Args:
+            injection_prompts: 预设中插入聊天历史的提示词,包含role、content和depth
+            depth_prompt: 角色备注的(深度, 角色, 内容)
+        """
+        groups: Dict[Tuple[int, str], List[str]] = {}
+        for prompt in injection_prompts:
+            content = str(prompt.get("content") or "").strip()
+            if content:
+                key = (max(int(prompt.get("depth") or 0), 0), self._role(prompt.get("role")))
+                groups.setdefault(key, []).append(content)
+        depth, role, content = depth_prompt
+        if content.strip():
+            groups.setdefault((max(int(depth or 0), 0), self._role(role)), []).append(content.strip())
+        self.groups: Tuple[Tuple[int, str, str], ...] = tuple(
+            (depth, role, "\n".join(contents))
+            for (depth, role), contents in sorted(
+                groups.items(), key=lambda item: (-item[0][0], ROLES.index(item[0][1]))
+            )
+        )
+
+    @staticmethod
+    def _role(role: Any) -> str:
+        """将提示词的角色规范为system、user或assistant
+
+        Args:
+            role: 提示词中的角色
+
+        Returns:
+            str: 角色,无效时为system
+        """
+        return role if role in ROLES else "system"
+
+
+class PromptCache:
+    """会话构造提示时的缓存,保存在ChatSession.prompt_cache中
+
+    静态前缀和聊天历史之后的提示词在用户昵称、角色、预设提示词和生成设置都不变时复用;
+    聊天历史消息在下一轮只处理新增的记录和深度跨过正则规则边界的记录。
+    缓存的消息字典会出现在多轮的消息列表中,使用者不能修改。
+
+    Attributes:
+        key (Optional[Tuple[str, Any, Any, Any]]): 构造静态前缀时的(用户昵称, 角色对象, 预设提示词, 生成设置)
+        static_prefix (Tuple[Dict[str, Any], ...]): 静态前缀
+        shared_length (int): 静态前缀开头不依赖用户昵称的消息数
+        suffix_key (Optional[Tuple[str, Any, Any, Any]]): 构造聊天历史之后的提示词时的缓存键
+        static_suffix (Tuple[Dict[str, Any], ...]): 聊天历史之后的提示词
+        pipeline (Optional[Any]): 处理聊天历史时使用的正则流水线
+        names_behavior (int): 处理聊天历史时使用的names_behavior
+        plan_key (Optional[Tuple[Any, Any]]): 计算插入计划时的(预设注入提示词, 角色对象)
+        plan (Optional[InsertionPlan]): 插入计划
+        records (List[Dict[str, Any]]): 上一轮的聊天记录
+        history_messages (List[Dict[str, Any]]): 上一轮聊天记录对应的消息
+    """
+
+    __slots__ = (
+        "key", "static_prefix", "shared_length", "suffix_key", "static_suffix", "pipeline", "names_behavior",
+        "plan_key", "plan", "records", "history_messages"
+    )
+
+    # 由多个会话共享的对象,不计入会话的内存占用
+    shared_attributes = ("key", "suffix_key", "pipeline", "plan_key")
+
+    def __init__(self) -> None:
+        """初始化空缓存"""
+        self.key: Optional[Tuple[str, Any, Any, Any]] = None
+        self.static_prefix: Tuple[Dict[str, Any], ...] = ()
+        self.shared_length: int = 0
+        self.suffix_key: Optional[Tuple[str, Any, Any, Any]] = None
+        self.static_suffix: Tuple[Dict[str, Any], ...] = ()
+        self.pipeline: Optional[Any] = None
+        self.names_behavior: int = NAMES_DEFAULT
+        self.plan_key: Optional[Tuple[Any, Any]] = None
+        self.plan: Optional[InsertionPlan] = None
+        self.records: List[Dict[str, Any]] = []
+        self.history_messages: List[Dict[str, Any]] = []
 
 
 class Messages:
@@ -15,130 +116,754 @@ class Messages:
         nickname (str): 用户昵称
         character_name (str): 角色名称
         message_type (str): 消息类型
+        token_counter (TokenCounter): 按上下文预算截取历史时使用的token计数器
+        world_info_depth (int): 世界书未设置scan_depth时扫描的最近消息数
+        world_info_budget (int): 世界书关键词条目的token预算,为0时不限制
+        macro_engine (MacroEngine): 渲染预设提示词和角色卡中的宏
     """
 
-    def __init__(self) -> None:
-        """初始化消息构造器"""
+    def __init__(
+        self,
+        token_counter: Optional[TokenCounter] = None,
+        world_info_depth: int = 2,
+        world_info_budget: int = 2048
+    ) -> None:
+        """初始化消息构造器
+        
+        Args:
+            token_counter: token计数器
+            world_info_depth: 世界书未设置scan_depth时扫描的最近消息数
+            world_info_budget: 世界书关键词条目的token预算
+        """
         self.user_message: str = ""
         self.nickname: str = ""
         self.character_name: str = ""
         self.message_type: str = ""
+        self.token_counter = token_counter or TokenCounter()
+        self.world_info_depth = world_info_depth
+        self.world_info_budget = world_info_budget
+        self.macro_engine = MacroEngine()
 
     # 文件地址
     script_dir = os.path.dirname(__file__)
 
-    async def construct_messages(
+    def get_static_prefix(
         self,
-        message: str,
         chat_session: ChatSession,
-        chat_history: List[Dict[str, Any]]
-    ) -> List[Dict[str, Any]]:
-        """构造消息列表
-        
+        message: str = "",
+        chat_history: Sequence[Dict[str, Any]] = ()
+    ) -> Tuple[Dict[str, Any], ...]:
+        """获取会话的静态前缀,用户昵称、角色、预设提示词和生成设置都未变化时返回上次构造的前缀
+
+        静态前缀中有{{time}}、{{random}}等每轮结果不同的宏时不缓存,每轮重新构造。
+        预设启用squash_system_messages时返回合并相邻system消息后的前缀。
+
         Args:
-            message: 当前消息
             chat_session: 聊天会话对象
-            chat_history: 聊天历史记录
-            
+            message: 当前消息,用于渲染前缀中的宏
+            chat_history: 聊天历史记录,用于渲染前缀中的宏
+
         Returns:
-            List[Dict[str, Any]]: 构造的消息列表
+            Tuple[Dict[str, Any], ...]: 静态前缀消息,不能修改
         """
-        messages = []
-        character = chat_session.get_character()
-        nickname = chat_session.get_nick_name()
-        character_name = character.get_name()
-         #description=character.get_description().replace("{{user}}",nickname).replace("{{char}}",character_name)
+        cache = self._prompt_cache(chat_session)
+        key = self._prompt_key(chat_session)
+        if self._same_key(cache.key, key):
+            return cache.static_prefix
+        context = self._macro_context(chat_session, message, chat_history)
+        prefix = self.build_static_prefix(chat_session, context)
+        if self._squash_enabled(chat_session):
+            prefix = self._squash_system_messages(prefix)
+        prefix = tuple(prefix)
+        cache.key = None if context.volatile else key
+        cache.static_prefix = prefix
+        cache.shared_length = self._shared_prefix_length(chat_session, prefix, context)
+        return prefix
+
+    def get_shared_prefix_length(self, chat_session: ChatSession) -> int:
+        """获取上次构造的静态前缀开头不依赖用户昵称的消息数
+
+        同一预设和角色的不同用户共享这部分前缀,Gemini缓存内容只包含这部分。
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            int: 消息数,未构造过静态前缀时为0
+        """
+        return self._prompt_cache(chat_session).shared_length
+
+    def _shared_prefix_length(
+        self,
+        chat_session: ChatSession,
+        prefix: Sequence[Dict[str, Any]],
+        context: MacroContext
+    ) -> int:
+        """用另一个用户昵称重新渲染静态前缀,逐条比较得到开头不依赖用户昵称的消息数
+
+        重新渲染使用会话变量的副本,变量宏的修改不会执行两次。
+
+        Args:
+            chat_session: 聊天会话对象
+            prefix: 已构造的静态前缀
+            context: 构造静态前缀时使用的宏上下文
+
+        Returns:
+            int: 消息数
+        """
+        probe_context = MacroContext(
+            user=NICKNAME_PROBE,
+            char=context.char,
+            character=context.character,
+            input=context.input,
+            history=context.history,
+            variables=dict(context.variables),
+            global_variables=dict(context.global_variables),
+            now=context.now,
+            seed=context.seed
+        )
+        probe_prefix = self.build_static_prefix(chat_session, probe_context)
+        if self._squash_enabled(chat_session):
+            probe_prefix = self._squash_system_messages(probe_prefix)
+        shared_length = 0
+        for message, probe_message in zip(prefix, probe_prefix):
+            if message != probe_message:
+                break
+            shared_length += 1
+        return shared_length
+
+    def _get_static_suffix(
+        self,
+        chat_session: ChatSession,
+        context: MacroContext,
+        order_prompts: List[Any],
+        chatHistory_id: int
+    ) -> Tuple[Dict[str, Any], ...]:
+        """获取聊天历史之后的提示词,与静态前缀使用相同的缓存条件
+
+        Args:
+            chat_session: 聊天会话对象
+            context: 本轮的宏上下文
+            order_prompts: 预设提示词列表
+            chatHistory_id: chatHistory标记的位置
+
+        Returns:
+            Tuple[Dict[str, Any], ...]: 渲染后的提示词,不能修改
+        """
+        cache = self._prompt_cache(chat_session)
+        key = self._prompt_key(chat_session)
+        if self._same_key(cache.suffix_key, key):
+            return cache.static_suffix
+        volatile, context.volatile = context.volatile, False
+        suffix = self._render_prompts(order_prompts[chatHistory_id+1:], chat_session, context)
+        if self._squash_enabled(chat_session):
+            suffix = self._squash_system_messages(suffix)
+        suffix = tuple(suffix)
+        cache.suffix_key = None if context.volatile else key
+        cache.static_suffix = suffix
+        context.volatile = context.volatile or volatile
+        return suffix
+
+    @staticmethod
+    def _prompt_key(chat_session: ChatSession) -> Tuple[str, Any, Any, Any]:
+        """获取决定静态提示词内容的(用户昵称, 角色对象, 预设提示词, 生成设置)
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            Tuple[str, Any, Any, Any]: 缓存键
+        """
+        return (
+            chat_session.get_nick_name(),
+            chat_session.get_character(),
+            chat_session.get_preset_order_prompts(),
+            chat_session.get_generation_settings()
+        )
+
+    @staticmethod
+    def _same_key(cached: Optional[Tuple[str, Any, Any, Any]], key: Tuple[str, Any, Any, Any]) -> bool:
+        """判断缓存键是否相同,角色对象、预设提示词和生成设置按同一对象比较
+
+        Args:
+            cached: 缓存时的键,为None表示没有缓存
+            key: 当前的键
+
+        Returns:
+            bool: 是否相同
+        """
+        return (
+            cached is not None and cached[0] == key[0] and
+            cached[1] is key[1] and cached[2] is key[2] and cached[3] is key[3]
+        )
+
+    @staticmethod
+    def _squash_enabled(chat_session: ChatSession) -> bool:
+        """判断会话的预设是否启用squash_system_messages
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            bool: 是否合并相邻的system消息
+        """
+        generation = chat_session.get_generation_settings()
+        return generation is not None and generation.squash_system_messages
+
+    @staticmethod
+    def _names_behavior(chat_session: ChatSession) -> int:
+        """获取会话的预设中的names_behavior
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            int: names_behavior,未设置生成设置时为NAMES_DEFAULT
+        """
+        generation = chat_session.get_generation_settings()
+        return generation.names_behavior if generation is not None else NAMES_DEFAULT
+
+    @staticmethod
+    def _squash_system_messages(messages: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """将相邻的system消息以换行连接合并为一条,与SillyTavern的squash_system_messages相同
+
+        带name字段的消息不参与合并;合并时生成新的消息字典,不修改传入的消息。
 
+        Args:
+            messages: 消息列表
+
+        Returns:
+            List[Dict[str, Any]]: 合并后的消息列表
+        """
+        squashed: List[Dict[str, Any]] = []
+        run: List[Dict[str, Any]] = []
+        for message in chain(messages, (None,)):
+            if message is not None and message["role"] == "system" and "name" not in message:
+                run.append(message)
+                continue
+            if len(run) == 1:
+                squashed.append(run[0])
+            elif run:
+                squashed.append({"role": "system", "content": "\n".join(item["content"] for item in run)})
+            run = []
+            if message is not None:
+                squashed.append(message)
+        return squashed
+
+    @staticmethod
+    def _add_name(message: Dict[str, Any], name: str, names_behavior: int) -> Dict[str, Any]:
+        """按names_behavior在消息中加入发送者名称
+
+        NAMES_COMPLETION时设置消息的name字段,NAMES_CONTENT时在内容前加上"名称: ",
+        其他取值不修改消息。
+
+        Args:
+            message: 新构造的消息
+            name: 发送者名称
+            names_behavior: 预设中的names_behavior
+
+        Returns:
+            Dict[str, Any]: 传入的消息
+        """
+        if not name:
+            return message
+        if names_behavior == NAMES_COMPLETION:
+            name = sanitize_name(name)
+            if name:
+                message["name"] = name
+        elif names_behavior == NAMES_CONTENT:
+            message["content"] = f"{name}: {message['content']}"
+        return message
+
+    @staticmethod
+    def _prompt_cache(chat_session: ChatSession) -> PromptCache:
+        """获取会话的提示缓存,不存在时创建
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            PromptCache: 提示缓存
+        """
+        if chat_session.prompt_cache is None:
+            chat_session.prompt_cache = PromptCache()
+        return chat_session.prompt_cache
+
+    def build_static_prefix(
+        self,
+        chat_session: ChatSession,
+        context: Optional[MacroContext] = None
+    ) -> List[Dict[str, Any]]:
+        """构造消息列表中不随对话变化的静态前缀
+
+        静态前缀包括聊天历史之前的预设提示词、角色卡字段和角色的初始消息。
+        相同的预设、角色和昵称总是得到逐字节相同的前缀,便于服务端的前缀缓存命中。
+        角色世界书有关键词触发的条目时,静态前缀在对应的世界书标记之前结束。
+
+        Args:
+            chat_session: 聊天会话对象
+            context: 宏上下文,为None时不包含当前消息和聊天历史
+
+        Returns:
+            List[Dict[str, Any]]: 静态前缀消息列表
+        """
         order_prompts = chat_session.get_preset_order_prompts()
+        static_end, chatHistory_id = self._split_prompts(order_prompts, chat_session)
+        if context is None:
+            context = self._macro_context(chat_session)
+        prefix = self._render_prompts(order_prompts[0:static_end], chat_session, context)
+        if static_end == chatHistory_id:
+            prefix.append(self._render_first_message(chat_session, context))
+        return prefix
+
+    def _macro_context(
+        self,
+        chat_session: ChatSession,
+        message: str = "",
+        chat_history: Sequence[Dict[str, Any]] = ()
+    ) -> MacroContext:
+        """构造本轮渲染宏使用的上下文
+
+        Args:
+            chat_session: 聊天会话对象
+            message: 当前消息
+            chat_history: 聊天历史记录,按时间从旧到新排列
+
+        Returns:
+            MacroContext: 宏上下文,聊天记录包括当前消息
+        """
+        history = list(chat_history)
+        if message:
+            history.append({"name": chat_session.get_nick_name(), "is_user": True, "msg": message})
+        return MacroContext(
+            user=chat_session.get_nick_name(),
+            char=chat_session.get_character_name(),
+            character=chat_session.get_character(),
+            input=message,
+            history=history,
+            variables=chat_session.variables,
+            global_variables=self.macro_engine.global_variables,
+            seed=chat_session.get_session_id()
+        )
+
+    def _split_prompts(self, order_prompts: List[Any], chat_session: ChatSession) -> Tuple[int, int]:
+        """获取静态前缀的结束位置和chatHistory标记的位置
+
+        Args:
+            order_prompts: 预设提示词列表
+            chat_session: 聊天会话对象
+
+        Returns:
+            Tuple[int, int]: (静态前缀结束位置, chatHistory标记位置)
+        """
         chatHistory_id = order_prompts.index("chatHistory")
-        order_prompts0 = order_prompts[0:chatHistory_id]
-        order_prompts1 = order_prompts[chatHistory_id+1:]
+        lorebook = chat_session.get_character().get_lorebook()
+        if lorebook is not None and lorebook.dynamic_positions:
+            for index, prompt in enumerate(order_prompts[0:chatHistory_id]):
+                if isinstance(prompt, str) and WORLD_INFO_MARKERS.get(prompt) in lorebook.dynamic_positions:
+                    return index, chatHistory_id
+        return chatHistory_id, chatHistory_id
+
+    def _render_first_message(self, chat_session: ChatSession, context: MacroContext) -> Dict[str, Any]:
+        """渲染角色的初始消息
+
+        Args:
+            chat_session: 聊天会话对象
+            context: 宏上下文
+
+        Returns:
+            Dict[str, Any]: assistant消息
+        """
+        return {
+            "role": "assistant",
+            "content": self.macro_engine.render(chat_session.get_character().get_first_message(), context)
+        }
+
+    def _render_prompts(
+        self,
+        order_prompts: List[Any],
+        chat_session: ChatSession,
+        context: MacroContext,
+        world_info: Optional[WorldInfo] = None
+    ) -> List[Dict[str, Any]]:
+        """渲染预设提示词,将标记替换为角色卡字段并渲染其中的宏
+
+        总是生成新的消息字典,不修改会话中保存的预设提示词。
+
+        Args:
+            order_prompts: 预设提示词列表,标记为字符串
+            chat_session: 聊天会话对象
+            context: 宏上下文
+            world_info: 本轮触发的世界书条目,为None时只使用常驻条目
+
+        Returns:
+            List[Dict[str, Any]]: 渲染后的消息列表,已去除空标记
+        """
+        character = chat_session.get_character()
+        if world_info is None and character.get_lorebook() is not None:
+            world_info = character.get_lorebook().static_world_info
         #['worldInfoBefore', 'personaDescription', 'charDescription', 'charPersonality',
         # 'scenario', 'worldInfoAfter', 'dialogueExamples', 'chatHistory']
         replace_prompt_list = {
-            'worldInfoBefore': "",
+            'worldInfoBefore': self._join_world_info(world_info, WORLD_INFO_BEFORE),
             'personaDescription': "",
-            'charDescription': character.get_description().replace(
-                "{{user}}", nickname
-            ).replace(
-                "{{char}}", character_name
-            ),
-            'charPersonality': character.get_personality().replace(
-                "{{user}}", nickname
-            ).replace(
-                "{{char}}", character_name
-            ),
-            'scenario': character.get_scenario().replace(
-                "{{user}}", nickname
-            ).replace(
-                "{{char}}", character_name
-            ),
-            'worldInfoAfter': "",
-            'dialogueExamples': character.get_mes_example().replace(
-                "{{user}}", nickname
-            ).replace(
-                "{{char}}", character_name
-            ),
+            'charDescription': character.get_description(),
+            'charPersonality': character.get_personality(),
+            'scenario': character.get_scenario(),
+            'worldInfoAfter': self._join_world_info(world_info, WORLD_INFO_AFTER),
+            'dialogueExamples': character.get_mes_example(),
             'chatHistory': ""
         }
-        for i, prompt in enumerate(order_prompts0):
+        rendered = []
+        for prompt in order_prompts:
             if isinstance(prompt, str):
-                if replace_prompt_list[prompt]:
-                    order_prompts0[i] = {
-                        'role': 'system',
-                        'content': replace_prompt_list[prompt]
-                    }
-                else:
-                    order_prompts0[i] = None
+                content = replace_prompt_list.get(prompt, "")
+                role = 'system'
             else:
-                prompt["content"] = str(prompt["content"]).replace(
-                    "{{user}}", nickname
-                ).replace(
-                    "{{char}}", character_name
-                )
-
-        for i, prompt in enumerate(order_prompts1):
-            if isinstance(prompt, str):
-                if replace_prompt_list[prompt]:
-                    order_prompts1[i] = {
-                        'role': 'system',
-                        'content': replace_prompt_list[prompt]
-                    }
-                else:
-                    order_prompts1[i] = None
-            else:
-                prompt["content"] = str(prompt["content"]).replace(
-                    "{{user}}", nickname
-                ).replace(
-                    "{{char}}", character_name
-                )
-    #将历史记录添加为user消息
-        first_message = {
-                    "role": "assistant",
-                    "content": character.get_first_message().replace(
-                        "{{user}}", nickname
-                    ).replace(
-                        "{{char}}", character_name
-                    )
-                }
-        messages.append(first_message)
-        for history_message in chat_history:
-            messages.append({
-                "role": "user" if history_message["is_user"] else "assistant",
-                "content": history_message["msg"]
+                content = str(prompt.get("content") or "")
+                role = prompt["role"]
+            if not content:
+                continue
+            rendered.append({
+                'role': role,
+                'content': self.macro_engine.render(content, context)
             })
+        return rendered
 
-        user_message = {
-            "role": "user",
-            "content": message
-        }
-        messages.append(user_message)
+    @staticmethod
+    def _join_world_info(world_info: Optional[WorldInfo], position: int) -> str:
+        """拼接插入世界书标记位置的条目内容
+
+        Args:
+            world_info: 触发的世界书条目
+            position: WORLD_INFO_BEFORE或WORLD_INFO_AFTER
+
+        Returns:
+            str: 条目内容,按插入顺序以换行分隔
+        """
+        if world_info is None:
+            return ""
+        return "\n".join(entry.content for entry in world_info.get_entries(position))
+
+    def precompile(self, chat_session: ChatSession) -> int:
+        """预先编译会话的预设提示词、注入提示词和角色卡字段中的宏,用于启动后预热
+
+        只编译模板,不渲染也不修改会话的提示缓存。
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            int: 编译的文本段数
+        """
+        character = chat_session.get_character()
+        texts = [
+            character.get_description(),
+            character.get_personality(),
+            character.get_scenario(),
+            character.get_mes_example(),
+            character.get_first_message(),
+            character.get_depth_prompt()[0]
+        ]
+        for prompt in chat_session.get_preset_order_prompts():
+            if not isinstance(prompt, str):
+                texts.append(str(prompt.get("content") or ""))
+        for prompt in chat_session.get_preset_injection_prompts():
+            texts.append(str(prompt.get("content") or ""))
+        compiled = 0
+        for text in texts:
+            if text and isinstance(text, str):
+                self.macro_engine.compile(text)
+                compiled += 1
+        return compiled
+
+    def _get_insertion_plan(self, chat_session: ChatSession) -> InsertionPlan:
+        """获取会话的插入计划,预设注入提示词和角色都未变化时返回上次计算的结果
+
+        Args:
+            chat_session: 聊天会话对象
+
+        Returns:
+            InsertionPlan: 插入计划
+        """
+        cache = self._prompt_cache(chat_session)
+        injection_prompts = chat_session.get_preset_injection_prompts()
+        character = chat_session.get_character()
+        if cache.plan is None or cache.plan_key[0] is not injection_prompts or cache.plan_key[1] is not character:
+            depth_prompt, role = character.get_depth_prompt()
+            cache.plan = InsertionPlan(injection_prompts, (character.get_depth(), role, depth_prompt))
+            cache.plan_key = (injection_prompts, character)
+        return cache.plan
+
+    def _render_depth_entries(
+        self,
+        plan: InsertionPlan,
+        world_info: Optional[WorldInfo],
+        context: MacroContext
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        """渲染插入聊天历史中的提示词和世界书条目,相同深度和角色的内容合并为一条消息
+
+        插入计划已经排好序,只对本轮触发的世界书条目排序后与插入计划逐个归并。
+
+        Args:
+            plan: 预设注入提示词和角色备注的插入计划
+            world_info: 触发的世界书条目,为None时只插入计划中的提示词
+            context: 宏上下文
+
+        Returns:
+            List[Tuple[int, Dict[str, Any]]]: (深度, 消息),按深度从大到小、角色顺序排列,不含内容为空的消息
+        """
+        groups: Dict[Tuple[int, str], List[str]] = {}
+        if world_info is not None:
+            for entry in world_info.at_depth:
+                groups.setdefault((entry.depth, entry.role), []).append(entry.content)
+        entries = sorted(groups.items(), key=lambda item: (-item[0][0], ROLES.index(item[0][1])))
+        depth_messages = []
+        index = 0
+        for depth, role, template in plan.groups:
+            order = (-depth, ROLES.index(role))
+            while index < len(entries) and (-entries[index][0][0], ROLES.index(entries[index][0][1])) < order:
+                depth_messages.append(self._depth_message(entries[index][0], [], entries[index][1], context))
+                index += 1
+            contents: List[str] = []
+            if index < len(entries) and entries[index][0] == (depth, role):
+                contents = entries[index][1]
+                index += 1
+            depth_messages.append(self._depth_message((depth, role), [template], contents, context))
+        for key, contents in entries[index:]:
+            depth_messages.append(self._depth_message(key, [], contents, context))
+        return [item for item in depth_messages if item[1]["content"]]
+
+    def _depth_message(
+        self,
+        key: Tuple[int, str],
+        templates: List[str],
+        contents: List[str],
+        context: MacroContext
+    ) -> Tuple[int, Dict[str, Any]]:
+        """渲染一条插入聊天历史中的消息
+
+        Args:
+            key: (深度, 角色)
+            templates: 插入计划中的模板
+            contents: 世界书条目内容
+            context: 宏上下文
+
+        Returns:
+            Tuple[int, Dict[str, Any]]: (深度, 消息)
+        """
+        parts = [self.macro_engine.render(template, context) for template in templates]
+        if contents:
+            parts.append(self.macro_engine.render("\n".join(contents), context))
+        return key[0], {"role": key[1], "content": "\n".join(part for part in parts if part)}
+
+    async def construct_messages(
+        self,
+        message: str,
+        chat_session: ChatSession,
+        chat_history: List[Dict[str, Any]],
+        static_prefix: Optional[Sequence[Dict[str, Any]]] = None,
+        budget: int = 0
+    ) -> List[Dict[str, Any]]:
+        """构造消息列表
+        
+        聊天历史和当前消息先按深度执行预设中promptOnly的正则规则(当前消息深度为0),
+        给定budget时,先扣除静态前缀、当前消息和聊天历史之后的提示词,
+        再从最新的聊天记录开始向前加入,直到剩余预算放不下下一条为止。
+        预设启用squash_system_messages时相邻的system消息合并为一条。
+        
+        Args:
+            message: 当前消息
+            chat_session: 聊天会话对象
+            chat_history: 聊天历史记录,按时间从旧到新排列
+            static_prefix: 已构造的静态前缀,为None时使用会话缓存的静态前缀
+            budget: 提示的token预算,为0时不截取聊天历史
+            
+        Returns:
+            List[Dict[str, Any]]: 构造的消息列表,以静态前缀开头
+        """
+        if static_prefix is None:
+            static_prefix = self.get_static_prefix(chat_session, message, chat_history)
+
+        order_prompts = chat_session.get_preset_order_prompts()
+        static_end, chatHistory_id = self._split_prompts(order_prompts, chat_session)
+        context = self._macro_context(chat_session, message, chat_history)
+        order_prompts1 = self._get_static_suffix(chat_session, context, order_prompts, chatHistory_id)
 
-        messages = order_prompts0 + messages + order_prompts1
-        messages = [item for item in messages if item is not None]
+        regex_pipeline = chat_session.get_preset_regex()
+        if regex_pipeline is not None:
+            message = regex_pipeline.process_prompt(message, USER_INPUT, 0)
+        user_message = self._add_name(
+            {"role": "user", "content": message},
+            chat_session.get_nick_name(),
+            self._names_behavior(chat_session)
+        )
+
+        history_messages = self._history_messages(chat_session, chat_history)
+
+        #扫描当前消息和最近的聊天历史,触发角色世界书中的条目
+        world_info = None
+        lorebook = chat_session.get_character().get_lorebook()
+        if lorebook is not None:
+            world_info = lorebook.activate(
+                chain([message], (history_message["content"] for history_message in reversed(history_messages))),
+                self.world_info_budget,
+                self.token_counter.count_text,
+                self.world_info_depth
+            )
+        #静态前缀之后、聊天历史之前的提示词包含本轮触发的世界书条目
+        middle_messages = []
+        if static_end < chatHistory_id:
+            middle_messages = self._render_prompts(
+                order_prompts[static_end:chatHistory_id], chat_session, context, world_info
+            )
+            middle_messages.append(self._render_first_message(chat_session, context))
+        #预设注入提示词、角色备注和世界书条目按深度插入聊天历史
+        depth_messages = self._render_depth_entries(self._get_insertion_plan(chat_session), world_info, context)
+
+        if budget > 0:
+            history_messages = self._fit_history(
+                history_messages,
+                budget - self.token_counter.count_messages(
+                    list(static_prefix) + middle_messages + [user_message] + list(order_prompts1)
+                    + [depth_message for _, depth_message in depth_messages]
+                )
+            )
+
+        chat_messages = history_messages + [user_message]
+        if depth_messages:
+            chat_messages = self._insert_at_depth(chat_messages, depth_messages)
+        #静态前缀和聊天历史之后的提示词在缓存时已经合并,这里只合并中间的部分,静态前缀保持不变
+        chat_messages = middle_messages + chat_messages
+        if self._squash_enabled(chat_session):
+            chat_messages = (
+                self._squash_system_messages(chat_messages + list(order_prompts1[:1]))
+                + list(order_prompts1[1:])
+            )
+        else:
+            chat_messages = chat_messages + list(order_prompts1)
+        messages = list(static_prefix) + chat_messages
         pprint(messages,indent=2)
         return messages
 
+    def _history_messages(
+        self,
+        chat_session: ChatSession,
+        chat_history: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """将聊天历史转换为user/assistant消息并执行promptOnly的正则规则,最新的一条深度为1
+
+        消息按预设的names_behavior加入发送者名称。
+
+        本轮的聊天历史通常是上一轮的聊天历史去掉开头若干条后追加新记录,
+        与上一轮重叠的记录复用上一轮的消息,只处理新增的记录和上一轮深度小于正则规则深度边界的记录。
+
+        Args:
+            chat_session: 聊天会话对象
+            chat_history: 聊天历史记录,按时间从旧到新排列
+
+        Returns:
+            List[Dict[str, Any]]: 聊天历史消息,消息字典不能修改
+        """
+        cache = self._prompt_cache(chat_session)
+        regex_pipeline = chat_session.get_preset_regex()
+        names_behavior = self._names_behavior(chat_session)
+        records, history_messages = cache.records, cache.history_messages
+        if cache.pipeline is not regex_pipeline or cache.names_behavior != names_behavior:
+            records, history_messages = [], []
+        dropped = self._find_overlap(records, chat_history)
+        history_messages = history_messages[dropped:]
+        kept = len(history_messages)
+        horizon = regex_pipeline.depth_horizon if regex_pipeline is not None else 0
+        #复用的消息上一轮的深度为kept-index,不小于horizon时生效的规则不变;horizon为0时只处理新增的记录
+        start = kept if horizon == 0 else max(kept - horizon + 1, 0)
+        for index in range(start, len(chat_history)):
+            record = chat_history[index]
+            content = record["msg"]
+            if regex_pipeline is not None:
+                content = regex_pipeline.process_prompt(
+                    content,
+                    USER_INPUT if record["is_user"] else AI_OUTPUT,
+                    len(chat_history) - index
+                )
+            message = self._add_name(
+                {"role": "user" if record["is_user"] else "assistant", "content": content},
+                record.get("name", ""),
+                names_behavior
+            )
+            if index < kept:
+                history_messages[index] = message
+            else:
+                history_messages.append(message)
+        cache.pipeline = regex_pipeline
+        cache.names_behavior = names_behavior
+        cache.records = list(chat_history)
+        cache.history_messages = history_messages
+        return history_messages
+
+    @staticmethod
+    def _find_overlap(records: List[Dict[str, Any]], chat_history: List[Dict[str, Any]]) -> int:
+        """找到上一轮的聊天记录中有多少条开头的记录不在本轮的聊天历史中
+
+        Args:
+            records: 上一轮的聊天记录
+            chat_history: 本轮的聊天历史记录
+
+        Returns:
+            int: 上一轮开头被移出的记录数,两轮没有重叠时为上一轮的记录数
+        """
+        for dropped in range(max(len(records) - len(chat_history), 0), len(records)):
+            if records[dropped:] == chat_history[:len(records) - dropped]:
+                return dropped
+        return len(records)
+
+    @staticmethod
+    def _insert_at_depth(
+        chat_messages: List[Dict[str, Any]],
+        depth_messages: List[Tuple[int, Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """将消息插入到距离聊天末尾depth条消息的位置,深度超出聊天长度时插入到最前面
+
+        Args:
+            chat_messages: 聊天历史和当前消息
+            depth_messages: (深度, 消息),按深度从大到小排列
+
+        Returns:
+            List[Dict[str, Any]]: 插入后的消息列表
+        """
+        result = []
+        index = 0
+        for depth, message in depth_messages:
+            position = max(len(chat_messages) - depth, 0)
+            result.extend(chat_messages[index:position])
+            index = max(index, position)
+            result.append(message)
+        result.extend(chat_messages[index:])
+        return result
+
+    def _fit_history(
+        self,
+        history_messages: List[Dict[str, Any]],
+        remaining: int
+    ) -> List[Dict[str, Any]]:
+        """从最新的记录开始保留能放入剩余预算的聊天历史
+
+        Args:
+            history_messages: 聊天历史消息,按时间从旧到新排列
+            remaining: 剩余token预算
+
+        Returns:
+            List[Dict[str, Any]]: 保留的聊天历史,按时间从旧到新排列
+        """
+        start = len(history_messages)
+        while start > 0:
+            tokens = self.token_counter.count_message(history_messages[start - 1])
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            start -= 1
+        return history_messages[start:]
+
 
 
 
@@ -0,0 +1,73 @@
+from typing import List
+
+
+class StreamSplitter:
+    """流式回复切分器,将逐段到达的文本切分为适合逐条发送的消息
+
+    优先在段落边界(空行)处切分;段落过长时退而在句末标点处切分。
+
+    Attributes:
+        min_length (int): 切分出的消息最少字符数,避免刷屏
+        max_length (int): 缓冲超过该长度时允许在句末切分
+        buffer (str): 尚未切分的文本
+    """
+
+    sentence_endings = "。！？!?…~～\n"
+
+    def __init__(self, min_length: int = 60, max_length: int = 300) -> None:
+        """初始化切分器
+
+        Args:
+            min_length: 切分出的消息最少字符数
+            max_length: 缓冲超过该长度时允许在句末切分
+        """
+        self.min_length = min_length
+        self.max_length = max_length
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """追加新到达的文本并返回已可发送的消息
+
+        Args:
+            text: 新到达的文本
+
+        Returns:
+            List[str]: 可立即发送的消息列表
+        """
+        self.buffer += text
+        segments = []
+        while True:
+            cut = self._find_cut()
+            if cut <= 0:
+                break
+            segment = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> List[str]:
+        """取出缓冲中剩余的全部文本
+
+        Returns:
+            List[str]: 剩余的消息列表
+        """
+        segment = self.buffer.strip()
+        self.buffer = ""
+        return [segment] if segment else []
+
+    def _find_cut(self) -> int:
+        """查找下一个切分位置
+
+        Returns:
+            int: 切分位置,无合适位置时返回-1
+        """
+        paragraph = self.buffer.find("\n\n", self.min_length)
+        if paragraph != -1:
+            return paragraph + 2
+        if len(self.buffer) < self.max_length:
+            return -1
+        for index in range(len(self.buffer) - 1, self.min_length - 1, -1):
+            if self.buffer[index] in self.sentence_endings:
+                return index + 1
+        return -1
@@ -0,0 +1,103 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except ImportError:
+    tiktoken = None
+    _encoding = None
+
+# 中日韩文字、假名、谚文和全角符号,每个字符大约对应一个token
+_CJK_RE = re.compile(r"[　-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+@lru_cache(maxsize=4096)
+def _count_text(text: str) -> float:
+    """计算文本未校准的token数
+
+    安装了tiktoken时使用o200k_base编码计数,否则按中日韩字符每个1个token、
+    其余字符每4个1个token估算。
+
+    Args:
+        text: 文本
+
+    Returns:
+        float: token数
+    """
+    if _encoding is not None:
+        return float(len(_encoding.encode(text, disallowed_special=())))
+    other = _CJK_RE.sub("", text)
+    return (len(text) - len(other)) + len(other) / 4
+
+
+class TokenCounter:
+    """token计数器,用于在发送请求前估算消息列表的token数
+
+    本地计数与服务端分词器存在差异,收到服务端返回的prompt_tokens后
+    按两者的比值校准,使估算结果逐渐贴近实际用量。
+
+    Attributes:
+        message_overhead (int): 每条消息的角色和格式开销
+        scale (float): 校准系数
+        alpha (float): 校准系数的指数加权平均系数
+    """
+
+    def __init__(self, message_overhead: int = 4, alpha: float = 0.2) -> None:
+        """初始化token计数器
+
+        Args:
+            message_overhead: 每条消息的角色和格式开销
+            alpha: 校准系数的指数加权平均系数
+        """
+        self.message_overhead = message_overhead
+        self.scale = 1.0
+        self.alpha = alpha
+
+    def count_text(self, text: str) -> int:
+        """估算文本的token数
+
+        Args:
+            text: 文本
+
+        Returns:
+            int: token数
+        """
+        return int(_count_text(text) * self.scale) + 1 if text else 0
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        """估算单条消息的token数
+
+        Args:
+            message: 消息字典
+
+        Returns:
+            int: token数
+        """
+        return self.count_text(str(message.get("content") or "")) + self.message_overhead
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        """估算消息列表的token数
+
+        Args:
+            messages: 消息列表
+
+        Returns:
+            int: token数
+        """
+        return sum(self.count_message(message) for message in messages)
+
+    def calibrate(self, messages: List[Dict[str, Any]], prompt_tokens: int) -> None:
+        """根据服务端返回的实际prompt_tokens校准估算系数
+
+        Args:
+            messages: 本次请求发送的消息列表
+            prompt_tokens: 服务端返回的提示token数
+        """
+        raw = sum(_count_text(str(message.get("content") or "")) for message in messages)
+        text_tokens = prompt_tokens - self.message_overhead * len(messages)
+        if raw <= 0 or text_tokens <= 0:
+            return
+        ratio = min(max(text_tokens / raw, 0.5), 2.0)
+        self.scale = (1 - self.alpha) * self.scale + self.alpha * ratio
@@ -0,0 +1,292 @@
+import gzip
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional, Sequence
+
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+
+def _dumps(value: Any) -> str:
+    """按与httpx相同的方式编码JSON: 紧凑格式,非ASCII字符不转义
+
+    Args:
+        value: 要编码的值
+
+    Returns:
+        str: JSON文本
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+
+
+class PrefixFragment:
+    """静态前缀编码后的JSON片段
+
+    Attributes:
+        messages (List[Dict[str, Any]]): 编码时的静态前缀消息
+        fragment (bytes): 消息数组中静态前缀部分的UTF-8编码,不含两侧的方括号
+    """
+
+    __slots__ = ("messages", "fragment")
+
+    def __init__(self, messages: List[Dict[str, Any]], fragment: bytes) -> None:
+        """初始化片段
+
+        Args:
+            messages: 静态前缀消息
+            fragment: 编码后的片段
+        """
+        self.messages = messages
+        self.fragment = fragment
+
+
+class PayloadEncoder:
+    """构造chat/completions请求体
+
+    静态前缀按缓存键(预设, 角色)只编码一次,每轮只编码静态前缀之后的消息,
+    再与请求参数和缓存的前缀片段直接拼接为请求体。
+    缓存的前缀与本轮的前缀不同时(例如预设被修改,或前缀中有用户昵称且换了用户)重新编码。
+
+    Attributes:
+        fragments (OrderedDict[Hashable, PrefixFragment]): 缓存键到前缀片段的映射
+        cache_size (int): 缓存的最大条目数
+        hits (int): 前缀片段缓存命中次数
+        misses (int): 前缀片段缓存未命中次数
+    """
+
+    def __init__(self, cache_size: int = 256) -> None:
+        """初始化编码器
+
+        Args:
+            cache_size: 缓存的最大条目数
+        """
+        self.fragments: "OrderedDict[Hashable, PrefixFragment]" = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_prefix_fragment(self, cache_key: Hashable, prefix: List[Dict[str, Any]]) -> bytes:
+        """获取静态前缀的编码片段
+
+        Args:
+            cache_key: 静态前缀的缓存键
+            prefix: 静态前缀消息
+
+        Returns:
+            bytes: 编码后的片段,不含两侧的方括号
+        """
+        entry = self.fragments.get(cache_key)
+        if entry is not None and entry.messages == prefix:
+            self.fragments.move_to_end(cache_key)
+            self.hits += 1
+            return entry.fragment
+        self.misses += 1
+        fragment = _dumps(prefix)[1:-1].encode("utf-8")
+        self.fragments[cache_key] = PrefixFragment(prefix, fragment)
+        self.fragments.move_to_end(cache_key)
+        if len(self.fragments) > self.cache_size:
+            self.fragments.popitem(last=False)
+        return fragment
+
+    def build_body(
+        self,
+        fields: Dict[str, Any],
+        messages: Sequence[Dict[str, Any]],
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None
+    ) -> bytes:
+        """构造请求体
+
+        Args:
+            fields: messages以外的请求参数
+            messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键,为None时不使用缓存
+
+        Returns:
+            bytes: UTF-8编码的JSON请求体
+        """
+        parts = [_dumps(fields)[:-1].encode("utf-8")]
+        parts.append(b',"messages":[' if fields else b'"messages":[')
+        tail = messages
+        if cache_key is not None and static_prefix_length > 0:
+            parts.append(self.get_prefix_fragment(cache_key, list(messages[:static_prefix_length])))
+            tail = messages[static_prefix_length:]
+            if tail:
+                parts.append(b",")
+        if tail:
+            parts.append(_dumps(list(tail))[1:-1].encode("utf-8"))
+        parts.append(b"]}")
+        return b"".join(parts)
+
+
+def get_chat_url(base_url: str) -> str:
+    """根据API基础URL得到chat/completions接口地址
+
+    Args:
+        base_url: API基础URL
+
+    Returns:
+        str: 接口地址
+    """
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/chat/completions"):
+        return base_url
+    return f"{base_url}/chat/completions"
+
+
+def get_headers(api_key: Optional[str], compressed: bool = False) -> Dict[str, str]:
+    """构造chat/completions接口请求头
+
+    Args:
+        api_key: API密钥
+        compressed: 请求体是否经过gzip压缩
+
+    Returns:
+        Dict[str, str]: 请求头
+    """
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+    return headers
+
+
+def compress_body(body: bytes, level: int = 1) -> bytes:
+    """gzip压缩请求体
+
+    提示文本重复较多,级别1的压缩率与默认级别相差不大,耗时约为一半。
+
+    Args:
+        body: 请求体
+        level: 压缩级别
+
+    Returns:
+        bytes: 压缩后的请求体
+    """
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+async def raise_for_status(response: httpx.Response) -> None:
+    """响应状态码表示错误时抛出与openai库相同类型的错误
+
+    429抛出RateLimitError,其他错误状态码抛出APIStatusError,
+    错误信息的格式与openai库相同,便于沿用原有的重试和上下文超长判断。
+
+    Args:
+        response: 响应,流式响应会先读取完错误内容
+
+    Raises:
+        RateLimitError: 状态码为429
+        APIStatusError: 状态码不小于400
+    """
+    if response.status_code < 400:
+        return
+    await response.aread()
+    try:
+        body: Any = response.json()
+    except ValueError:
+        body = None
+    detail = body.get("error", body) if isinstance(body, dict) else None
+    message = f"Error code: {response.status_code} - {body if body is not None else response.text}"
+    error_class = RateLimitError if response.status_code == 429 else APIStatusError
+    raise error_class(message, response=response, body=detail)
+
+
+def wrap_transport_error(error: httpx.HTTPError, request: httpx.Request) -> Exception:
+    """将httpx的连接错误转换为openai库的错误类型
+
+    Args:
+        error: httpx错误
+        request: 请求
+
+    Returns:
+        Exception: APITimeoutError或APIConnectionError
+    """
+    if isinstance(error, httpx.TimeoutException):
+        return APITimeoutError(request=request)
+    return APIConnectionError(message=str(error) or "Connection error.", request=request)
+
+
+async def iter_sse_chunks(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """逐个解析流式响应中的数据块,收到[DONE]时结束
+
+    Args:
+        response: 流式响应
+
+    Yields:
+        Dict[str, Any]: 数据块
+
+    Raises:
+        APIStatusError: 数据块中包含错误
+    """
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        if not data:
+            continue
+        chunk = json.loads(data)
+        if isinstance(chunk, dict) and chunk.get("error"):
+            error = chunk["error"]
+            raise APIStatusError(
+                f"Error code: {response.status_code} - {chunk}",
+                response=response,
+                body=error
+            )
+        yield chunk
+
+
+def parse_usage(usage: Optional[Dict[str, Any]]) -> Optional[SimpleNamespace]:
+    """将响应中的usage转换为与openai库相同的属性访问方式
+
+    Args:
+        usage: 响应中的usage
+
+    Returns:
+        Optional[SimpleNamespace]: 使用量对象,响应中没有usage时为None
+    """
+    if not usage:
+        return None
+    details = usage.get("prompt_tokens_details") or {}
+    return SimpleNamespace(
+        prompt_tokens=usage.get("prompt_tokens") or 0,
+        completion_tokens=usage.get("completion_tokens") or 0,
+        total_tokens=usage.get("total_tokens") or 0,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=details.get("cached_tokens")),
+        prompt_cache_hit_tokens=usage.get("prompt_cache_hit_tokens")
+    )
+
+
+def get_message_text(data: Dict[str, Any]) -> str:
+    """读取非流式响应的回复文本
+
+    Args:
+        data: 响应JSON
+
+    Returns:
+        str: 回复文本
+    """
+    choices = data.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("message") or {}).get("content") or ""
+
+
+def get_delta_text(chunk: Dict[str, Any]) -> str:
+    """读取流式数据块中的回复文本
+
+    Args:
+        chunk: 数据块
+
+    Returns:
+        str: 回复文本片段
+    """
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
@@ -0,0 +1,248 @@
+import json
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+ANTHROPIC_VERSION = "2023-06-01"
+DEFAULT_CLAUDE_URL = "https://api.anthropic.com"
+NEW_CHAT_PROMPT = "[Start a new chat]"
+RATE_LIMIT_STATUS = (429, 529)
+
+
+class ClaudeStatusError(Exception):
+    """Messages接口返回错误状态码
+
+    Attributes:
+        status_code (int): HTTP状态码
+        message (str): 错误信息
+        retry_after (Optional[float]): 服务端要求的重试等待秒数
+    """
+
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None) -> None:
+        """初始化错误
+
+        Args:
+            status_code: HTTP状态码
+            message: 错误信息
+            retry_after: 服务端要求的重试等待秒数
+        """
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def rate_limited(self) -> bool:
+        """是否为速率限制或服务过载(429/529)"""
+        return self.status_code in RATE_LIMIT_STATUS
+
+
+def get_messages_url(api_url: str) -> str:
+    """根据配置的API URL得到Messages接口地址
+
+    Args:
+        api_url: 配置的API URL,可以带或不带/v1
+
+    Returns:
+        str: Messages接口地址
+    """
+    base_url = (api_url or DEFAULT_CLAUDE_URL).rstrip("/")
+    if base_url.endswith("/messages"):
+        return base_url
+    if base_url.endswith("/v1"):
+        return f"{base_url}/messages"
+    return f"{base_url}/v1/messages"
+
+
+def get_headers(api_key: Optional[str]) -> Dict[str, str]:
+    """构造Messages接口请求头
+
+    Args:
+        api_key: API密钥
+
+    Returns:
+        Dict[str, str]: 请求头
+    """
+    return {
+        "x-api-key": api_key or "",
+        "anthropic-version": ANTHROPIC_VERSION,
+        "content-type": "application/json"
+    }
+
+
+def build_claude_request(
+    messages: List[Dict[str, str]],
+    static_prefix_length: int,
+    model: str,
+    max_tokens: int,
+    temperature: float,
+    stream: bool = False,
+    parameters: Optional[Dict[str, Any]] = None,
+    assistant_prefill: str = ""
+) -> Dict[str, Any]:
+    """将construct_messages构造的消息列表转换为Messages接口请求体
+
+    开头连续的system消息放入system块,其余system消息转为user消息;
+    相邻同角色消息合并为一条,对话以assistant开头时补一条user消息。
+    静态前缀的system块末尾、静态前缀的最后一条消息和最后一条user消息
+    分别设置cache_control断点,重复的轮次可以从提示缓存读取。
+    设置assistant_prefill时在末尾加入assistant消息,模型从预填内容之后继续生成。
+
+    Args:
+        messages: 消息列表
+        static_prefix_length: 消息列表开头静态前缀的消息数
+        model: 模型名称
+        max_tokens: 最大生成token数
+        temperature: 采样温度,超过1时按1发送
+        stream: 是否流式返回
+        parameters: top_k等其他采样参数
+        assistant_prefill: 回复的预填内容
+
+    Returns:
+        Dict[str, Any]: 请求体
+    """
+    system_blocks: List[Dict[str, Any]] = []
+    index = 0
+    while index < len(messages) and messages[index]["role"] == "system":
+        if messages[index]["content"]:
+            system_blocks.append({"type": "text", "text": messages[index]["content"]})
+        index += 1
+    if system_blocks and index <= static_prefix_length:
+        system_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+
+    claude_messages: List[Dict[str, Any]] = []
+    prefix_block: Optional[Dict[str, Any]] = None
+    last_user_block: Optional[Dict[str, Any]] = None
+    for position in range(index, len(messages)):
+        message = messages[position]
+        if not message["content"]:
+            continue
+        role = "assistant" if message["role"] == "assistant" else "user"
+        block = {"type": "text", "text": message["content"]}
+        if claude_messages and claude_messages[-1]["role"] == role:
+            claude_messages[-1]["content"].append(block)
+        else:
+            claude_messages.append({"role": role, "content": [block]})
+        if position < static_prefix_length:
+            prefix_block = block
+        if message["role"] == "user":
+            last_user_block = block
+
+    if not claude_messages or claude_messages[0]["role"] != "user":
+        claude_messages.insert(0, {
+            "role": "user",
+            "content": [{"type": "text", "text": NEW_CHAT_PROMPT}]
+        })
+    for block in (prefix_block, last_user_block):
+        if block is not None:
+            block["cache_control"] = {"type": "ephemeral"}
+    #预填内容结尾不能有空白
+    assistant_prefill = assistant_prefill.rstrip()
+    if assistant_prefill:
+        block = {"type": "text", "text": assistant_prefill}
+        if claude_messages[-1]["role"] == "assistant":
+            claude_messages[-1]["content"].append(block)
+        else:
+            claude_messages.append({"role": "assistant", "content": [block]})
+
+    body: Dict[str, Any] = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": min(temperature, 1.0),
+        "messages": claude_messages
+    }
+    if parameters:
+        body.update(parameters)
+    if system_blocks:
+        body["system"] = system_blocks
+    if stream:
+        body["stream"] = True
+    return body
+
+
+def parse_claude_usage(usage: Dict[str, Any]) -> SimpleNamespace:
+    """将Messages接口的usage转换为与OpenAI一致的字段
+
+    Args:
+        usage: Messages接口返回的usage
+
+    Returns:
+        SimpleNamespace: 含prompt_tokens/completion_tokens/total_tokens/
+        cache_read_input_tokens的使用量对象
+    """
+    cache_read = usage.get("cache_read_input_tokens") or 0
+    cache_creation = usage.get("cache_creation_input_tokens") or 0
+    prompt_tokens = (usage.get("input_tokens") or 0) + cache_read + cache_creation
+    completion_tokens = usage.get("output_tokens") or 0
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        cache_read_input_tokens=cache_read,
+        cache_creation_input_tokens=cache_creation
+    )
+
+
+def get_response_text(data: Dict[str, Any]) -> str:
+    """拼接Messages接口响应中的文本块
+
+    Args:
+        data: 响应JSON
+
+    Returns:
+        str: 回复文本
+    """
+    return "".join(
+        block.get("text", "") for block in data.get("content", [])
+        if block.get("type") == "text"
+    )
+
+
+async def raise_for_status(response: httpx.Response) -> None:
+    """响应状态码表示错误时抛出ClaudeStatusError
+
+    Args:
+        response: 响应,流式响应会先读取完错误内容
+
+    Raises:
+        ClaudeStatusError: 状态码不小于400
+    """
+    if response.status_code < 400:
+        return
+    await response.aread()
+    try:
+        message = response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = response.text
+    try:
+        retry_after: Optional[float] = float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = None
+    raise ClaudeStatusError(response.status_code, message, retry_after)
+
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """逐个解析服务端推送事件
+
+    Args:
+        response: 流式响应
+
+    Yields:
+        Tuple[str, Dict[str, Any]]: (事件名, 事件数据)
+    """
+    event = ""
+    data_lines: List[str] = []
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+        elif not line and data_lines:
+            data = json.loads("\n".join(data_lines))
+            yield event or data.get("type", ""), data
+            event = ""
+            data_lines = []
+    if data_lines:
+        data = json.loads("\n".join(data_lines))
+        yield event or data.get("type", ""), data
@@ -0,0 +1,64 @@
+from typing import Optional
+
+import httpx
+
+
+class ClientPool:
+    """LLM客户端池,所有请求共享同一个httpx.AsyncClient
+
+    同一主机的请求复用keep-alive连接,避免每次请求都重新握手。
+    不做内部重试,重试和换密钥由调用方负责。
+
+    Attributes:
+        max_connections (int): 最大连接数
+        max_keepalive_connections (int): 最大保持连接数
+        keepalive_expiry (float): 空闲连接保持秒数
+        timeout (httpx.Timeout): 请求超时设置
+        http_client (Optional[httpx.AsyncClient]): 共享的HTTP客户端
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        timeout: float = 600.0,
+        connect_timeout: float = 10.0
+    ) -> None:
+        """初始化客户端池
+
+        Args:
+            max_connections: 最大连接数
+            max_keepalive_connections: 最大保持连接数
+            keepalive_expiry: 空闲连接保持秒数
+            timeout: 读写超时秒数
+            connect_timeout: 建立连接超时秒数
+        """
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http_client: Optional[httpx.AsyncClient] = None
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端,首次调用时在当前事件循环中创建
+
+        Returns:
+            httpx.AsyncClient: 共享的HTTP客户端
+        """
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+        return self.http_client
+
+    async def close(self) -> None:
+        """关闭共享连接"""
+        if self.http_client is not None and not self.http_client.is_closed:
+            await self.http_client.aclose()
+        self.http_client = None
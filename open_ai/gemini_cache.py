@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import httpx
+
+from .client_pool import ClientPool
+
+GEMINI_NATIVE_URL = "https://generativelanguage.googleapis.com/v1beta"
+
+
+class GeminiCachedContent:
+    """一个API密钥下创建的Gemini缓存内容
+
+    Attributes:
+        name (str): 缓存名称(cachedContents/...),创建失败时为空
+        expire_time (float): 过期时间(time.time())
+        retry_time (float): 创建失败后允许再次尝试的时间
+    """
+
+    __slots__ = ("name", "expire_time", "retry_time")
+
+    def __init__(self, name: str, expire_time: float, retry_time: float = 0.0) -> None:
+        """初始化缓存内容
+
+        Args:
+            name: 缓存名称
+            expire_time: 过期时间
+            retry_time: 创建失败后允许再次尝试的时间
+        """
+        self.name = name
+        self.expire_time = expire_time
+        self.retry_time = retry_time
+
+    def is_stale(self, now: float) -> bool:
+        """判断缓存内容是否已过期且不再需要保留
+
+        Args:
+            now: 当前时间(time.time())
+
+        Returns:
+            bool: 缓存已过期,或创建失败且已到再次尝试的时间
+        """
+        return self.expire_time <= now and self.retry_time <= now
+
+
+class GeminiCacheEntry:
+    """(预设, 角色, 模型)的Gemini缓存条目
+
+    缓存内容属于创建它的API密钥所在的项目,因此每个密钥各自创建缓存内容,
+    前缀内容相同时共享同一个条目和锁。
+
+    Attributes:
+        digest (str): 缓存前缀内容的摘要
+        contents (Dict[str, GeminiCachedContent]): API密钥到缓存内容的映射
+        lock (asyncio.Lock): 创建、续期和删除缓存内容时持有的锁,避免并发请求重复创建
+    """
+
+    __slots__ = ("digest", "contents", "lock")
+
+    def __init__(self, digest: str) -> None:
+        """初始化缓存条目
+
+        Args:
+            digest: 前缀内容摘要
+        """
+        self.digest = digest
+        self.contents: Dict[str, GeminiCachedContent] = {}
+        self.lock = asyncio.Lock()
+
+
+class GeminiCacheManager:
+    """Gemini缓存内容管理器,为每个(预设, 角色, 模型)的静态前缀创建、续期和删除缓存
+
+    条目按(缓存键, 模型)区分,缓存键为(预设名, 角色名),缓存的前缀不包含依赖用户昵称的消息,
+    同一角色的所有用户共享缓存。前缀内容变化时删除旧缓存并重新创建;
+    前缀过短等原因创建失败时,在retry_interval秒内不再尝试,直接走普通请求。
+    同一条目的创建和续期在锁内进行,并发的请求等待第一个请求的结果;
+    已过期的缓存内容和没有缓存内容的条目定期移除。
+
+    Attributes:
+        client_pool (ClientPool): 共享的客户端池
+        ttl (int): 缓存存活秒数
+        refresh_margin (int): 剩余存活时间低于该值时续期
+        retry_interval (int): 创建失败后再次尝试的间隔秒数
+        entries (Dict[Tuple[Hashable, str], GeminiCacheEntry]): 缓存条目
+        prune_time (float): 下次移除过期缓存内容的时间(time.time())
+    """
+
+    def __init__(
+        self,
+        client_pool: ClientPool,
+        ttl: int = 3600,
+        refresh_margin: int = 300,
+        retry_interval: int = 600
+    ) -> None:
+        """初始化缓存管理器
+
+        Args:
+            client_pool: 共享的客户端池
+            ttl: 缓存存活秒数
+            refresh_margin: 剩余存活时间低于该值时续期
+            retry_interval: 创建失败后再次尝试的间隔秒数
+        """
+        self.client_pool = client_pool
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.entries: Dict[Tuple[Hashable, str], GeminiCacheEntry] = {}
+        self.prune_time = 0.0
+
+    async def get_cached_content(
+        self,
+        api_key: str,
+        model: str,
+        cache_key: Hashable,
+        prefix_messages: List[Dict[str, Any]]
+    ) -> Optional[str]:
+        """获取静态前缀对应的缓存名称,必要时创建或续期
+
+        Args:
+            api_key: API密钥
+            model: 模型名称
+            cache_key: 缓存键,通常为(预设名, 角色名)
+            prefix_messages: 不依赖用户昵称的静态前缀消息列表
+
+        Returns:
+            Optional[str]: 缓存名称,不可用时返回None
+        """
+        if not prefix_messages:
+            return None
+        now = time.time()
+        if now >= self.prune_time:
+            self.prune(now)
+        entry_key = (cache_key, model)
+        digest = hashlib.sha256(
+            json.dumps(prefix_messages, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        entry = self.entries.get(entry_key)
+        if entry is None:
+            entry = self.entries[entry_key] = GeminiCacheEntry(digest)
+        elif entry.digest == digest:
+            content = entry.contents.get(api_key)
+            if content is not None and content.name and content.expire_time - now > self.refresh_margin:
+                return content.name
+
+        async with entry.lock:
+            if entry.digest != digest:
+                await self._delete_contents(entry)
+                entry.digest = digest
+            now = time.time()
+            content = entry.contents.get(api_key)
+            if content is not None:
+                if not content.name:
+                    if now < content.retry_time:
+                        return None
+                elif content.expire_time - now > self.refresh_margin:
+                    return content.name
+                elif content.expire_time > now and await self._refresh(api_key, content):
+                    return content.name
+
+            content = await self._create(api_key, model, prefix_messages)
+            entry.contents[api_key] = content
+            return content.name or None
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """移除已过期的缓存内容和没有缓存内容的条目
+
+        过期的缓存内容已由服务端删除,只需从本地移除。
+
+        Args:
+            now: 当前时间(time.time()),为None时使用当前时间
+
+        Returns:
+            int: 移除的缓存内容数
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for entry_key, entry in list(self.entries.items()):
+            if entry.lock.locked():
+                continue
+            for api_key, content in list(entry.contents.items()):
+                if content.is_stale(now):
+                    del entry.contents[api_key]
+                    removed += 1
+            if not entry.contents:
+                del self.entries[entry_key]
+        self.prune_time = now + self.refresh_margin
+        return removed
+
+    async def _create(
+        self,
+        api_key: str,
+        model: str,
+        prefix_messages: List[Dict[str, Any]]
+    ) -> GeminiCachedContent:
+        """创建缓存内容
+
+        Args:
+            api_key: API密钥
+            model: 模型名称
+            prefix_messages: 静态前缀消息列表
+
+        Returns:
+            GeminiCachedContent: 新的缓存内容,失败时名称为空
+        """
+        system_text = "\n\n".join(
+            message["content"] for message in prefix_messages
+            if message["role"] == "system"
+        )
+        contents = [
+            {
+                "role": "model" if message["role"] == "assistant" else "user",
+                "parts": [{"text": message["content"]}]
+            }
+            for message in prefix_messages
+            if message["role"] != "system"
+        ]
+        body: Dict[str, Any] = {
+            "model": model if model.startswith("models/") else f"models/{model}",
+            "contents": contents,
+            "ttl": f"{self.ttl}s"
+        }
+        if system_text:
+            body["systemInstruction"] = {"parts": [{"text": system_text}]}
+
+        try:
+            response = await self.client_pool.get_http_client().post(
+                f"{GEMINI_NATIVE_URL}/cachedContents",
+                params={"key": api_key},
+                json=body
+            )
+            response.raise_for_status()
+            name = response.json()["name"]
+            print(f"已创建Gemini缓存: {name}")
+            return GeminiCachedContent(name, time.time() + self.ttl)
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            print(f"创建Gemini缓存失败,{self.retry_interval}秒内不再尝试: {e}")
+            return GeminiCachedContent("", 0.0, time.time() + self.retry_interval)
+
+    async def _refresh(self, api_key: str, content: GeminiCachedContent) -> bool:
+        """续期缓存内容
+
+        Args:
+            api_key: API密钥
+            content: 缓存内容
+
+        Returns:
+            bool: 是否续期成功
+        """
+        try:
+            response = await self.client_pool.get_http_client().patch(
+                f"{GEMINI_NATIVE_URL}/{content.name}",
+                params={"key": api_key, "updateMask": "ttl"},
+                json={"ttl": f"{self.ttl}s"}
+            )
+            response.raise_for_status()
+            content.expire_time = time.time() + self.ttl
+            return True
+        except httpx.HTTPError as e:
+            print(f"续期Gemini缓存失败: {e}")
+            return False
+
+    async def _delete(self, api_key: str, name: str) -> None:
+        """删除缓存内容
+
+        Args:
+            api_key: API密钥
+            name: 缓存名称
+        """
+        try:
+            response = await self.client_pool.get_http_client().delete(
+                f"{GEMINI_NATIVE_URL}/{name}",
+                params={"key": api_key}
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"删除Gemini缓存失败: {e}")
+
+    async def _delete_contents(self, entry: GeminiCacheEntry) -> None:
+        """删除条目中所有未过期的缓存内容
+
+        Args:
+            entry: 缓存条目
+        """
+        now = time.time()
+        for api_key, content in entry.contents.items():
+            if content.name and content.expire_time > now:
+                await self._delete(api_key, content.name)
+        entry.contents.clear()
+
+    async def expire(self, cache_key: Optional[Hashable] = None) -> None:
+        """删除缓存内容
+
+        Args:
+            cache_key: 仅删除该缓存键的条目,为None时删除全部
+        """
+        for entry_key in list(self.entries):
+            if cache_key is not None and entry_key[0] != cache_key:
+                continue
+            entry = self.entries.pop(entry_key)
+            async with entry.lock:
+                await self._delete_contents(entry)
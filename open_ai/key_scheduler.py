@@ -0,0 +1,300 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Any, Iterable
+
+
+class TokenBucket:
+    """令牌桶,用于限制单个密钥的请求速率
+
+    Attributes:
+        capacity (float): 桶容量,为0表示不限制
+        rate (float): 每秒补充的令牌数
+        tokens (float): 当前令牌数
+        updated (float): 上次补充的时间
+    """
+
+    def __init__(self, capacity: float, period: float) -> None:
+        """初始化令牌桶
+
+        Args:
+            capacity: 每个周期允许的请求数,为0表示不限制
+            period: 周期秒数
+        """
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period if period > 0 else 0.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        """按经过的时间补充令牌"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """获取距离下一个可用令牌的等待秒数
+
+        Args:
+            now: 当前时间(time.monotonic())
+
+        Returns:
+            float: 等待秒数,可立即使用时为0
+        """
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        """消耗一个令牌
+
+        Args:
+            now: 当前时间(time.monotonic())
+        """
+        if self.capacity <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+
+class KeyState:
+    """单个API密钥的健康状态
+
+    Attributes:
+        key (str): API密钥
+        rpm_bucket (TokenBucket): 每分钟请求数限制
+        rpd_bucket (TokenBucket): 每天请求数限制
+        cooldown_until (float): 冷却结束时间
+        in_flight (int): 正在进行的请求数
+        ewma_latency (float): 延迟的指数加权平均(秒)
+        ewma_error (float): 错误率的指数加权平均
+        total_requests (int): 累计请求数
+        rate_limited (int): 累计429次数
+    """
+
+    def __init__(self, key: str, rpm: int, rpd: int) -> None:
+        """初始化密钥状态
+
+        Args:
+            key: API密钥
+            rpm: 每分钟请求数限制,0表示不限制
+            rpd: 每天请求数限制,0表示不限制
+        """
+        self.key = key
+        self.rpm_bucket = TokenBucket(rpm, 60)
+        self.rpd_bucket = TokenBucket(rpd, 86400)
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.ewma_latency = 0.0
+        self.ewma_error = 0.0
+        self.total_requests = 0
+        self.rate_limited = 0
+
+    def wait_time(self, now: float) -> float:
+        """获取该密钥可再次使用前需要等待的秒数
+
+        Args:
+            now: 当前时间(time.monotonic())
+
+        Returns:
+            float: 等待秒数
+        """
+        return max(
+            self.cooldown_until - now,
+            self.rpm_bucket.wait_time(now),
+            self.rpd_bucket.wait_time(now),
+            0.0
+        )
+
+    def score(self) -> float:
+        """计算调度分数,越低越优先
+
+        Returns:
+            float: 调度分数
+        """
+        latency = self.ewma_latency or 1.0
+        return latency * (1 + self.in_flight) * (1 + 4 * self.ewma_error)
+
+
+class KeyScheduler:
+    """多密钥调度器,按健康分数为并发请求分配API密钥
+
+    每个密钥有独立的RPM/RPD令牌桶,收到429后进入冷却,并以延迟和错误率的
+    指数加权平均计算分数。请求在获取密钥后一直固定使用该密钥直到释放。
+
+    Attributes:
+        states (Dict[str, KeyState]): 密钥到状态的映射
+        rpm (int): 每个密钥的每分钟请求数限制
+        rpd (int): 每个密钥的每天请求数限制
+        cooldown (float): 429后默认冷却秒数
+        alpha (float): 指数加权平均系数
+        max_wait (float): 获取密钥时最长等待秒数
+    """
+
+    def __init__(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        rpm: int = 0,
+        rpd: int = 0,
+        cooldown: float = 60.0,
+        alpha: float = 0.3,
+        max_wait: float = 60.0
+    ) -> None:
+        """初始化调度器
+
+        Args:
+            keys: API密钥列表
+            rpm: 每个密钥的每分钟请求数限制,0表示不限制
+            rpd: 每个密钥的每天请求数限制,0表示不限制
+            cooldown: 429后默认冷却秒数
+            alpha: 指数加权平均系数
+            max_wait: 获取密钥时最长等待秒数
+        """
+        self.states: Dict[str, KeyState] = {}
+        self.rpm = rpm
+        self.rpd = rpd
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.max_wait = max_wait
+        self.set_keys(keys or [])
+
+    def set_keys(self, keys: Iterable[str], rpm: Optional[int] = None, rpd: Optional[int] = None) -> None:
+        """更新密钥列表,保留已有密钥的状态
+
+        Args:
+            keys: API密钥列表
+            rpm: 新的每分钟请求数限制,为None时保持不变
+            rpd: 新的每天请求数限制,为None时保持不变
+        """
+        limits_changed = (
+            (rpm is not None and rpm != self.rpm) or
+            (rpd is not None and rpd != self.rpd)
+        )
+        if rpm is not None:
+            self.rpm = rpm
+        if rpd is not None:
+            self.rpd = rpd
+
+        states = {}
+        for key in keys:
+            if not key or key in states:
+                continue
+            state = self.states.get(key)
+            if state is None or limits_changed:
+                new_state = KeyState(key, self.rpm, self.rpd)
+                if state is not None:
+                    new_state.cooldown_until = state.cooldown_until
+                    new_state.in_flight = state.in_flight
+                    new_state.ewma_latency = state.ewma_latency
+                    new_state.ewma_error = state.ewma_error
+                    new_state.total_requests = state.total_requests
+                    new_state.rate_limited = state.rate_limited
+                state = new_state
+            states[key] = state
+        self.states = states
+
+    def has_keys(self) -> bool:
+        """是否配置了密钥
+
+        Returns:
+            bool: 是否至少有一个密钥
+        """
+        return bool(self.states)
+
+    async def acquire(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """获取当前最优的可用密钥,没有可用密钥时等待
+
+        Args:
+            exclude: 本次请求不希望再使用的密钥
+
+        Returns:
+            Optional[str]: API密钥,未配置密钥时返回None
+
+        Raises:
+            TimeoutError: 等待可用密钥超时
+        """
+        if not self.states:
+            return None
+        excluded = set(exclude)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            candidates = [
+                state for state in self.states.values()
+                if state.key not in excluded
+            ] or list(self.states.values())
+
+            best: Optional[KeyState] = None
+            shortest_wait = float("inf")
+            for state in candidates:
+                wait = state.wait_time(now)
+                if wait > 0:
+                    shortest_wait = min(shortest_wait, wait)
+                    continue
+                if best is None or state.score() < best.score():
+                    best = state
+
+            if best is not None:
+                best.rpm_bucket.consume(now)
+                best.rpd_bucket.consume(now)
+                best.in_flight += 1
+                best.total_requests += 1
+                return best.key
+
+            if now + shortest_wait > deadline:
+                raise TimeoutError(f"所有API密钥都在冷却或已达到速率限制,需等待{shortest_wait:.0f}秒")
+            await asyncio.sleep(min(shortest_wait, 1.0))
+
+    def release(
+        self,
+        key: Optional[str],
+        latency: Optional[float] = None,
+        error: bool = False,
+        rate_limited: bool = False,
+        retry_after: Optional[float] = None
+    ) -> None:
+        """释放密钥并记录本次请求的结果
+
+        Args:
+            key: acquire返回的密钥
+            latency: 请求耗时秒数,成功时提供
+            error: 请求是否失败
+            rate_limited: 是否收到429
+            retry_after: 服务端要求的重试等待秒数
+        """
+        state = self.states.get(key) if key else None
+        if state is None:
+            return
+        state.in_flight = max(0, state.in_flight - 1)
+        failed = error or rate_limited
+        state.ewma_error = (1 - self.alpha) * state.ewma_error + self.alpha * (1.0 if failed else 0.0)
+        if latency is not None:
+            if state.ewma_latency:
+                state.ewma_latency = (1 - self.alpha) * state.ewma_latency + self.alpha * latency
+            else:
+                state.ewma_latency = latency
+        if rate_limited:
+            state.rate_limited += 1
+            state.cooldown_until = time.monotonic() + (retry_after or self.cooldown)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """获取每个密钥的调度状态
+
+        Returns:
+            List[Dict[str, Any]]: 密钥状态列表,密钥只显示末四位
+        """
+        now = time.monotonic()
+        return [
+            {
+                "key": f"...{state.key[-4:]}",
+                "in_flight": state.in_flight,
+                "cooldown": round(max(0.0, state.cooldown_until - now), 1),
+                "ewma_latency": round(state.ewma_latency, 3),
+                "ewma_error": round(state.ewma_error, 3),
+                "total_requests": state.total_requests,
+                "rate_limited": state.rate_limited,
+                "score": round(state.score(), 3)
+            }
+            for state in self.states.values()
+        ]
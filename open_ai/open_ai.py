@@ -1,8 +1,80 @@
 import asyncio
 import json
+import re
+import time
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Union
-from openai import OpenAI, RateLimitError, APIError
+from typing import AsyncIterator, Hashable, List, Dict, Any, Optional, Tuple, Union
+import httpx
+from openai import RateLimitError, APIError, APIStatusError
+
+from . import chat_request, claude
+from .chat_request import PayloadEncoder
+from .client_pool import ClientPool
+from .gemini_cache import GeminiCacheManager
+from .key_scheduler import KeyScheduler
+from ..messages.token_counter import TokenCounter
+from ..preset.generation import GenerationProfile, GenerationSettings
+from ..util.metrics import Metrics
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
+CONTEXT_OVERFLOW_PATTERN = re.compile(
+    r"context_length_exceeded|maximum context length|context length|prompt is too long|"
+    r"exceeds the maximum number of tokens|too many tokens|input is too long",
+    re.I
+)
+
+
+class ContextOverflowError(Exception):
+    """提示超出模型上下文长度
+
+    只在尚未产出任何回复内容时抛出,调用方可以缩减上下文预算后重新构造消息重试。
+
+    Attributes:
+        limit (Optional[int]): 错误信息中给出的上下文上限
+    """
+
+    def __init__(self, message: str) -> None:
+        """初始化错误
+
+        Args:
+            message: 服务端返回的错误信息
+        """
+        super().__init__(message)
+        numbers = [int(number) for number in re.findall(r"\d{4,}", message)]
+        self.limit: Optional[int] = min(numbers) if numbers else None
+
+    def reduce_budget(self, sent_tokens: int, factor: float = 0.75) -> int:
+        """根据本次发送的token数计算重试时的预算
+
+        Args:
+            sent_tokens: 本次发送的提示token数(本地估算)
+            factor: 缩减比例
+
+        Returns:
+            int: 新的token预算
+        """
+        budget = min(sent_tokens, self.limit) if self.limit else sent_tokens
+        return max(int(budget * factor), 1)
+
+
+class StreamError(Exception):
+    """流式回复中途或开始前出错
+
+    与回复文本分开抛出,调用方可以只保存已收到的回复,并将错误作为单独的提示发送。
+
+    Attributes:
+        received (bool): 出错前是否已经产出过回复片段
+    """
+
+    def __init__(self, message: str, received: bool = False) -> None:
+        """初始化错误
+
+        Args:
+            message: 错误信息
+            received: 出错前是否已经产出过回复片段
+        """
+        super().__init__(message)
+        self.received = received
 
 
 ##
@@ -22,13 +94,31 @@ class OpenAi:
         module (str): 模型名称
         max_tokens (int): 最大生成token数
         temperature (float): 采样温度
-        current_key_index (int): 当前API密钥索引
+        key_scheduler (KeyScheduler): 多密钥调度器
+        gemini_cache (GeminiCacheManager): Gemini缓存内容管理器
+        gemini_context_cache (bool): 是否使用Gemini缓存内容
+        metrics (Metrics): token用量指标
+        token_counter (Optional[TokenCounter]): 根据实际用量校准的token计数器
         max_retries (int): 最大重试次数
         retry_delay (int): 重试延迟秒数
+        client_pool (ClientPool): 复用连接的异步客户端池
+        payload_encoder (PayloadEncoder): 缓存静态前缀编码结果的请求体编码器
+        request_gzip (bool): 是否gzip压缩OpenAI兼容接口的请求体,只用于支持压缩请求的代理
+        generation_parameters (Optional[List[str]]): 发送的预设采样参数名称,为None时按来源选择
+        default_generation (GenerationSettings): 会话未设置预设生成设置时使用的默认设置
     """
 
-    def __init__(self) -> None:
-        """初始化OpenAI客户端"""
+    def __init__(
+        self,
+        metrics: Optional[Metrics] = None,
+        token_counter: Optional[TokenCounter] = None
+    ) -> None:
+        """初始化OpenAI客户端
+        
+        Args:
+            metrics: 记录token用量的指标记录器
+            token_counter: 根据服务端返回的用量校准的token计数器
+        """
         self.config_path = Path(__file__).parent / "../config/completion_configs"
         
         # 默认配置
@@ -38,9 +128,18 @@ class OpenAi:
         self.module = ""
         self.max_tokens = 1000
         self.temperature = 0.8
-        self.current_key_index = 0
         self.max_retries = 10
         self.retry_delay = 3
+        self.client_pool = ClientPool()
+        self.payload_encoder = PayloadEncoder()
+        self.request_gzip = False
+        self.generation_parameters: Optional[List[str]] = None
+        self.default_generation = GenerationSettings()
+        self.key_scheduler = KeyScheduler()
+        self.gemini_cache = GeminiCacheManager(self.client_pool)
+        self.gemini_context_cache = False
+        self.metrics = metrics or Metrics()
+        self.token_counter = token_counter
 
         # 加载配置
         self.from_json()
@@ -72,6 +171,7 @@ class OpenAi:
         """
         self.api_keys = [key]
         self.to_json("api_keys", self.api_keys)
+        self.key_scheduler.set_keys(self.api_keys)
 
     def set_api_keys(self, keys: List[str]) -> None:
         """设置多个API密钥
@@ -81,6 +181,7 @@ class OpenAi:
         """
         self.api_keys = keys
         self.to_json("api_keys", keys)
+        self.key_scheduler.set_keys(self.api_keys)
 
     def set_module(self, module: str) -> None:
         """设置模型名称
@@ -181,6 +282,16 @@ class OpenAi:
             self.temperature = config.get("temperature", 0.8)
             self.max_retries = config.get("max_retries", 10)
             self.retry_delay = config.get("retry_delay", 5)
+            self.key_scheduler.cooldown = config.get("key_cooldown", self.retry_delay)
+            self.key_scheduler.set_keys(
+                self.api_keys,
+                rpm=config.get("key_rpm", 0),
+                rpd=config.get("key_rpd", 0)
+            )
+            self.gemini_context_cache = config.get("gemini_context_cache", False)
+            self.gemini_cache.ttl = config.get("gemini_cache_ttl", 3600)
+            self.request_gzip = config.get("request_gzip", False)
+            self.generation_parameters = config.get("generation_parameters")
             
             return config
             
@@ -188,180 +299,721 @@ class OpenAi:
             print(f"错误: 配置文件 '{self.chat_completion_source}' 格式错误,请检查JSON格式")
             return {}
 
+    def get_generation_profile(self, generation: Optional[GenerationSettings] = None) -> GenerationProfile:
+        """将会话预设的生成设置与当前的聊天补全配置合并
+        
+        Args:
+            generation: 会话预设的生成设置,为None时使用默认设置
+            
+        Returns:
+            GenerationProfile: 生成参数
+        """
+        return (generation or self.default_generation).resolve(
+            self.chat_completion_source,
+            self.module,
+            self.max_tokens,
+            self.temperature,
+            self.generation_parameters
+        )
+
     async def start_chat(
         self,
-        messages: List[Dict[str, str]]
+        messages: List[Dict[str, str]],
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None,
+        generation: Optional[GenerationSettings] = None,
+        shared_prefix_length: Optional[int] = None
     ) -> str:
         """启动聊天会话
         
         Args:
             messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键,通常为(预设名, 角色名)
+            generation: 会话预设的生成设置
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
             
         Returns:
             str: 回复消息
         """
+        profile = self.get_generation_profile(generation)
         match self.chat_completion_source.lower():
             case "openai":
-                return await self.chat_with_openai(messages)
+                return await self.chat_with_openai(
+                    messages, None, static_prefix_length, cache_key, profile, shared_prefix_length
+                )
             case "claude":
-                return await self.chat_with_claude(messages)
+                return await self.chat_with_claude(messages, static_prefix_length, profile)
             case "google ai studio":
-                return await self.chat_with_gemini(messages)
+                return await self.chat_with_gemini(
+                    messages, static_prefix_length, cache_key, profile, shared_prefix_length
+                )
             case "deepseek":
-                return await self.chat_with_openai(messages)
+                return await self.chat_with_openai(
+                    messages, None, static_prefix_length, cache_key, profile, shared_prefix_length
+                )
             case _:
                 print(f"警告: 未知的聊天补全来源 '{self.chat_completion_source}',默认使用OpenAI")
-                return await self.chat_with_openai(messages)
+                return await self.chat_with_openai(
+                    messages, None, static_prefix_length, cache_key, profile, shared_prefix_length
+                )
 
     async def chat_with_openai(
         self,
-        messages: List[Dict[str, str]]
+        messages: List[Dict[str, str]],
+        base_url: Optional[str] = None,
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None,
+        profile: Optional[GenerationProfile] = None,
+        shared_prefix_length: Optional[int] = None
     ) -> str:
-        """使用OpenAI API进行聊天
+        """使用OpenAI兼容接口进行聊天,由密钥调度器分配API密钥
         
         Args:
             messages: 消息列表
+            base_url: API基础URL,默认使用配置中的api_url
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            profile: 生成参数,为None时使用默认设置与配置合并的结果
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
             
         Returns:
             str: 回复消息
-            
-        Raises:
-            RateLimitError: 达到速率限制
-            APIError: API调用错误
         """
+        base_url = base_url or self.api_url or "https://api.openai.com/v1"
+        profile = profile or self.get_generation_profile()
         retries = 0
+        failed_keys: List[str] = []
         while retries <= self.max_retries:
             try:
-                client = OpenAI(
-                    api_key=self.api_keys[0] if self.api_keys else None,
-                    base_url=self.api_url or "https://api.openai.com/v1"
-                )
+                api_key = await self.key_scheduler.acquire(exclude=failed_keys)
+            except TimeoutError as e:
+                print(f"{self.chat_completion_source}密钥调度失败: {e}")
+                return f"错误: {e}"
 
-                response = client.chat.completions.create(
-                    model=self.module,
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature,
-                    extra_headers={"Content-Type": "application/json"}
+            start = time.perf_counter()
+            try:
+                body = await self.build_chat_body(
+                    messages, base_url, api_key, static_prefix_length, cache_key, profile,
+                    shared_prefix_length=shared_prefix_length
                 )
+                response = await self.send_chat_request(base_url, api_key, body)
+                data = response.json()
 
-                msg = response.choices[0].message.content
+                self.key_scheduler.release(api_key, latency=time.perf_counter() - start)
+                msg = chat_request.get_message_text(data)
                 #print(msg)
-                print_usage_info(response.usage)
+                self.record_usage(chat_request.parse_usage(data.get("usage")), messages)
                 return msg
 
             except RateLimitError as e:
+                self.key_scheduler.release(api_key, rate_limited=True, retry_after=get_retry_after(e))
                 retries += 1
                 if retries > self.max_retries:
-                    print(f"OpenAI速率限制错误: 达到最大重试次数。错误: {e}")
-                    return f"错误: OpenAI速率限制 - 超过最大重试次数。最后错误: {e}"
-                    
-                print(f"OpenAI速率限制错误: {self.retry_delay}秒后重试... (重试 {retries}/{self.max_retries})")
-                await asyncio.sleep(self.retry_delay)
+                    print(f"{self.chat_completion_source}速率限制错误({mask_key(api_key)}): 达到最大重试次数。错误: {e}")
+                    return f"错误: {self.chat_completion_source}速率限制 - 超过最大重试次数。最后错误: {e}"
+
+                print(f"{self.chat_completion_source}速率限制错误({mask_key(api_key)}): 切换密钥重试... (重试 {retries}/{self.max_retries})")
                 continue
 
+            except APIStatusError as e:
+                self.key_scheduler.release(api_key, error=True)
+                if is_context_overflow(e.status_code, str(e)):
+                    raise ContextOverflowError(str(e)) from e
+                if e.status_code in (401, 403) or e.status_code >= 500:
+                    retries += 1
+                    if api_key:
+                        failed_keys.append(api_key)
+                    if retries <= self.max_retries and len(failed_keys) < len(self.key_scheduler.states):
+                        print(f"{self.chat_completion_source} API错误({mask_key(api_key)}): {e},尝试下一个API密钥...")
+                        continue
+                print(f"{self.chat_completion_source} API错误({mask_key(api_key)}): {e}")
+                return f"错误: {self.chat_completion_source} API - {e}"
             except APIError as e:
-                print(f"OpenAI API错误: {e}")
-                return f"错误: OpenAI API - {e}"
+                self.key_scheduler.release(api_key, error=True)
+                print(f"{self.chat_completion_source} API错误: {e}")
+                return f"错误: {self.chat_completion_source} API - {e}"
+            except asyncio.CancelledError:
+                self.key_scheduler.release(api_key)
+                raise
             except Exception as e:
-                print(f"OpenAI聊天时发生意外错误: {e}")
+                self.key_scheduler.release(api_key, error=True)
+                print(f"{self.chat_completion_source}聊天时发生意外错误: {e}")
                 return f"错误: 意外 - {e}"
 
     async def chat_with_gemini(
         self,
-        messages: List[Dict[str, str]]
+        messages: List[Dict[str, str]],
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None,
+        profile: Optional[GenerationProfile] = None,
+        shared_prefix_length: Optional[int] = None
     ) -> str:
-        """使用Google AI Studio (Gemini) API进行聊天
+        """使用Google AI Studio (Gemini) API进行聊天,多个密钥由调度器并行使用
         
         Args:
             messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            profile: 生成参数
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
             
         Returns:
             str: 回复消息
-            
-        Raises:
-            RateLimitError: 达到速率限制
-            APIError: API调用错误
         """
         if not self.api_keys:
             return "错误: 未提供Google AI Studio的API密钥"
+        return await self.chat_with_openai(
+            messages, GEMINI_BASE_URL, static_prefix_length, cache_key, profile, shared_prefix_length
+        )
 
-        for index in range(len(self.api_keys)):
-            api_key = self.api_keys[
-                (self.current_key_index + index) % len(self.api_keys)
-            ]
-            retries = 0
-            
-            while retries <= self.max_retries:
+    async def stream_chat(
+        self,
+        messages: List[Dict[str, str]],
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None,
+        generation: Optional[GenerationSettings] = None,
+        shared_prefix_length: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """以流式方式启动聊天会话,逐段产出回复文本
+
+        Args:
+            messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            generation: 会话预设的生成设置
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
+
+        Yields:
+            str: 回复文本片段
+
+        Raises:
+            StreamError: 回复开始前或中途出错
+        """
+        profile = self.get_generation_profile(generation)
+        match self.chat_completion_source.lower():
+            case "claude":
+                async for text in self.stream_with_claude(messages, static_prefix_length, profile):
+                    yield text
+            case "google ai studio":
+                if not self.api_keys:
+                    raise StreamError("未提供Google AI Studio的API密钥")
+                async for text in self.stream_with_openai(
+                    messages, GEMINI_BASE_URL, static_prefix_length, cache_key, profile, shared_prefix_length
+                ):
+                    yield text
+            case _:
+                async for text in self.stream_with_openai(
+                    messages, None, static_prefix_length, cache_key, profile, shared_prefix_length
+                ):
+                    yield text
+
+    async def stream_with_openai(
+        self,
+        messages: List[Dict[str, str]],
+        base_url: Optional[str] = None,
+        static_prefix_length: int = 0,
+        cache_key: Optional[Hashable] = None,
+        profile: Optional[GenerationProfile] = None,
+        shared_prefix_length: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """使用OpenAI兼容接口进行流式聊天
+
+        整个流固定使用同一个密钥;只在收到第一个片段之前因速率限制或401/403/5xx切换密钥重试,
+        避免重复输出已发送的内容。
+
+        Args:
+            messages: 消息列表
+            base_url: API基础URL,默认使用配置中的api_url
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            profile: 生成参数,为None时使用默认设置与配置合并的结果
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
+
+        Yields:
+            str: 回复文本片段
+
+        Raises:
+            StreamError: 回复开始前或中途出错,已产出的片段不会重复产出
+        """
+        base_url = base_url or self.api_url or "https://api.openai.com/v1"
+        profile = profile or self.get_generation_profile()
+        retries = 0
+        received = False
+        failed_keys: List[str] = []
+        while retries <= self.max_retries:
+            try:
+                api_key = await self.key_scheduler.acquire(exclude=failed_keys)
+            except TimeoutError as e:
+                print(f"{self.chat_completion_source}密钥调度失败: {e}")
+                raise StreamError(str(e), received) from e
+
+            start = time.perf_counter()
+            try:
+                body = await self.build_chat_body(
+                    messages, base_url, api_key, static_prefix_length, cache_key, profile,
+                    stream=True, shared_prefix_length=shared_prefix_length
+                )
+                response = await self.send_chat_request(base_url, api_key, body, stream=True)
                 try:
-                    client = OpenAI(
-                        api_key=api_key,
-                        base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
-                    )
-
-                    response = client.chat.completions.create(
-                        model=self.module,
-                        messages=messages,
-                        max_tokens=self.max_tokens,
-                        temperature=self.temperature,
-                        extra_headers={"Content-Type": "application/json"}
-                    )
-
-                    msg = response.choices[0].message.content
-                    print_usage_info(response.usage)
-                    self.current_key_index = (
-                        self.current_key_index + index
-                    ) % len(self.api_keys)
-                    return msg
-
-                except RateLimitError as e:
-                    retries += 1
-                    if retries > self.max_retries:
-                        print(
-                            f"Gemini速率限制错误(密钥索引 {(self.current_key_index + index) % len(self.api_keys)}): "
-                            f"达到最大重试次数。错误: {e}"
-                        )
-                        break
-                        
-                    print(
-                        f"Gemini速率限制错误(密钥索引 {(self.current_key_index + index) % len(self.api_keys)}): "
-                        f"{self.retry_delay}秒后重试... (重试 {retries}/{self.max_retries})"
-                    )
-                    await asyncio.sleep(self.retry_delay)
-                    continue
+                    async for chunk in chat_request.iter_sse_chunks(response):
+                        usage = chat_request.parse_usage(chunk.get("usage"))
+                        if usage is not None:
+                            self.record_usage(usage, messages)
+                        text = chat_request.get_delta_text(chunk)
+                        if text:
+                            received = True
+                            yield text
+                except httpx.HTTPError as e:
+                    raise chat_request.wrap_transport_error(e, response.request) from e
+                finally:
+                    await response.aclose()
+                self.key_scheduler.release(api_key, latency=time.perf_counter() - start)
+                return
 
-                except APIError as e:
-                    print(
-                        f"Gemini API错误(密钥索引 {(self.current_key_index + index) % len(self.api_keys)}): {e}"
-                    )
-                    if index == len(self.api_keys) - 1:
-                        return f"错误: Gemini API - 所有API密钥都失败。最后错误: {e}"
-                    print("尝试下一个API密钥...")
-                    break
-                    
-                except Exception as e:
-                    print(f"Gemini聊天时发生意外错误: {e}")
-                    return f"错误: 意外 - {e}"
-            else:
+            except RateLimitError as e:
+                self.key_scheduler.release(api_key, rate_limited=True, retry_after=get_retry_after(e))
+                retries += 1
+                if received or retries > self.max_retries:
+                    print(f"流式速率限制错误({mask_key(api_key)}): 达到最大重试次数。错误: {e}")
+                    raise StreamError(f"速率限制 - 超过最大重试次数。最后错误: {e}", received) from e
+
+                print(f"流式速率限制错误({mask_key(api_key)}): 切换密钥重试... (重试 {retries}/{self.max_retries})")
                 continue
-                
-            if index == len(self.api_keys) - 1:
-                return "错误: Gemini API - 所有API密钥在多次重试后都失败"
+
+            except APIError as e:
+                self.key_scheduler.release(api_key, error=True)
+                if not received and isinstance(e, APIStatusError):
+                    if is_context_overflow(e.status_code, str(e)):
+                        raise ContextOverflowError(str(e)) from e
+                    if e.status_code in (401, 403) or e.status_code >= 500:
+                        retries += 1
+                        if api_key:
+                            failed_keys.append(api_key)
+                        if retries <= self.max_retries and len(failed_keys) < len(self.key_scheduler.states):
+                            print(f"流式API错误({mask_key(api_key)}): {e},尝试下一个API密钥...")
+                            continue
+                print(f"流式API错误({mask_key(api_key)}): {e}")
+                raise StreamError(f"API - {e}", received) from e
+            except (GeneratorExit, asyncio.CancelledError):
+                self.key_scheduler.release(api_key)
+                raise
+            except Exception as e:
+                self.key_scheduler.release(api_key, error=True)
+                print(f"流式聊天时发生意外错误: {e}")
+                raise StreamError(f"意外 - {e}", received) from e
+
+    async def build_chat_body(
+        self,
+        messages: List[Dict[str, str]],
+        base_url: str,
+        api_key: Optional[str],
+        static_prefix_length: int,
+        cache_key: Optional[Hashable],
+        profile: GenerationProfile,
+        stream: bool = False,
+        shared_prefix_length: Optional[int] = None
+    ) -> bytes:
+        """构造chat/completions请求体
+
+        静态前缀按cache_key使用缓存的编码片段,只编码之后的消息;
+        使用Gemini缓存内容时静态前缀不在请求中,整体编码。
+
+        Args:
+            messages: 消息列表
+            base_url: API基础URL
+            api_key: 本次请求使用的API密钥
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            profile: 生成参数
+            stream: 是否为流式请求
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
+
+        Returns:
+            bytes: 请求体,启用request_gzip时为压缩后的内容
+        """
+        request_messages, extra_body = await self.prepare_cached_request(
+            messages, base_url, api_key, static_prefix_length, cache_key, shared_prefix_length
+        )
+        fields: Dict[str, Any] = dict(profile.fields)
+        if stream:
+            fields["stream"] = True
+        if extra_body:
+            fields.update(extra_body)
+        if request_messages is not messages:
+            static_prefix_length, cache_key = 0, None
+        body = self.payload_encoder.build_body(fields, request_messages, static_prefix_length, cache_key)
+        self.metrics.increase("request_body_bytes", len(body))
+        if self.request_gzip:
+            body = chat_request.compress_body(body)
+        self.metrics.increase("request_wire_bytes", len(body))
+        return body
+
+    async def send_chat_request(
+        self,
+        base_url: str,
+        api_key: Optional[str],
+        body: bytes,
+        stream: bool = False
+    ) -> httpx.Response:
+        """通过共享连接发送chat/completions请求
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            body: 请求体
+            stream: 是否为流式请求,为True时调用方负责关闭响应
+
+        Returns:
+            httpx.Response: 状态码正常的响应
+
+        Raises:
+            RateLimitError: 状态码为429
+            APIStatusError: 其他错误状态码
+            APIConnectionError: 连接失败或超时
+        """
+        http_client = self.client_pool.get_http_client()
+        request = http_client.build_request(
+            "POST",
+            chat_request.get_chat_url(base_url),
+            headers=chat_request.get_headers(api_key, self.request_gzip),
+            content=body
+        )
+        try:
+            response = await http_client.send(request, stream=stream)
+        except httpx.HTTPError as e:
+            raise chat_request.wrap_transport_error(e, request) from e
+        try:
+            await chat_request.raise_for_status(response)
+        except APIError:
+            await response.aclose()
+            raise
+        return response
+
+    async def prepare_cached_request(
+        self,
+        messages: List[Dict[str, str]],
+        base_url: str,
+        api_key: Optional[str],
+        static_prefix_length: int,
+        cache_key: Optional[Hashable],
+        shared_prefix_length: Optional[int] = None
+    ) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+        """在启用Gemini缓存时,用缓存内容替换静态前缀中不依赖用户昵称的部分
+
+        缓存内容已包含系统指令,请求中不能再出现system消息,
+        因此缓存内容之后的system消息会改为user消息发送。
+
+        Args:
+            messages: 消息列表
+            base_url: API基础URL
+            api_key: 本次请求使用的API密钥
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            cache_key: 静态前缀的缓存键
+            shared_prefix_length: 静态前缀开头不依赖用户昵称的消息数,Gemini缓存内容只包含这部分,为None时等于static_prefix_length
+
+        Returns:
+            Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]: (实际发送的消息列表, 额外请求体)
+        """
+        if shared_prefix_length is None:
+            shared_prefix_length = static_prefix_length
+        if not (
+            self.gemini_context_cache and base_url == GEMINI_BASE_URL and
+            api_key and cache_key is not None and shared_prefix_length
+        ):
+            return messages, None
+        cached_content = await self.gemini_cache.get_cached_content(
+            api_key, self.module, cache_key, messages[:shared_prefix_length]
+        )
+        if not cached_content:
+            return messages, None
+        request_messages = [
+            {"role": "user", "content": message["content"]} if message["role"] == "system" else message
+            for message in messages[shared_prefix_length:]
+        ]
+        return request_messages, {"extra_body": {"google": {"cached_content": cached_content}}}
+
+    def record_usage(self, usage: Any, messages: Optional[List[Dict[str, str]]] = None) -> None:
+        """打印并记录token使用量,包括命中服务端前缀缓存的token数
+        
+        Args:
+            usage: 使用量信息对象
+            messages: 本次请求的消息列表,用于校准token计数器
+        """
+        if usage is None:
+            return
+        print_usage_info(usage)
+        prompt_tokens = usage.prompt_tokens or 0
+        if messages and self.token_counter is not None:
+            self.token_counter.calibrate(messages, prompt_tokens)
+        cached_tokens = get_cached_tokens(usage)
+        self.metrics.increase("prompt_tokens", prompt_tokens)
+        self.metrics.increase("completion_tokens", usage.completion_tokens or 0)
+        self.metrics.increase("cached_prompt_tokens", cached_tokens)
+        cache_creation_tokens = getattr(usage, "cache_creation_input_tokens", None)
+        if cache_creation_tokens:
+            self.metrics.increase("cache_creation_prompt_tokens", cache_creation_tokens)
+        if prompt_tokens:
+            self.metrics.record("prompt_cache_hit_ratio", cached_tokens / prompt_tokens)
 
     async def chat_with_claude(
         self,
-        messages: List[Dict[str, str]]
+        messages: List[Dict[str, str]],
+        static_prefix_length: int = 0,
+        profile: Optional[GenerationProfile] = None
     ) -> str:
-        """使用Claude API进行聊天(占位)
+        """使用Claude Messages API进行聊天,静态前缀通过cache_control走提示缓存
         
         Args:
             messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            profile: 生成参数,为None时使用默认设置与配置合并的结果
             
         Returns:
             str: 回复消息
         """
-        print("警告: Claude集成是占位符,可能需要进一步实现才能完全功能")
-        return "此版本未完全实现Claude集成"
+        if not self.api_keys:
+            return "错误: 未提供Claude的API密钥"
+        profile = profile or self.get_generation_profile()
+        body = claude.build_claude_request(
+            messages, static_prefix_length, profile.model, profile.max_tokens, profile.temperature,
+            parameters=profile.parameters, assistant_prefill=profile.assistant_prefill
+        )
+        url = claude.get_messages_url(self.api_url)
+        retries = 0
+        failed_keys: List[str] = []
+        while retries <= self.max_retries:
+            try:
+                api_key = await self.key_scheduler.acquire(exclude=failed_keys)
+            except TimeoutError as e:
+                print(f"Claude密钥调度失败: {e}")
+                return f"错误: {e}"
+
+            start = time.perf_counter()
+            try:
+                response = await self.client_pool.get_http_client().post(
+                    url,
+                    headers=claude.get_headers(api_key),
+                    json=body
+                )
+                await claude.raise_for_status(response)
+                data = response.json()
+
+                self.key_scheduler.release(api_key, latency=time.perf_counter() - start)
+                self.record_usage(claude.parse_claude_usage(data.get("usage", {})), messages)
+                return claude.get_response_text(data)
+
+            except claude.ClaudeStatusError as e:
+                if e.rate_limited:
+                    self.key_scheduler.release(api_key, rate_limited=True, retry_after=e.retry_after)
+                    retries += 1
+                    if retries > self.max_retries:
+                        print(f"Claude速率限制错误({mask_key(api_key)}): 达到最大重试次数。错误: {e}")
+                        return f"错误: Claude速率限制 - 超过最大重试次数。最后错误: {e}"
+                    print(f"Claude速率限制错误({mask_key(api_key)}): 切换密钥重试... (重试 {retries}/{self.max_retries})")
+                    continue
+
+                self.key_scheduler.release(api_key, error=True)
+                if is_context_overflow(e.status_code, e.message):
+                    raise ContextOverflowError(e.message) from e
+                if e.status_code in (401, 403) or e.status_code >= 500:
+                    retries += 1
+                    if api_key:
+                        failed_keys.append(api_key)
+                    if retries <= self.max_retries and len(failed_keys) < len(self.key_scheduler.states):
+                        print(f"Claude API错误({mask_key(api_key)}): {e},尝试下一个API密钥...")
+                        continue
+                print(f"Claude API错误({mask_key(api_key)}): {e}")
+                return f"错误: Claude API - {e}"
+            except httpx.HTTPError as e:
+                self.key_scheduler.release(api_key, error=True)
+                print(f"Claude API错误: {e}")
+                return f"错误: Claude API - {e}"
+            except asyncio.CancelledError:
+                self.key_scheduler.release(api_key)
+                raise
+            except Exception as e:
+                self.key_scheduler.release(api_key, error=True)
+                print(f"Claude聊天时发生意外错误: {e}")
+                return f"错误: 意外 - {e}"
+        return "错误: Claude API - 超过最大重试次数"
+
+    async def stream_with_claude(
+        self,
+        messages: List[Dict[str, str]],
+        static_prefix_length: int = 0,
+        profile: Optional[GenerationProfile] = None
+    ) -> AsyncIterator[str]:
+        """使用Claude Messages API进行流式聊天
+
+        与stream_with_openai相同,整个流固定使用同一个密钥,
+        只在收到第一个片段之前因429/529或401/403/5xx切换密钥重试。
+
+        Args:
+            messages: 消息列表
+            static_prefix_length: 消息列表开头静态前缀的消息数
+            profile: 生成参数,为None时使用默认设置与配置合并的结果
+
+        Yields:
+            str: 回复文本片段
+
+        Raises:
+            StreamError: 回复开始前或中途出错,已产出的片段不会重复产出
+        """
+        if not self.api_keys:
+            raise StreamError("未提供Claude的API密钥")
+        profile = profile or self.get_generation_profile()
+        body = claude.build_claude_request(
+            messages, static_prefix_length, profile.model, profile.max_tokens, profile.temperature,
+            stream=True, parameters=profile.parameters, assistant_prefill=profile.assistant_prefill
+        )
+        url = claude.get_messages_url(self.api_url)
+        retries = 0
+        received = False
+        failed_keys: List[str] = []
+        while retries <= self.max_retries:
+            try:
+                api_key = await self.key_scheduler.acquire(exclude=failed_keys)
+            except TimeoutError as e:
+                print(f"Claude密钥调度失败: {e}")
+                raise StreamError(str(e), received) from e
+
+            start = time.perf_counter()
+            try:
+                async with self.client_pool.get_http_client().stream(
+                    "POST",
+                    url,
+                    headers=claude.get_headers(api_key),
+                    json=body
+                ) as response:
+                    await claude.raise_for_status(response)
+                    usage: Dict[str, Any] = {}
+                    async for event, data in claude.iter_sse_events(response):
+                        if event == "message_start":
+                            usage.update(data.get("message", {}).get("usage", {}))
+                        elif event == "content_block_delta":
+                            text = data.get("delta", {}).get("text")
+                            if text:
+                                received = True
+                                yield text
+                        elif event == "message_delta":
+                            usage.update(data.get("usage", {}))
+                        elif event == "error":
+                            error = data.get("error", {})
+                            raise claude.ClaudeStatusError(
+                                529 if error.get("type") == "overloaded_error" else 500,
+                                error.get("message", "")
+                            )
+                self.key_scheduler.release(api_key, latency=time.perf_counter() - start)
+                self.record_usage(claude.parse_claude_usage(usage), messages)
+                return
+
+            except claude.ClaudeStatusError as e:
+                if e.rate_limited and not received:
+                    self.key_scheduler.release(api_key, rate_limited=True, retry_after=e.retry_after)
+                    retries += 1
+                    if retries <= self.max_retries:
+                        print(f"Claude流式速率限制错误({mask_key(api_key)}): 切换密钥重试... (重试 {retries}/{self.max_retries})")
+                        continue
+                else:
+                    self.key_scheduler.release(api_key, error=True)
+                    if not received:
+                        if is_context_overflow(e.status_code, e.message):
+                            raise ContextOverflowError(e.message) from e
+                        if e.status_code in (401, 403) or e.status_code >= 500:
+                            retries += 1
+                            if api_key:
+                                failed_keys.append(api_key)
+                            if retries <= self.max_retries and len(failed_keys) < len(self.key_scheduler.states):
+                                print(f"Claude流式API错误({mask_key(api_key)}): {e},尝试下一个API密钥...")
+                                continue
+                print(f"Claude流式API错误({mask_key(api_key)}): {e}")
+                raise StreamError(f"Claude API - {e}", received) from e
+            except httpx.HTTPError as e:
+                self.key_scheduler.release(api_key, error=True)
+                print(f"Claude流式API错误: {e}")
+                raise StreamError(f"Claude API - {e}", received) from e
+            except (GeneratorExit, asyncio.CancelledError):
+                self.key_scheduler.release(api_key)
+                raise
+            except Exception as e:
+                self.key_scheduler.release(api_key, error=True)
+                print(f"Claude流式聊天时发生意外错误: {e}")
+                raise StreamError(f"意外 - {e}", received) from e
+
+    def get_key_stats(self) -> List[Dict[str, Any]]:
+        """获取密钥调度状态
+        
+        Returns:
+            List[Dict[str, Any]]: 每个密钥的调度状态
+        """
+        return self.key_scheduler.get_stats()
+
+    async def close(self) -> None:
+        """删除Gemini缓存内容并关闭客户端池中的所有连接"""
+        await self.gemini_cache.expire()
+        await self.client_pool.close()
+
+def get_retry_after(error: RateLimitError) -> Optional[float]:
+    """从429响应头中读取Retry-After秒数
+    
+    Args:
+        error: 速率限制错误
+        
+    Returns:
+        Optional[float]: 等待秒数,响应头缺失或无法解析时返回None
+    """
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_context_overflow(status_code: int, message: str) -> bool:
+    """判断错误是否为提示超出模型上下文长度
+    
+    Args:
+        status_code: HTTP状态码
+        message: 错误信息
+        
+    Returns:
+        bool: 是否为上下文超长错误
+    """
+    return status_code in (400, 413) and bool(CONTEXT_OVERFLOW_PATTERN.search(message))
+
+
+def mask_key(api_key: Optional[str]) -> str:
+    """隐藏API密钥,只保留末四位用于日志
+    
+    Args:
+        api_key: API密钥
+        
+    Returns:
+        str: 隐藏后的密钥
+    """
+    return f"...{api_key[-4:]}" if api_key else "无密钥"
+
+
+def get_cached_tokens(usage: Any) -> int:
+    """读取命中服务端前缀缓存的token数
+    
+    OpenAI和Gemini在prompt_tokens_details.cached_tokens中返回,
+    DeepSeek在prompt_cache_hit_tokens中返回,Claude在cache_read_input_tokens中返回。
+    
+    Args:
+        usage: 使用量信息对象
+        
+    Returns:
+        int: 缓存命中的token数
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    if cached_tokens is None:
+        cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached_tokens is None:
+        cached_tokens = getattr(usage, "cache_read_input_tokens", None)
+    return cached_tokens or 0
+
 
 def print_usage_info(usage: Any) -> None:
     """打印token使用信息
@@ -373,6 +1025,7 @@ def print_usage_info(usage: Any) -> None:
     print(f"  补全tokens: {usage.completion_tokens}")
     print(f"  提示tokens: {usage.prompt_tokens}")
     print(f"  总tokens: {usage.total_tokens}")
+    print(f"  缓存命中tokens: {get_cached_tokens(usage)}")
 
 
 if __name__=="__main__":
@@ -1,10 +1,76 @@
 import json
 import os
 from pathlib import Path
-from typing import Dict, List, Optional, Any, Union
+from typing import Dict, List, Optional, Any, Tuple, Union
 
 from click import prompt
 
+from .generation import GenerationSettings
+
+# 文件的(修改时间, 大小),用于判断缓存是否过期
+FileStamp = Tuple[int, int]
+
+
+def _file_stamp(path: Union[str, Path]) -> Optional[FileStamp]:
+    """获取文件的修改时间和大小
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        Optional[FileStamp]: (修改时间纳秒, 字节数),文件不存在时为None
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class CompiledPreset:
+    """编译后的预设,包含按提示词顺序解析好的提示词列表,由所有会话只读共享
+
+    Attributes:
+        preset_name (str): 预设名称
+        message_type (str): 消息类型
+        order_prompts (List[Any]): 排序后的提示词列表,标记为字符串
+        injection_prompts (List[Dict[str, Any]]): 插入聊天历史中的提示词(injection_position为1),包含role、content和depth
+        global_settings (Dict[str, Any]): 预设的全局设置
+        generation (GenerationSettings): 全局设置中与生成相关的设置
+        stamps (Tuple[Optional[FileStamp], Optional[FileStamp]]): 编译时预设文件和提示词顺序文件的状态
+    """
+
+    __slots__ = (
+        "preset_name", "message_type", "order_prompts", "injection_prompts", "global_settings", "generation", "stamps"
+    )
+
+    def __init__(
+        self,
+        preset_name: str,
+        message_type: str,
+        order_prompts: List[Any],
+        injection_prompts: List[Dict[str, Any]],
+        global_settings: Dict[str, Any],
+        stamps: Tuple[Optional[FileStamp], Optional[FileStamp]]
+    ) -> None:
+        """初始化编译后的预设
+
+        Args:
+            preset_name: 预设名称
+            message_type: 消息类型
+            order_prompts: 排序后的提示词列表
+            injection_prompts: 插入聊天历史中的提示词
+            global_settings: 预设的全局设置
+            stamps: 预设文件和提示词顺序文件的状态
+        """
+        self.preset_name = preset_name
+        self.message_type = message_type
+        self.order_prompts = order_prompts
+        self.injection_prompts = injection_prompts
+        self.global_settings = global_settings
+        self.generation = GenerationSettings(global_settings)
+        self.stamps = stamps
+
 
 class QLPresetManager():
     """预设管理器类,用于管理聊天预设配置
@@ -15,6 +81,10 @@ class QLPresetManager():
         default_preset_name (str): 默认预设名称
         script_dir (Path): 脚本所在目录
         preset_folder_path (Path): 预设文件夹路径
+        compiled_presets (Dict[Tuple[str, str], CompiledPreset]): (预设名称, 消息类型)到编译后预设的映射
+        json_cache (Dict[str, Tuple[FileStamp, Any]]): 文件路径到(文件状态, 解析结果)的映射
+        version (int): 预设配置的版本号,会话的预设选择改变或预设文件被替换时递增,
+            会话的版本号与其不同时重新取得预设
     """
 
     def __init__(self) -> None:
@@ -26,6 +96,10 @@ class QLPresetManager():
         self.default_preset_name = "default"
         self.preset_name: str =""
         self.preset: dict = {}
+        self.compiled_presets: Dict[Tuple[str, str], CompiledPreset] = {}
+        self.json_cache: Dict[str, Tuple[FileStamp, Any]] = {}
+        self.preset_list_cache: Optional[Tuple[FileStamp, List[str]]] = None
+        self.version = 0
 
     def _load_preset_config(self) -> Dict[str, Dict[str, str]]:
         """加载预设配置文件
@@ -116,6 +190,7 @@ class QLPresetManager():
             self.preset_config[message_type] = {}
             
         self.preset_config[message_type][chat_id] = preset_name
+        self.version += 1
         self._save_preset_config()
 
     # def get_order_prompts(
@@ -215,13 +290,21 @@ class QLPresetManager():
     def list_presets(self) -> List[str]:
         """获取所有可用的预设名称列表
         
+        预设文件夹的修改时间不变时返回缓存的列表,不重新遍历文件夹。
+        
         Returns:
             List[str]: 预设名称列表
         """
-        return [
+        stamp = _file_stamp(self.preset_folder_path)
+        if stamp is not None and self.preset_list_cache is not None and self.preset_list_cache[0] == stamp:
+            return self.preset_list_cache[1]
+        presets = [
             f.stem for f in self.preset_folder_path.glob("*.json")
             if f.is_file()
         ]
+        if stamp is not None:
+            self.preset_list_cache = (stamp, presets)
+        return presets
 
     def remove_preset(self, message_type: str, chat_id: str) -> bool:
         """移除指定会话的预设配置
@@ -242,6 +325,7 @@ class QLPresetManager():
         if (message_type in self.preset_config and 
             chat_id in self.preset_config[message_type]):
             del self.preset_config[message_type][chat_id]
+            self.version += 1
             self._save_preset_config()
             return True
         return False
@@ -280,8 +364,23 @@ class QLPresetManager():
             self.preset_config[message_type] = {}
             
         self.preset_config[message_type][session_id] = preset_name
+        self.version += 1
         self._save_preset_config()
 
+    def invalidate(self, preset_name: Optional[str] = None) -> None:
+        """删除编译后的预设,上传或修改预设文件后调用
+
+        版本号递增,使用该预设的会话下次收到消息时重新取得预设,其他会话的预设对象不变。
+
+        Args:
+            preset_name: 预设名称,为None时删除全部
+        """
+        for key in list(self.compiled_presets):
+            if preset_name is None or key[0] == preset_name:
+                del self.compiled_presets[key]
+        self.preset_list_cache = None
+        self.version += 1
+
     def get_preset(self, preset_name: str) -> Dict[str, Any]:
         """获取预设配置内容
         
@@ -289,19 +388,17 @@ class QLPresetManager():
             preset_name: 预设名称
             
         Returns:
-            Dict[str, Any]: 预设配置内容
+            Dict[str, Any]: 预设配置内容,为共享的缓存对象,调用方不应修改
             
         Raises:
             FileNotFoundError: 预设文件不存在
             json.JSONDecodeError: 预设文件格式错误
         """
         preset_path = self.preset_folder_path / f"{preset_name}.json"
-        if not preset_path.exists():
-            raise FileNotFoundError(f"预设文件不存在: {preset_name}")
-            
         try:
-            with open(preset_path, "r", encoding='utf-8') as f:
-                return json.load(f)
+            return self._load_json(preset_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"预设文件不存在: {preset_name}")
         except json.JSONDecodeError as e:
             raise json.JSONDecodeError(
                 f"预设文件格式错误: {str(e)}", 
@@ -309,6 +406,46 @@ class QLPresetManager():
                 e.pos
             )
 
+    def _load_json(self, path: Path) -> Any:
+        """读取JSON文件,文件的修改时间和大小未变化时返回缓存的解析结果
+        
+        Args:
+            path: 文件路径
+            
+        Returns:
+            Any: 解析结果
+            
+        Raises:
+            FileNotFoundError: 文件不存在
+            json.JSONDecodeError: 文件格式错误
+        """
+        key = str(path)
+        stamp = _file_stamp(path)
+        if stamp is None:
+            self.json_cache.pop(key, None)
+            raise FileNotFoundError(key)
+        cached = self.json_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, "r", encoding='utf-8') as f:
+            data = json.load(f)
+        self.json_cache[key] = (stamp, data)
+        return data
+
+    def get_global_settings(self, preset_name: str) -> Dict[str, Any]:
+        """获取预设的全局设置
+
+        Args:
+            preset_name: 预设名称
+
+        Returns:
+            Dict[str, Any]: 全局设置,预设不存在时返回空字典
+        """
+        try:
+            return self.get_preset(preset_name).get("global_settings", {})
+        except FileNotFoundError:
+            return {}
+
     def get_prompt_order(self, message_type: str, session_id: str) -> List[Dict[str, Any]]:
         """获取提示词顺序配置
         
@@ -324,17 +461,10 @@ class QLPresetManager():
             FileNotFoundError: 配置文件不存在
         """
         preset_name = self.get_preset_name(message_type, session_id)
-        order_path = (
-            self.script_dir / 
-            f"../config/preset/preset_prompt_orders/{preset_name}/{message_type}_prompt_order.json"
-        )
-        
-        if not order_path.exists():
-            raise FileNotFoundError(f"提示词顺序配置文件不存在: {preset_name}")
-            
         try:
-            with open(order_path, "r", encoding='utf-8') as f:
-                return json.load(f)["order"]
+            return self._load_json(self._get_order_path(preset_name, message_type))["order"]
+        except FileNotFoundError:
+            raise FileNotFoundError(f"提示词顺序配置文件不存在: {preset_name}")
         except json.JSONDecodeError as e:
             raise json.JSONDecodeError(
                 f"提示词顺序配置文件格式错误: {str(e)}", 
@@ -342,34 +472,120 @@ class QLPresetManager():
                 e.pos
             )
 
-    def get_order_prompts(self, message_type: str, session_id: str) -> List[Dict[str, Any]]:
-        """获取排序后的提示词列表
+    def _get_order_path(self, preset_name: str, message_type: str) -> Path:
+        """获取提示词顺序配置文件路径
         
         Args:
+            preset_name: 预设名称
             message_type: 消息类型
-            session_id: 会话ID
             
         Returns:
-            List[Dict[str, Any]]: 排序后的提示词列表
+            Path: 提示词顺序配置文件路径
         """
-        preset_name = self.get_preset_name(message_type, session_id)
+        return (
+            self.script_dir / 
+            f"../config/preset/preset_prompt_orders/{preset_name}/{message_type}_prompt_order.json"
+        )
+
+    def get_compiled_preset(self, preset_name: str, message_type: str) -> CompiledPreset:
+        """获取编译后的预设
+        
+        每次调用只检查预设文件和提示词顺序文件的修改时间,两者都未变化时返回缓存的结果。
+        
+        Args:
+            preset_name: 预设名称
+            message_type: 消息类型
+            
+        Returns:
+            CompiledPreset: 编译后的预设,由所有会话共享,调用方不应修改
+            
+        Raises:
+            FileNotFoundError: 预设文件或提示词顺序配置文件不存在
+        """
+        preset_path = self.preset_folder_path / f"{preset_name}.json"
+        order_path = self._get_order_path(preset_name, message_type)
+        stamps = (_file_stamp(preset_path), _file_stamp(order_path))
+        key = (preset_name, message_type)
+        compiled = self.compiled_presets.get(key)
+        if compiled is not None and compiled.stamps == stamps:
+            return compiled
+
         preset = self.get_preset(preset_name)
-        prompt_order = self.get_prompt_order(message_type, session_id)
+        try:
+            prompt_order = self._load_json(order_path)["order"]
+        except FileNotFoundError:
+            raise FileNotFoundError(f"提示词顺序配置文件不存在: {preset_name}")
         
         order_prompts = []
+        injection_prompts = []
         for item in prompt_order:
             if item["enabled"]:
                 prompt = preset["prompts"].get(item["name"])
                 if prompt and item["identifier"] == prompt["identifier"]:
-                    if not prompt.get("marker"):
+                    if not prompt.get("marker") and prompt.get("injection_position") == 1:
+                        #聊天内注入的提示词不按顺序放置,插入到距离聊天末尾injection_depth条消息的位置
+                        injection_prompts.append({
+                            "role": prompt["role"],
+                            "content": prompt["content"],
+                            "depth": prompt.get("injection_depth") or 0
+                        })
+                    elif not prompt.get("marker"):
                         order_prompts.append({
                             "role": prompt["role"],
                             "content": prompt["content"]
                         })
                     else:
                         order_prompts.append(prompt["identifier"])
-                        
-        return order_prompts
+
+        compiled = CompiledPreset(
+            preset_name,
+            message_type,
+            order_prompts,
+            injection_prompts,
+            preset.get("global_settings", {}),
+            stamps
+        )
+        self.compiled_presets[key] = compiled
+        return compiled
+
+    def get_order_prompts(self, message_type: str, session_id: str) -> List[Dict[str, Any]]:
+        """获取排序后的提示词列表
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            
+        Returns:
+            List[Dict[str, Any]]: 排序后的提示词列表,由使用同一预设的会话共享,调用方不应修改
+        """
+        preset_name = self.get_preset_name(message_type, session_id)
+        return self.get_compiled_preset(preset_name, message_type).order_prompts
+
+    def get_injection_prompts(self, message_type: str, session_id: str) -> List[Dict[str, Any]]:
+        """获取插入聊天历史中的提示词
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            
+        Returns:
+            List[Dict[str, Any]]: 提示词列表,由使用同一预设的会话共享,调用方不应修改
+        """
+        preset_name = self.get_preset_name(message_type, session_id)
+        return self.get_compiled_preset(preset_name, message_type).injection_prompts
+
+    def get_generation_settings(self, message_type: str, session_id: str) -> GenerationSettings:
+        """获取会话所用预设中与生成相关的设置
+        
+        Args:
+            message_type: 消息类型
+            session_id: 会话ID
+            
+        Returns:
+            GenerationSettings: 生成设置,由使用同一预设的会话共享,调用方不应修改
+        """
+        preset_name = self.get_preset_name(message_type, session_id)
+        return self.get_compiled_preset(preset_name, message_type).generation
 
     def config_from_json(self):
         preset_config_path = os.path.join(self.script_dir, "../config/preset/preset_config/preset_config.json")
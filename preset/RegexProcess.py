@@ -1,31 +1,700 @@
 import json
 import os
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Tuple, Pattern, Optional
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Tuple, Pattern, Optional, Union
 import regex
 
+# JS正则标志到regex标志的映射,g控制是否替换全部匹配
+JS_FLAGS = {
+    "i": regex.I,
+    "m": regex.M,
+    "s": regex.S,
+    "u": 0,
+    "y": 0,
+    "d": 0,
+    "g": 0
+}
+# 未使用/pattern/flags写法的规则沿用原来的标志,替换全部匹配
+DEFAULT_FLAGS = regex.S | regex.I | regex.M
+# 规则作用位置(placement)
+USER_INPUT = 1
+AI_OUTPUT = 2
+
+
+def parse_find_regex(find_regex: str) -> Tuple[str, int, bool]:
+    """解析SillyTavern的findRegex,支持/pattern/flags写法
+
+    Args:
+        find_regex: findRegex字段
+
+    Returns:
+        Tuple[str, int, bool]: (正则表达式, regex标志, 是否替换全部匹配),
+        不是/pattern/flags写法或标志无法识别时按整个字符串作为正则表达式
+    """
+    find_regex = find_regex.strip()
+    end = find_regex.rfind("/")
+    if find_regex.startswith("/") and end > 0:
+        flags = find_regex[end + 1:]
+        if all(flag in JS_FLAGS for flag in flags) and len(set(flags)) == len(flags):
+            regex_flags = 0
+            for flag in flags:
+                regex_flags |= JS_FLAGS[flag]
+            return find_regex[1:end], regex_flags, "g" in flags
+    return find_regex, DEFAULT_FLAGS, True
+
+
+_REPLACE_TOKEN = regex.compile(r"\$(?:(\$)|(&)|(\d{1,2})|<([^>]+)>)|\{\{match\}\}", regex.I)
+
+
+def parse_replace_string(replace_string: str) -> List[Union[str, Tuple[Union[int, str]]]]:
+    """将JS风格的替换字符串拆分为文本和分组引用
+
+    支持$&、{{match}}、$$、$1和$<name>。
+
+    Args:
+        replace_string: replaceString字段
+
+    Returns:
+        List[Union[str, Tuple[Union[int, str]]]]: 文本片段或(分组序号或名称,)
+    """
+    parts: List[Union[str, Tuple[Union[int, str]]]] = []
+    position = 0
+    for match in _REPLACE_TOKEN.finditer(replace_string):
+        parts.append(replace_string[position:match.start()])
+        if match.group(1):
+            parts.append("$")
+        elif match.group(3):
+            parts.append((int(match.group(3)),))
+        elif match.group(4):
+            parts.append((match.group(4),))
+        else:
+            parts.append((0,))
+        position = match.end()
+    parts.append(replace_string[position:])
+    return [part for part in parts if part != ""]
+
+
+def convert_replace_string(
+    replace_string: str,
+    trim_strings: Tuple[str, ...] = ()
+) -> Union[str, Callable[[Any], str]]:
+    """将JS风格的替换字符串转换为regex.sub使用的替换
+
+    没有trimStrings时转换为模板,由regex在C代码中展开;
+    有trimStrings时返回函数,先从引用的分组中删除这些字符串再拼接。
+
+    Args:
+        replace_string: replaceString字段
+        trim_strings: 从分组内容中删除的字符串
+
+    Returns:
+        Union[str, Callable[[Any], str]]: 替换模板或替换函数
+    """
+    parts = parse_replace_string(replace_string)
+    if not trim_strings:
+        return "".join(
+            part.replace("\\", "\\\\") if isinstance(part, str) else f"\\g<{part[0]}>"
+            for part in parts
+        )
+
+    def replace(match: Any) -> str:
+        output = []
+        for part in parts:
+            if isinstance(part, str):
+                output.append(part)
+                continue
+            value = match.group(part[0]) or ""
+            for trim_string in trim_strings:
+                value = value.replace(trim_string, "")
+            output.append(value)
+        return "".join(output)
+
+    return replace
+
+
+def _to_depth(value: Any) -> Optional[int]:
+    """将minDepth/maxDepth转换为整数
+
+    Args:
+        value: 配置值,可能为None、空字符串或数字
+
+    Returns:
+        Optional[int]: 深度,未设置时为None
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RegexRule:
+    """编译后的正则规则及其执行统计
+
+    Attributes:
+        name (str): 规则名称(scriptName,没有时为文件名)
+        pattern (Pattern): 编译后的正则表达式
+        replacement (Union[str, Callable]): 替换模板或替换函数
+        count (int): 最多替换次数,0表示全部替换
+        placement (FrozenSet[int]): 作用位置,1为用户输入,2为AI回复
+        min_depth (Optional[int]): 构造提示和显示时生效的最小消息深度
+        max_depth (Optional[int]): 构造提示和显示时生效的最大消息深度
+        prompt_only (bool): 只在构造提示时生效,不修改保存的消息
+        markdown_only (bool): 只在显示时生效,不修改保存的消息
+        calls (int): 执行次数
+        total_time (float): 累计执行秒数
+        max_time (float): 单次最长执行秒数
+        timeouts (int): 超时次数
+        errors (int): 出错次数
+    """
+
+    __slots__ = (
+        "name", "pattern", "replacement", "count",
+        "placement", "min_depth", "max_depth", "prompt_only", "markdown_only",
+        "calls", "total_time", "max_time", "timeouts", "errors", "stream_patterns"
+    )
+
+    def __init__(
+        self,
+        name: str,
+        pattern: Pattern,
+        replacement: Union[str, Callable[[Any], str]],
+        count: int = 0,
+        placement: FrozenSet[int] = frozenset((AI_OUTPUT,)),
+        min_depth: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        prompt_only: bool = False,
+        markdown_only: bool = False
+    ) -> None:
+        """初始化规则
+
+        Args:
+            name: 规则名称
+            pattern: 编译后的正则表达式
+            replacement: 替换模板或替换函数
+            count: 最多替换次数,0表示全部替换
+            placement: 作用位置
+            min_depth: 最小消息深度,为None时不限制
+            max_depth: 最大消息深度,为None时不限制
+            prompt_only: 只在构造提示时生效
+            markdown_only: 只在显示时生效
+        """
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.count = count
+        self.placement = placement
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.prompt_only = prompt_only
+        self.markdown_only = markdown_only
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.timeouts = 0
+        self.errors = 0
+        self.stream_patterns: Optional[Tuple[Pattern, Pattern]] = None
+
+    def applies(self, placement: int, mode: str, depth: Optional[int] = None) -> bool:
+        """判断规则是否作用于指定位置、用途和深度的消息
+
+        与SillyTavern相同: 同时设置promptOnly和markdownOnly的规则在构造提示和显示时都生效,
+        两者都未设置的规则只在保存消息前生效。深度只在构造提示和显示时检查。
+
+        Args:
+            placement: 消息位置,USER_INPUT或AI_OUTPUT
+            mode: 用途,edit(保存前)、display(显示)或prompt(构造提示)
+            depth: 消息深度,最新的消息为0
+
+        Returns:
+            bool: 是否生效
+        """
+        if placement not in self.placement:
+            return False
+        if mode == "prompt":
+            if not self.prompt_only:
+                return False
+        elif mode == "display":
+            if not self.markdown_only:
+                return False
+        elif self.prompt_only or self.markdown_only:
+            return False
+        if depth is not None:
+            if self.min_depth is not None and self.min_depth >= -1 and depth < self.min_depth:
+                return False
+            if self.max_depth is not None and self.max_depth >= 0 and depth > self.max_depth:
+                return False
+        return True
+
+    def apply(self, text: str, timeout: Optional[float]) -> str:
+        """对文本执行替换,超时或出错时返回原文本
+
+        Args:
+            text: 要处理的文本
+            timeout: 超时秒数,为None时不限制
+
+        Returns:
+            str: 处理后的文本
+        """
+        start = time.perf_counter()
+        try:
+            return self.pattern.sub(self.replacement, text, count=self.count, timeout=timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            print(f"正则规则执行超时,已跳过: {self.name} ({len(text)}字符)")
+            return text
+        except (regex.error, IndexError) as e:
+            self.errors += 1
+            print(f"正则规则执行失败,已跳过: {self.name} - {e}")
+            return text
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+
+
+    def get_stream_patterns(self) -> Optional[Tuple[Pattern, Pattern]]:
+        """获取流式处理时判断匹配是否依赖后续文本的两个辅助正则,首次使用时编译
+
+        两者都在原正则之后强制失败,配合partial=True使用:
+        前者找出最早的、有匹配路径读到了文本末尾的起始位置;
+        后者用原子组截断在第一个成功的匹配处,只报告优先级更高的路径是否读到了文本末尾。
+
+        Returns:
+            Optional[Tuple[Pattern, Pattern]]: (任意路径检查, 更高优先级路径检查),无法编译时为None
+        """
+        if self.stream_patterns is None:
+            try:
+                self.stream_patterns = (
+                    regex.compile(f"(?:{self.pattern.pattern})(*FAIL)", self.pattern.flags),
+                    regex.compile(f"(?>(?:{self.pattern.pattern}))(*FAIL)", self.pattern.flags)
+                )
+            except regex.error as e:
+                print(f"正则规则无法流式处理,将等待回复结束后执行: {self.name} - {e}")
+                self.stream_patterns = ()
+        return self.stream_patterns or None
+
+
+class RegexPipeline:
+    """预设的正则规则流水线,由使用该预设的所有会话共享
+
+    构造提示时的处理结果按(位置, 生效规则, 原文)缓存,
+    历史消息只在第一次出现或跨过规则的深度边界时执行正则。
+
+    Attributes:
+        preset_name (str): 预设名称
+        rules (List[RegexRule]): 按文件名排序的规则
+        timeout (Optional[float]): 每条规则的超时秒数
+        stamp (Tuple): 编译时规则文件的状态,用于判断是否需要重新编译
+        selections (Dict[Tuple[int, str, Optional[int]], Tuple[int, ...]]): (位置, 用途, 深度)到生效规则序号的映射
+        prompt_cache (OrderedDict[Tuple[int, Tuple[int, ...], str], str]): 构造提示时的处理结果缓存
+        cache_size (int): 处理结果缓存的最大条目数
+        cache_hits (int): 处理结果缓存命中次数
+        cache_misses (int): 处理结果缓存未命中次数
+        depth_horizon (int): 深度不小于该值的消息,生效的规则与深度无关
+    """
+
+    def __init__(
+        self,
+        preset_name: str,
+        rules: List[RegexRule],
+        timeout: Optional[float],
+        stamp: Tuple,
+        cache_size: int = 4096
+    ) -> None:
+        """初始化流水线
+
+        Args:
+            preset_name: 预设名称
+            rules: 规则列表
+            timeout: 每条规则的超时秒数
+            stamp: 规则文件的状态
+            cache_size: 处理结果缓存的最大条目数
+        """
+        self.preset_name = preset_name
+        self.rules = rules
+        self.timeout = timeout
+        self.stamp = stamp
+        self.selections: Dict[Tuple[int, str, Optional[int]], Tuple[int, ...]] = {}
+        self.prompt_cache: "OrderedDict[Tuple[int, Tuple[int, ...], str], str]" = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.depth_horizon = max(
+            [rule.min_depth for rule in rules if rule.min_depth is not None and rule.min_depth >= 0]
+            + [rule.max_depth + 1 for rule in rules if rule.max_depth is not None and rule.max_depth >= 0],
+            default=0
+        )
+
+    def __iter__(self) -> Iterator[Tuple[Pattern, str]]:
+        """兼容按(正则, 替换字符串)遍历规则的旧用法"""
+        return ((rule.pattern, rule.replacement) for rule in self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def apply(self, text: str) -> str:
+        """依次执行所有规则,不区分位置和用途
+
+        Args:
+            text: 要处理的文本
+
+        Returns:
+            str: 处理后的文本
+        """
+        for rule in self.rules:
+            text = rule.apply(text, self.timeout)
+        return text
+
+    def select(self, placement: int, mode: str, depth: Optional[int] = None) -> Tuple[int, ...]:
+        """获取对指定位置、用途和深度生效的规则序号
+
+        Args:
+            placement: 消息位置
+            mode: 用途,edit、display或prompt
+            depth: 消息深度
+
+        Returns:
+            Tuple[int, ...]: 生效规则在rules中的序号
+        """
+        key = (placement, mode, depth)
+        selection = self.selections.get(key)
+        if selection is None:
+            selection = self.selections[key] = tuple(
+                index for index, rule in enumerate(self.rules)
+                if rule.applies(placement, mode, depth)
+            )
+        return selection
+
+    def run(self, text: str, placement: int, mode: str, depth: Optional[int] = None) -> str:
+        """执行对指定位置、用途和深度生效的规则
+
+        Args:
+            text: 要处理的文本
+            placement: 消息位置
+            mode: 用途,edit、display或prompt
+            depth: 消息深度
+
+        Returns:
+            str: 处理后的文本
+        """
+        for index in self.select(placement, mode, depth):
+            text = self.rules[index].apply(text, self.timeout)
+        return text
+
+    def process_prompt(self, text: str, placement: int, depth: int) -> str:
+        """处理构造提示时的消息,结果按生效规则和原文缓存
+
+        Args:
+            text: 消息原文
+            placement: 消息位置
+            depth: 消息深度,当前消息为0
+
+        Returns:
+            str: 处理后的文本
+        """
+        selection = self.select(placement, "prompt", depth)
+        if not selection:
+            return text
+        key = (placement, selection, text)
+        cached = self.prompt_cache.get(key)
+        if cached is not None:
+            self.prompt_cache.move_to_end(key)
+            self.cache_hits += 1
+            return cached
+        self.cache_misses += 1
+        result = text
+        for index in selection:
+            result = self.rules[index].apply(result, self.timeout)
+        self.prompt_cache[key] = result
+        if len(self.prompt_cache) > self.cache_size:
+            self.prompt_cache.popitem(last=False)
+        return result
+
+
+# 流式处理时追加在文本末尾的探测字符,用于发现依赖下一个字符的零宽断言($、\b、前瞻等)
+STREAM_PROBES = ("a", "0", "_", " ", "\n", "中", "<", ".")
+
+
+class StreamingRuleStage:
+    """流式执行单条正则规则
+
+    保存到目前为止的全部文本(后顾断言需要前文),只替换不会因后续文本改变的匹配并立即输出;
+    可能匹配到后续文本的部分暂不输出,等待更多文本或回复结束时再处理,
+    因此输出总是与对完整文本执行rule.apply的结果相同。
+
+    Attributes:
+        rule (RegexRule): 正则规则
+        timeout (Optional[float]): 每次匹配的超时秒数
+        buffer (str): 到目前为止收到的全部文本
+        position (int): buffer中已输出的位置
+        replaced (int): 已替换的次数
+        skip_empty (bool): position处的空匹配已经替换过
+        disabled (bool): 超时或出错后不再执行规则,直接输出文本
+    """
+
+    def __init__(self, rule: RegexRule, timeout: Optional[float]) -> None:
+        """初始化
+
+        Args:
+            rule: 正则规则
+            timeout: 每次匹配的超时秒数
+        """
+        self.rule = rule
+        self.timeout = timeout
+        self.patterns = rule.get_stream_patterns()
+        self.buffer = ""
+        self.position = 0
+        self.replaced = 0
+        self.skip_empty = False
+        self.disabled = False
+
+    def feed(self, text: str, final: bool = False) -> str:
+        """追加文本并返回已确定的输出
+
+        Args:
+            text: 新到达的文本
+            final: 是否为最后一段文本
+
+        Returns:
+            str: 可以输出的文本
+        """
+        self.buffer += text
+        output: List[str] = []
+        if not self.disabled:
+            try:
+                self._advance(final, output)
+            except TimeoutError:
+                self.rule.timeouts += 1
+                self.disabled = True
+                print(f"正则规则流式执行超时,已跳过: {self.rule.name} ({len(self.buffer)}字符)")
+            except (regex.error, IndexError) as e:
+                self.rule.errors += 1
+                self.disabled = True
+                print(f"正则规则流式执行失败,已跳过: {self.rule.name} - {e}")
+        if self.disabled:
+            output.append(self._take(len(self.buffer)))
+        return "".join(output)
+
+    def _take(self, end: int) -> str:
+        """取出从已输出位置到end的原文
+
+        Args:
+            end: 结束位置
+
+        Returns:
+            str: 原文
+        """
+        text = self.buffer[self.position:end]
+        self.position = max(self.position, end)
+        return text
+
+    def _advance(self, final: bool, output: List[str]) -> None:
+        """从已输出位置开始依次替换已确定的匹配
+
+        Args:
+            final: 是否为最后一段文本,为True时不再保留任何文本
+            output: 输出片段列表
+        """
+        buffer = self.buffer
+        count = self.rule.count
+        if count and self.replaced >= count:
+            output.append(self._take(len(buffer)))
+            return
+        if not final and self.patterns is None:
+            return
+
+        probes: List[str] = []
+        last_empty = -1
+        skip_empty, self.skip_empty = self.skip_empty, False
+        for match in self.rule.pattern.finditer(buffer, self.position, timeout=self.timeout):
+            start, end = match.span()
+            if skip_empty:
+                skip_empty = False
+                if start == end == self.position:
+                    last_empty = start
+                    continue
+            if not final:
+                if not probes:
+                    probes = [buffer + probe for probe in STREAM_PROBES]
+                hold = self._find_hold(match, probes, last_empty)
+                if hold is not None:
+                    output.append(self._take(hold))
+                    self.skip_empty = last_empty == hold
+                    return
+            output.append(self._take(start))
+            replacement = self.rule.replacement
+            output.append(match.expand(replacement) if isinstance(replacement, str) else replacement(match))
+            self.position = end
+            last_empty = start if start == end else -1
+            self.replaced += 1
+            if count and self.replaced >= count:
+                break
+        else:
+            if not final:
+                if not probes:
+                    probes = [buffer + probe for probe in STREAM_PROBES]
+                hold = self._find_hold(None, probes, last_empty)
+                output.append(self._take(hold))
+                self.skip_empty = last_empty == hold
+                return
+        output.append(self._take(len(buffer)))
+
+    def _find_hold(self, match: Any, probes: List[str], last_empty: int) -> Optional[int]:
+        """判断下一个匹配之前及匹配本身是否可能因后续文本而改变
+
+        Args:
+            match: 从已输出位置开始的下一个匹配,没有时为None
+            probes: 末尾追加了探测字符的文本
+            last_empty: 已替换的空匹配位置,没有时为-1
+
+        Returns:
+            Optional[int]: 需要保留的起始位置,匹配已确定时为None
+        """
+        any_path, higher_priority = self.patterns
+        buffer = self.buffer
+        length = len(buffer)
+        timeout = self.timeout
+
+        # 最早的、有匹配路径读到文本末尾的位置
+        tail = any_path.search(buffer, self.position, partial=True, timeout=timeout)
+        earliest = tail.start() if tail is not None else length
+        # 末尾再多一个字符就会出现更早的匹配的位置
+        if earliest > self.position:
+            for probe in probes:
+                for probe_match in self.rule.pattern.finditer(probe, self.position, timeout=timeout):
+                    if probe_match.start() == probe_match.end() == last_empty:
+                        continue
+                    earliest = min(earliest, probe_match.start())
+                    break
+
+        if match is None:
+            return earliest
+        start, end = match.span()
+        if earliest < start:
+            return earliest
+        if end >= length:
+            return start
+        # 优先级高于当前匹配的路径读到了文本末尾
+        if higher_priority.match(buffer, start, partial=True, timeout=timeout) is not None:
+            return start
+        for probe in probes:
+            probe_match = self.rule.pattern.match(probe, start, timeout=timeout)
+            if probe_match is None or probe_match.span() != match.span() or probe_match.groups() != match.groups():
+                return start
+        return None
+
+
+class StreamingStripStage:
+    """流式执行str.strip(),去掉开头的空白,末尾的空白保留到后面出现非空白字符时再输出
+
+    Attributes:
+        started (bool): 是否已经输出过非空白字符
+        pending (str): 保留的末尾空白
+    """
+
+    def __init__(self) -> None:
+        """初始化"""
+        self.started = False
+        self.pending = ""
+
+    def feed(self, text: str, final: bool = False) -> str:
+        """追加文本并返回已确定的输出
+
+        Args:
+            text: 新到达的文本
+            final: 是否为最后一段文本
+
+        Returns:
+            str: 可以输出的文本
+        """
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self.started = True
+        text = self.pending + text
+        body = text.rstrip()
+        self.pending = "" if final else text[len(body):]
+        return body
+
+
+class StreamingRegex:
+    """流式正则处理器,依次经过各个阶段,输出与批量处理完整回复的结果相同
+
+    Attributes:
+        stages (List[Union[StreamingRuleStage, StreamingStripStage]]): 处理阶段
+    """
+
+    def __init__(self, stages: List[Union[StreamingRuleStage, StreamingStripStage]]) -> None:
+        """初始化
+
+        Args:
+            stages: 处理阶段
+        """
+        self.stages = stages
+
+    def feed(self, text: str) -> str:
+        """处理新到达的文本
+
+        Args:
+            text: 新到达的文本
+
+        Returns:
+            str: 可以立即发送的文本
+        """
+        for stage in self.stages:
+            text = stage.feed(text)
+        return text
+
+    def flush(self) -> str:
+        """回复结束时处理所有保留的文本
+
+        Returns:
+            str: 剩余的文本
+        """
+        text = ""
+        for stage in self.stages:
+            text = stage.feed(text, True)
+        return text
+
+
 class RegexProcessor:
     """正则表达式处理器类,用于管理和应用正则表达式规则
     
+    每个预设的规则只编译一次,规则文件变化时重新编译。
+    
     Attributes:
-        patterns (List[Tuple[Pattern, str]]): 编译后的正则表达式和替换字符串列表
+        patterns (List[Tuple[Pattern, str]]): process使用的正则表达式和替换字符串列表
+        timeout (Optional[float]): 每条规则的超时秒数,为None时不限制
+        pipelines (Dict[str, RegexPipeline]): 预设名称到规则流水线的映射
     """
 
-    def __init__(self) -> None:
-        """初始化正则表达式处理器"""
+    def __init__(self, timeout: Optional[float] = 0.5) -> None:
+        """初始化正则表达式处理器
+        
+        Args:
+            timeout: 每条规则的超时秒数,超时的规则跳过,为None或0时不限制
+        """
         self.patterns: List[Tuple[Pattern, str]] = []
+        self.timeout = timeout or None
+        self.pipelines: Dict[str, RegexPipeline] = {}
 
-    def get_patterns(self, preset_name: str) -> List[Tuple[Pattern, str]]:
-        """加载预设的正则表达式规则
+    def get_patterns(self, preset_name: str) -> RegexPipeline:
+        """获取预设的正则规则流水线,规则文件未变化时返回缓存的流水线
+        
+        预设没有正则规则目录时返回空的流水线,与QLPresetManager.get_regex_config返回空列表一致。
         
         Args:
             preset_name: 预设名称
             
         Returns:
-            List[Tuple[Pattern, str]]: 正则表达式和替换字符串列表
+            RegexPipeline: 规则流水线,可按(正则, 替换字符串)遍历
             
         Raises:
-            FileNotFoundError: 预设目录不存在
             json.JSONDecodeError: 规则文件格式错误
         """
         try:
@@ -34,11 +703,17 @@ class RegexProcessor:
                 f"../config/preset/preset_regex/{preset_name}"
             )
             
-            if not regex_dir.exists():
-                raise FileNotFoundError(f"正则表达式预设目录不存在: {regex_dir}")
+            file_paths = sorted(regex_dir.glob("*.json")) if regex_dir.is_dir() else []
+            stamp = tuple(
+                (file_path.name, stat.st_mtime_ns, stat.st_size)
+                for file_path, stat in ((file_path, file_path.stat()) for file_path in file_paths)
+            )
+            pipeline = self.pipelines.get(preset_name)
+            if pipeline is not None and pipeline.stamp == stamp:
+                return pipeline
 
-            self.patterns = []
-            for file_path in regex_dir.glob("*.json"):
+            rules = []
+            for file_path in file_paths:
                 try:
                     with open(file_path, 'r', encoding='utf-8') as f:
                         config = json.load(f)
@@ -46,18 +721,28 @@ class RegexProcessor:
                     if config.get('disabled', False):
                         continue
                         
-                    regex_pattern = str(config.get('findRegex', '')).strip('/')
+                    regex_pattern, flags, replace_all = parse_find_regex(str(config.get('findRegex', '')))
                     if not regex_pattern:
                         continue
                         
-                    replace_string = config['replaceString']
+                    replace_string = convert_replace_string(
+                        str(config['replaceString']),
+                        tuple(str(trim) for trim in config.get('trimStrings') or () if trim)
+                    )
                     
                     # 编译正则表达式
-                    pattern = regex.compile(
-                        regex_pattern,
-                        regex.S | regex.I | regex.M | regex.VERSION1
-                    )
-                    self.patterns.append((pattern, replace_string))
+                    pattern = regex.compile(regex_pattern, flags | regex.VERSION1)
+                    rules.append(RegexRule(
+                        str(config.get('scriptName') or file_path.stem),
+                        pattern,
+                        replace_string,
+                        0 if replace_all else 1,
+                        frozenset(config.get('placement') or (AI_OUTPUT,)),
+                        _to_depth(config.get('minDepth')),
+                        _to_depth(config.get('maxDepth')),
+                        bool(config.get('promptOnly', False)),
+                        bool(config.get('markdownOnly', False))
+                    ))
                     
                 except json.JSONDecodeError as e:
                     raise json.JSONDecodeError(
@@ -66,7 +751,9 @@ class RegexProcessor:
                         e.pos
                     )
                     
-            return self.patterns
+            pipeline = RegexPipeline(preset_name, rules, self.timeout, stamp)
+            self.pipelines[preset_name] = pipeline
+            return pipeline
             
         except FileNotFoundError:
             raise
@@ -85,23 +772,17 @@ class RegexProcessor:
         Raises:
             RuntimeError: 处理失败
         """
-        try:
-            for pattern, replacement in self.patterns:
-                text = pattern.sub(replacement, text)
-            return text.strip()
-            
-        except Exception as e:
-            raise RuntimeError(f"处理文本失败: {str(e)}") from e
+        return self.process_by_regex(self.patterns, text)
 
     def process_by_regex(
         self,
-        regexs: List[Tuple[Pattern, str]],
+        regexs: Union[RegexPipeline, List[Tuple[Pattern, str]]],
         text: str
     ) -> str:
         """使用指定的规则处理文本
         
         Args:
-            regexs: 正则表达式和替换字符串列表
+            regexs: 规则流水线,或正则表达式和替换字符串列表
             text: 要处理的文本
             
         Returns:
@@ -110,14 +791,103 @@ class RegexProcessor:
         Raises:
             RuntimeError: 处理失败
         """
+        if isinstance(regexs, RegexPipeline):
+            return regexs.apply(text).strip()
         try:
             for pattern, replacement in regexs:
-                text = pattern.sub(replacement, text)
+                text = pattern.sub(replacement, text, timeout=self.timeout)
             return text.strip()
             
         except Exception as e:
             raise RuntimeError(f"处理文本失败: {str(e)}") from e
 
+    def process_input(self, regexs: Optional[RegexPipeline], text: str) -> str:
+        """处理用户输入,在保存和构造提示之前执行作用于用户输入的规则
+        
+        Args:
+            regexs: 规则流水线
+            text: 用户消息
+            
+        Returns:
+            str: 处理后的消息
+        """
+        if regexs is None:
+            return text
+        return regexs.run(text, USER_INPUT, "edit")
+
+    def process_output(self, regexs: Optional[RegexPipeline], text: str) -> str:
+        """处理AI回复,得到保存到聊天记录的文本
+        
+        Args:
+            regexs: 规则流水线
+            text: AI回复
+            
+        Returns:
+            str: 处理后的回复
+        """
+        if regexs is None:
+            return text.strip()
+        return regexs.run(text, AI_OUTPUT, "edit").strip()
+
+    def process_display(self, regexs: Optional[RegexPipeline], text: str) -> str:
+        """处理要发送的AI回复,执行只在显示时生效的规则
+        
+        Args:
+            regexs: 规则流水线
+            text: 已经过process_output处理的回复
+            
+        Returns:
+            str: 发送的文本
+        """
+        if regexs is None:
+            return text.strip()
+        return regexs.run(text, AI_OUTPUT, "display", 0).strip()
+
+    def stream_display(self, regexs: Optional[RegexPipeline]) -> StreamingRegex:
+        """创建流式处理器,输出与process_display(regexs, process_output(regexs, 完整回复))相同
+        
+        Args:
+            regexs: 规则流水线
+            
+        Returns:
+            StreamingRegex: 流式正则处理器
+        """
+        stages: List[Union[StreamingRuleStage, StreamingStripStage]] = []
+        if regexs is not None:
+            stages.extend(
+                StreamingRuleStage(regexs.rules[index], self.timeout)
+                for index in regexs.select(AI_OUTPUT, "edit")
+            )
+        stages.append(StreamingStripStage())
+        if regexs is not None:
+            stages.extend(
+                StreamingRuleStage(regexs.rules[index], self.timeout)
+                for index in regexs.select(AI_OUTPUT, "display", 0)
+            )
+            stages.append(StreamingStripStage())
+        return StreamingRegex(stages)
+
+    def get_rule_stats(self) -> List[Dict[str, Any]]:
+        """获取所有已编译规则的执行统计,按累计耗时从高到低排列
+        
+        Returns:
+            List[Dict[str, Any]]: 每条规则的预设、名称、次数、累计/平均/最长耗时(毫秒)、超时和出错次数
+        """
+        stats = []
+        for pipeline in self.pipelines.values():
+            for rule in pipeline.rules:
+                stats.append({
+                    "preset": pipeline.preset_name,
+                    "name": rule.name,
+                    "calls": rule.calls,
+                    "total_ms": rule.total_time * 1000,
+                    "avg_ms": rule.total_time * 1000 / rule.calls if rule.calls else 0.0,
+                    "max_ms": rule.max_time * 1000,
+                    "timeouts": rule.timeouts,
+                    "errors": rule.errors
+                })
+        return sorted(stats, key=lambda item: item["total_ms"], reverse=True)
+
     def validate_regex_config(self, config: dict) -> Tuple[bool, str]:
         """验证正则表达式配置有效性
         
@@ -149,7 +919,7 @@ if __name__ == '__main__':
     # ]
 
     processor = RegexProcessor()
-    processor.get_patterns("Gemini!_It's_MyGO!!!!!_1.9.2版")
+    processor.patterns = processor.get_patterns("Gemini!_It's_MyGO!!!!!_1.9.2版")
 
     input_message = """
 ```Start
@@ -0,0 +1,193 @@
+import re
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+# names_behavior的取值,与SillyTavern相同
+NAMES_NONE = -1
+NAMES_DEFAULT = 0
+NAMES_COMPLETION = 1
+NAMES_CONTENT = 2
+
+# 各聊天补全来源默认发送的采样参数,未列出的来源(Others)发送全部参数
+# Claude的部分模型不接受同时设置temperature和top_p,因此只发送top_k
+# Gemini的OpenAI兼容接口不支持top_k,部分模型不支持频率和存在惩罚
+SOURCE_PARAMETERS: Dict[str, Tuple[str, ...]] = {
+    "openai": ("top_p", "frequency_penalty", "presence_penalty"),
+    "deepseek": ("top_p", "frequency_penalty", "presence_penalty"),
+    "google ai studio": ("top_p",),
+    "claude": ("top_k",)
+}
+ALL_PARAMETERS = ("top_p", "top_k", "frequency_penalty", "presence_penalty")
+
+# OpenAI接口中消息name字段允许的字符
+NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_-]")
+
+
+def _to_float(value: Any) -> Optional[float]:
+    """将预设中的数值转换为float
+
+    Args:
+        value: 预设中的值
+
+    Returns:
+        Optional[float]: 转换结果,无法转换时为None
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sanitize_name(name: str) -> str:
+    """将名称转换为OpenAI接口name字段允许的格式
+
+    Args:
+        name: 用户昵称或角色名称
+
+    Returns:
+        str: 只包含字母、数字、下划线和连字符的名称,最长64个字符
+    """
+    return NAME_PATTERN.sub("_", name)[:64]
+
+
+class GenerationProfile:
+    """预设和聊天补全配置合并后的生成参数,由使用同一预设和配置的会话共享
+
+    Attributes:
+        source (str): 聊天补全来源,小写
+        model (str): 模型名称
+        max_tokens (int): 最大生成token数
+        temperature (float): 采样温度
+        parameters (Dict[str, Any]): 发送给当前来源的其他采样参数
+        fields (Dict[str, Any]): OpenAI兼容接口请求体中messages以外的参数
+        assistant_prefill (str): Claude回复的预填内容
+    """
+
+    __slots__ = ("source", "model", "max_tokens", "temperature", "parameters", "fields", "assistant_prefill")
+
+    def __init__(
+        self,
+        source: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        parameters: Dict[str, Any],
+        assistant_prefill: str = ""
+    ) -> None:
+        """初始化生成参数
+
+        Args:
+            source: 聊天补全来源,小写
+            model: 模型名称
+            max_tokens: 最大生成token数
+            temperature: 采样温度
+            parameters: 发送给当前来源的其他采样参数
+            assistant_prefill: Claude回复的预填内容
+        """
+        self.source = source
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.parameters = parameters
+        self.fields: Dict[str, Any] = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            **parameters
+        }
+        self.assistant_prefill = assistant_prefill
+
+
+class GenerationSettings:
+    """预设global_settings中与生成相关的设置,在编译预设时转换一次
+
+    模型和温度以聊天补全配置为准;openai_max_tokens不超过配置中的max_tokens;
+    top_p、top_k和惩罚参数使用预设的值,等于默认值时不发送。
+
+    Attributes:
+        top_p (Optional[float]): top_p,为None或不小于1时不发送
+        top_k (Optional[int]): top_k,为None或0时不发送
+        frequency_penalty (Optional[float]): 频率惩罚,为None或0时不发送
+        presence_penalty (Optional[float]): 存在惩罚,为None或0时不发送
+        max_tokens (int): 预设的最大生成token数(openai_max_tokens),为0时使用配置
+        squash_system_messages (bool): 是否合并相邻的system消息
+        assistant_prefill (str): Claude回复的预填内容
+        names_behavior (int): 聊天历史中如何包含发送者名称
+        profile_key (Optional[Tuple[Any, ...]]): 上次合并时的聊天补全配置
+        profile (Optional[GenerationProfile]): 上次合并的结果
+    """
+
+    __slots__ = (
+        "top_p", "top_k", "frequency_penalty", "presence_penalty", "max_tokens",
+        "squash_system_messages", "assistant_prefill", "names_behavior", "profile_key", "profile"
+    )
+
+    def __init__(self, global_settings: Optional[Dict[str, Any]] = None) -> None:
+        """从预设的global_settings转换设置
+
+        Args:
+            global_settings: 预设的global_settings,为None时使用默认设置
+        """
+        global_settings = global_settings or {}
+        top_p = _to_float(global_settings.get("top_p"))
+        self.top_p = top_p if top_p is not None and 0 <= top_p < 1 else None
+        top_k = _to_float(global_settings.get("top_k"))
+        self.top_k = int(top_k) if top_k is not None and top_k >= 1 else None
+        self.frequency_penalty = _to_float(global_settings.get("frequency_penalty")) or None
+        self.presence_penalty = _to_float(global_settings.get("presence_penalty")) or None
+        max_tokens = _to_float(global_settings.get("openai_max_tokens"))
+        self.max_tokens = int(max_tokens) if max_tokens is not None and max_tokens > 0 else 0
+        self.squash_system_messages = bool(global_settings.get("squash_system_messages", False))
+        self.assistant_prefill = str(global_settings.get("assistant_prefill") or "")
+        names_behavior = _to_float(global_settings.get("names_behavior"))
+        self.names_behavior = int(names_behavior) if names_behavior is not None else NAMES_DEFAULT
+        self.profile_key: Optional[Tuple[Any, ...]] = None
+        self.profile: Optional[GenerationProfile] = None
+
+    def resolve(
+        self,
+        source: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        parameter_names: Optional[Sequence[str]] = None
+    ) -> GenerationProfile:
+        """与聊天补全配置合并,配置未变化时返回上次的结果
+
+        Args:
+            source: 聊天补全来源
+            model: 配置中的模型名称
+            max_tokens: 配置中的最大生成token数
+            temperature: 配置中的采样温度
+            parameter_names: 发送的采样参数名称,为None时按来源选择
+
+        Returns:
+            GenerationProfile: 生成参数,调用方不应修改
+        """
+        source = source.lower()
+        names = tuple(parameter_names) if parameter_names is not None else None
+        key = (source, model, max_tokens, temperature, names)
+        if self.profile is not None and self.profile_key == key:
+            return self.profile
+        if names is None:
+            names = SOURCE_PARAMETERS.get(source, ALL_PARAMETERS)
+        parameters = {}
+        for name in names:
+            value = getattr(self, name, None) if name in ALL_PARAMETERS else None
+            if value is not None:
+                parameters[name] = value
+        if self.max_tokens and max_tokens:
+            max_tokens = min(self.max_tokens, max_tokens)
+        else:
+            max_tokens = self.max_tokens or max_tokens
+        self.profile = GenerationProfile(
+            source,
+            model,
+            max_tokens,
+            temperature,
+            parameters,
+            self.assistant_prefill if source == "claude" else ""
+        )
+        self.profile_key = key
+        return self.profile
@@ -0,0 +1,12 @@
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def pytest_collect_directory(path, parent):
+    """仓库根目录按普通目录收集,避免pytest将插件入口__init__.py作为包导入"""
+    if path == ROOT:
+        return pytest.Dir.from_parent(parent, path=path)
+    return None
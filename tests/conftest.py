@@ -0,0 +1,14 @@
+import sys
+import types
+from pathlib import Path
+
+
+# 插件的__init__.py需要运行中的NoneBot驱动,测试只导入各子模块:
+# 将仓库根目录注册为qilianchat包,但不执行其__init__.py
+ROOT = Path(__file__).resolve().parents[1]
+if "qilianchat" not in sys.modules:
+    package = types.ModuleType("qilianchat")
+    package.__path__ = [str(ROOT)]
+    sys.modules["qilianchat"] = package
+
+
@@ -0,0 +1,115 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class StubServer:
+    """本地的chat/completions替身服务器,用于测试连接复用、并发和换密钥重试
+
+    每个请求按Authorization中的密钥决定返回的状态码,未列出的密钥返回正常回复。
+    流式请求按stream_pieces逐段返回SSE数据块,设置fail_after时在发送该数量的片段后断开连接。
+
+    Attributes:
+        delay (float): 非流式回复前等待的秒数
+        statuses (Dict[str, int]): 密钥到错误状态码的映射
+        stream_pieces (List[str]): 流式回复的文本片段
+        fail_after (Optional[int]): 流式回复发送多少个片段后断开连接,为None时正常结束
+        requests (List[Tuple[Optional[str], Dict[str, Any]]]): 收到的(密钥, 请求体)
+        connections (int): 建立过的连接数
+    """
+
+    def __init__(self, delay: float = 0.0) -> None:
+        """初始化替身服务器
+
+        Args:
+            delay: 非流式回复前等待的秒数
+        """
+        self.delay = delay
+        self.statuses: Dict[str, int] = {}
+        self.stream_pieces: List[str] = ["你好", "，", "世界"]
+        self.fail_after: Optional[int] = None
+        self.requests: List[Tuple[Optional[str], Dict[str, Any]]] = []
+        self.connections = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        """服务器的API基础URL"""
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def __aenter__(self) -> "StubServer":
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """处理一个keep-alive连接上的所有请求"""
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                headers = {}
+                for line in head.decode().split("\r\n")[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                request = json.loads(body or b"{}")
+                authorization = headers.get("authorization", "")
+                api_key = authorization[7:] if authorization.startswith("Bearer ") else None
+                self.requests.append((api_key, request))
+
+                status = self.statuses.get(api_key or "")
+                if status is not None:
+                    self.write_json(writer, status, {"error": {"message": f"stub error {status}", "code": status}})
+                elif request.get("stream"):
+                    if not await self.write_stream(writer):
+                        return
+                else:
+                    await asyncio.sleep(self.delay)
+                    self.write_json(writer, 200, {
+                        "id": "stub",
+                        "object": "chat.completion",
+                        "model": request.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+                    })
+                await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    def write_json(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]) -> None:
+        """写入JSON响应"""
+        out = json.dumps(payload).encode()
+        writer.write(
+            b"HTTP/1.1 %d Stub\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+            % (status, len(out)) + out
+        )
+
+    async def write_stream(self, writer: asyncio.StreamWriter) -> bool:
+        """写入SSE流式响应
+
+        Returns:
+            bool: 是否正常结束,断开连接时为False
+        """
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for index, piece in enumerate(self.stream_pieces):
+            if self.fail_after is not None and index >= self.fail_after:
+                await writer.drain()
+                writer.transport.abort()
+                return False
+            chunk = {"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            data = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+            writer.write(b"%x\r\n" % len(data) + data + b"\r\n")
+            await writer.drain()
+        data = b"data: [DONE]\n\n"
+        writer.write(b"%x\r\n" % len(data) + data + b"\r\n0\r\n\r\n")
+        return True
@@ -0,0 +1,51 @@
+from qilianchat.chat.chat_storage import JsonlChatStorage, SqliteChatStorage, migrate_chat_storage
+
+KEY = ("group", "123", "角色")
+
+
+def make_records(count: int) -> list:
+    return [{"name": "用户", "is_user": index % 2 == 0, "mes": f"消息{index}"} for index in range(count)]
+
+
+def make_storages(tmp_path, count: int = 5):
+    source = JsonlChatStorage(str(tmp_path / "chat_data"))
+    source.append(KEY, make_records(count))
+    target = SqliteChatStorage(str(tmp_path / "chat_history.db"))
+    return source, target
+
+
+def test_migrate_copies_new_sessions(tmp_path):
+    source, target = make_storages(tmp_path)
+    result = migrate_chat_storage(source, target, batch_size=2)
+    assert result == {"sessions": 1, "records": 5, "resumed": 0, "skipped": 0, "conflicts": 0}
+    assert list(target.iter_records(KEY)) == make_records(5)
+    # 重复执行不产生重复记录
+    assert migrate_chat_storage(source, target)["skipped"] == 1
+    assert target.count(KEY) == 5
+    target.close()
+
+
+def test_migrate_resumes_partially_migrated_session(tmp_path):
+    source, target = make_storages(tmp_path)
+    target.append(KEY, make_records(2))
+    result = migrate_chat_storage(source, target)
+    assert result == {"sessions": 0, "records": 3, "resumed": 1, "skipped": 0, "conflicts": 0}
+    assert list(target.iter_records(KEY)) == make_records(5)
+    target.close()
+
+
+def test_migrate_reports_conflicting_session(tmp_path):
+    source, target = make_storages(tmp_path)
+    target.append(KEY, [{"name": "用户", "is_user": True, "mes": "其他记录"}])
+    result = migrate_chat_storage(source, target)
+    assert result["conflicts"] == 1 and result["records"] == 0
+    assert target.count(KEY) == 1
+    target.close()
+
+
+def test_count_missing_session(tmp_path):
+    source, target = make_storages(tmp_path)
+    missing = ("private", "1", "角色")
+    assert source.count(missing) == 0
+    assert target.count(missing) == 0
+    target.close()
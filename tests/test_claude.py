@@ -0,0 +1,158 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from qilianchat.open_ai.open_ai import OpenAi, StreamError
+
+MESSAGES = [
+    {"role": "system", "content": "主提示"},
+    {"role": "system", "content": "角色设定"},
+    {"role": "assistant", "content": "初始消息"},
+    {"role": "user", "content": "你好"}
+]
+EPHEMERAL = {"type": "ephemeral"}
+
+
+class ClaudeStub:
+    """Messages接口的替身,按x-api-key决定返回的状态码"""
+
+    def __init__(self) -> None:
+        self.statuses = {}
+        self.events = [
+            ("message_start", {"message": {"usage": {"input_tokens": 10, "cache_read_input_tokens": 5}}}),
+            ("content_block_delta", {"delta": {"type": "text_delta", "text": "你"}}),
+            ("content_block_delta", {"delta": {"type": "text_delta", "text": "好"}}),
+            ("message_delta", {"usage": {"output_tokens": 2}}),
+            ("message_stop", {})
+        ]
+        self.requests = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        api_key = request.headers["x-api-key"]
+        body = json.loads(request.content)
+        self.requests.append((api_key, body))
+        status = self.statuses.get(api_key)
+        if status is not None:
+            return httpx.Response(
+                status,
+                headers={"retry-after": "30"},
+                json={"type": "error", "error": {"type": "rate_limit_error", "message": "slow down"}}
+            )
+        if body.get("stream"):
+            stream = "".join(
+                f"event: {event}\ndata: {json.dumps({'type': event, **data}, ensure_ascii=False)}\n\n"
+                for event, data in self.events
+            )
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=stream.encode())
+        return httpx.Response(200, json={
+            "content": [{"type": "text", "text": "你好"}],
+            "usage": {"input_tokens": 10, "output_tokens": 2}
+        })
+
+
+def make_client(stub: ClaudeStub, keys=("key-1",)) -> OpenAi:
+    """创建使用替身传输层的Claude客户端,不写入配置文件"""
+    open_ai = OpenAi()
+    open_ai.chat_completion_source = "Claude"
+    open_ai.api_url = "https://claude.test"
+    open_ai.api_keys = list(keys)
+    open_ai.module = "claude-test"
+    open_ai.max_retries = 3
+    open_ai.key_scheduler.set_keys(open_ai.api_keys)
+    open_ai.client_pool.http_client = httpx.AsyncClient(transport=httpx.MockTransport(stub.handler))
+    return open_ai
+
+
+def test_request_maps_system_blocks_and_cache_breakpoints():
+    async def main():
+        stub = ClaudeStub()
+        open_ai = make_client(stub)
+        reply = await open_ai.chat_with_claude(MESSAGES, static_prefix_length=3)
+        await open_ai.close()
+        return reply, stub.requests[0][1]
+
+    reply, body = asyncio.run(main())
+    assert reply == "你好"
+    assert body["system"] == [
+        {"type": "text", "text": "主提示"},
+        {"type": "text", "text": "角色设定", "cache_control": EPHEMERAL}
+    ]
+    # 对话以assistant开头时补一条user消息;静态前缀的最后一条和最后一条user消息设置断点
+    assert [message["role"] for message in body["messages"]] == ["user", "assistant", "user"]
+    assert "cache_control" not in body["messages"][0]["content"][0]
+    assert body["messages"][1]["content"] == [{"type": "text", "text": "初始消息", "cache_control": EPHEMERAL}]
+    assert body["messages"][2]["content"] == [{"type": "text", "text": "你好", "cache_control": EPHEMERAL}]
+
+
+def test_rate_limited_key_is_switched():
+    async def main():
+        stub = ClaudeStub()
+        stub.statuses = {"limited": 429}
+        open_ai = make_client(stub, keys=("limited", "good"))
+        reply = await open_ai.chat_with_claude(MESSAGES, static_prefix_length=3)
+        await open_ai.close()
+        return reply, [api_key for api_key, _ in stub.requests]
+
+    reply, used_keys = asyncio.run(main())
+    assert reply == "你好"
+    assert used_keys == ["limited", "good"]
+
+
+def test_stream_parses_sse_events():
+    async def main():
+        stub = ClaudeStub()
+        open_ai = make_client(stub)
+        parts = [text async for text in open_ai.stream_with_claude(MESSAGES, static_prefix_length=3)]
+        await open_ai.close()
+        return parts, stub.requests[0][1]
+
+    parts, body = asyncio.run(main())
+    assert parts == ["你", "好"]
+    assert body["stream"] is True
+
+
+def test_stream_rate_limit_before_first_piece_switches_key():
+    async def main():
+        stub = ClaudeStub()
+        stub.statuses = {"limited": 529}
+        open_ai = make_client(stub, keys=("limited", "good"))
+        parts = [text async for text in open_ai.stream_with_claude(MESSAGES)]
+        await open_ai.close()
+        return parts, [api_key for api_key, _ in stub.requests]
+
+    parts, used_keys = asyncio.run(main())
+    assert parts == ["你", "好"]
+    assert used_keys == ["limited", "good"]
+
+
+def test_stream_unauthorized_before_first_piece_switches_key():
+    async def main():
+        stub = ClaudeStub()
+        stub.statuses = {"revoked": 401}
+        open_ai = make_client(stub, keys=("revoked", "good"))
+        parts = [text async for text in open_ai.stream_with_claude(MESSAGES)]
+        await open_ai.close()
+        return parts, [api_key for api_key, _ in stub.requests]
+
+    parts, used_keys = asyncio.run(main())
+    assert parts == ["你", "好"]
+    assert used_keys == ["revoked", "good"]
+
+
+def test_stream_error_event_raises_after_partial_reply():
+    async def main():
+        stub = ClaudeStub()
+        stub.events.insert(2, ("error", {"error": {"type": "overloaded_error", "message": "Overloaded"}}))
+        open_ai = make_client(stub)
+        parts = []
+        with pytest.raises(StreamError) as info:
+            async for text in open_ai.stream_with_claude(MESSAGES):
+                parts.append(text)
+        await open_ai.close()
+        return parts, info.value
+
+    parts, error = asyncio.run(main())
+    assert parts == ["你"]
+    assert error.received
@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+from qilianchat.open_ai.open_ai import OpenAi
+from stub_server import StubServer
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": "hello"}]
+
+
+def make_client(server: StubServer, keys=("key-1",)) -> OpenAi:
+    """创建指向替身服务器的客户端,不写入配置文件"""
+    open_ai = OpenAi()
+    open_ai.chat_completion_source = "Others"
+    open_ai.api_url = server.base_url
+    open_ai.api_keys = list(keys)
+    open_ai.module = "stub-model"
+    open_ai.max_retries = 3
+    open_ai.key_scheduler.set_keys(open_ai.api_keys)
+    return open_ai
+
+
+def test_concurrent_calls_finish_in_about_one_call_time():
+    async def main():
+        async with StubServer(delay=0.3) as server:
+            open_ai = make_client(server)
+            start = time.perf_counter()
+            assert await open_ai.start_chat(MESSAGES) == "hi"
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            replies = await asyncio.gather(*(open_ai.start_chat(MESSAGES) for _ in range(10)))
+            concurrent = time.perf_counter() - start
+            await open_ai.close()
+        assert replies == ["hi"] * 10
+        # 10个请求并行发送,总耗时接近单个请求而不是其10倍
+        assert concurrent < single * 2, (single, concurrent)
+
+    asyncio.run(main())
+
+
+def test_sequential_calls_reuse_connection():
+    async def main():
+        async with StubServer() as server:
+            open_ai = make_client(server)
+            for _ in range(5):
+                assert await open_ai.start_chat(MESSAGES) == "hi"
+            await open_ai.close()
+            return server.connections, len(server.requests)
+
+    connections, requests = asyncio.run(main())
+    assert requests == 5
+    assert connections == 1
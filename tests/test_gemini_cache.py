@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import httpx
+
+from qilianchat.open_ai.client_pool import ClientPool
+from qilianchat.open_ai.gemini_cache import GeminiCacheManager
+
+PREFIX = [{"role": "system", "content": "角色设定"}, {"role": "assistant", "content": "初始消息"}]
+CACHE_KEY = ("预设", "角色")
+
+
+class GeminiStub:
+    """cachedContents接口的替身,记录收到的请求"""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.created = []
+        self.deleted = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.delay)
+        if request.method == "POST":
+            name = f"cachedContents/{len(self.created)}"
+            self.created.append((request.url.params["key"], json.loads(request.content)))
+            return httpx.Response(200, json={"name": name})
+        if request.method == "DELETE":
+            self.deleted.append(request.url.path.rsplit("/", 1)[-1])
+            return httpx.Response(200, json={})
+        return httpx.Response(200, json={})
+
+
+def make_manager(stub: GeminiStub) -> GeminiCacheManager:
+    """创建使用替身传输层的缓存管理器"""
+    client_pool = ClientPool()
+    client_pool.http_client = httpx.AsyncClient(transport=httpx.MockTransport(stub.handler))
+    return GeminiCacheManager(client_pool)
+
+
+def test_concurrent_requests_create_one_cache():
+    async def main():
+        stub = GeminiStub(delay=0.05)
+        manager = make_manager(stub)
+        names = await asyncio.gather(*(
+            manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, PREFIX) for _ in range(10)
+        ))
+        await manager.client_pool.close()
+        return stub, names
+
+    stub, names = asyncio.run(main())
+    assert len(stub.created) == 1
+    assert set(names) == {"cachedContents/0"}
+
+
+def test_entries_are_shared_per_preset_character_and_model():
+    async def main():
+        stub = GeminiStub()
+        manager = make_manager(stub)
+        first = await manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, PREFIX)
+        again = await manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, PREFIX)
+        # 缓存内容属于密钥所在的项目,另一个密钥单独创建,但共享同一个条目
+        other_key = await manager.get_cached_content("key-2", "gemini-test", CACHE_KEY, PREFIX)
+        await manager.client_pool.close()
+        return stub, manager, first, again, other_key
+
+    stub, manager, first, again, other_key = asyncio.run(main())
+    assert first == again != other_key
+    assert [api_key for api_key, _ in stub.created] == ["key-1", "key-2"]
+    assert list(manager.entries) == [(CACHE_KEY, "gemini-test")]
+
+
+def test_changed_prefix_deletes_old_caches():
+    async def main():
+        stub = GeminiStub()
+        manager = make_manager(stub)
+        await manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, PREFIX)
+        changed = PREFIX[:1] + [{"role": "assistant", "content": "新的初始消息"}]
+        name = await manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, changed)
+        await manager.client_pool.close()
+        return stub, name
+
+    stub, name = asyncio.run(main())
+    assert stub.deleted == ["0"]
+    assert name == "cachedContents/1"
+
+
+def test_expired_entries_are_pruned():
+    async def main():
+        stub = GeminiStub()
+        manager = make_manager(stub)
+        await manager.get_cached_content("key-1", "gemini-test", CACHE_KEY, PREFIX)
+        await manager.client_pool.close()
+        return manager
+
+    manager = asyncio.run(main())
+    entry = manager.entries[(CACHE_KEY, "gemini-test")]
+    assert manager.prune() == 0
+    entry.contents["key-1"].expire_time = 0.0
+    assert manager.prune() == 1
+    assert not manager.entries
@@ -0,0 +1,17 @@
+from datetime import datetime, timedelta, timezone
+
+from qilianchat.messages.macros import MacroContext, MacroEngine
+
+
+def test_time_utc_uses_turn_time():
+    now = datetime(2024, 3, 1, 23, 30, tzinfo=timezone(timedelta(hours=8)))
+    context = MacroContext(user="用户", char="角色", now=now)
+    engine = MacroEngine()
+    assert engine.render("{{time_utc+0}} {{time_utc+9}} {{time_UTC-2}}", context) == "15:30 00:30 13:30"
+
+
+def test_time_utc_converts_naive_local_time():
+    now = datetime(2024, 3, 1, 12, 0)
+    context = MacroContext(user="用户", char="角色", now=now)
+    expected = now.astimezone(timezone.utc).strftime("%H:%M")
+    assert MacroEngine().render("{{time_utc+0}}", context) == expected
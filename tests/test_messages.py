@@ -0,0 +1,91 @@
+import asyncio
+
+from qilianchat.chat.chat_session import ChatSession
+from qilianchat.messages.messages import Messages
+
+
+class FakeCharacter:
+    """只提供构造静态前缀所需字段的角色"""
+
+    def get_name(self) -> str:
+        return "Amy"
+
+    def get_lorebook(self):
+        return None
+
+    def get_description(self) -> str:
+        return "desc of {{char}}"
+
+    def get_personality(self) -> str:
+        return ""
+
+    def get_scenario(self) -> str:
+        return "meets {{user}}"
+
+    def get_mes_example(self) -> str:
+        return ""
+
+    def get_first_message(self) -> str:
+        return "hi {{user}}"
+
+    def get_depth_prompt(self):
+        return "", "system"
+
+    def get_depth(self) -> int:
+        return 4
+
+
+def make_session(nick_name: str) -> ChatSession:
+    session = ChatSession(FakeCharacter(), "1")
+    session.set_nick_name(nick_name)
+    session.set_preset_order_prompts([
+        {"role": "system", "content": "main prompt {{setvar::count::{{char}}}}"},
+        "charDescription",
+        "scenario",
+        "chatHistory"
+    ])
+    return session
+
+
+def test_shared_prefix_excludes_nickname_messages():
+    messages = Messages()
+    session = make_session("Bob")
+    prefix = messages.get_static_prefix(session, "hello")
+    assert [message["content"] for message in prefix] == ["main prompt ", "desc of Amy", "meets Bob", "hi Bob"]
+    assert messages.get_shared_prefix_length(session) == 2
+    # 用另一个昵称重新渲染时使用变量的副本
+    assert session.variables == {"count": "Amy"}
+
+
+def test_shared_prefix_is_identical_across_users():
+    messages = Messages()
+    bob, alice = make_session("Bob"), make_session("Alice")
+    bob_prefix = messages.get_static_prefix(bob, "hello")
+    alice_prefix = messages.get_static_prefix(alice, "hello")
+    length = messages.get_shared_prefix_length(bob)
+    assert length == messages.get_shared_prefix_length(alice)
+    assert bob_prefix[:length] == alice_prefix[:length]
+
+
+def history(count: int) -> list:
+    return [
+        {"name": "Bob" if index % 2 == 0 else "Amy", "is_user": index % 2 == 0, "msg": f"{'u' if index % 2 == 0 else 'a'}{index}"}
+        for index in range(count)
+    ]
+
+
+def history_contents(messages: Messages, session: ChatSession, message: str, chat_history: list) -> list:
+    built = asyncio.run(messages.construct_messages(message, session, chat_history))
+    return [item["content"] for item in built if item["content"] in {record["msg"] for record in chat_history}]
+
+
+def test_history_without_regex_keeps_every_record_across_turns():
+    messages = Messages()
+    session = make_session("Bob")
+    assert session.get_preset_regex() is None
+
+    first = history(4)
+    assert history_contents(messages, session, "now", first) == ["u0", "a1", "u2", "a3"]
+    # 下一轮去掉开头一条记录并追加新记录,复用的消息与记录保持对齐
+    second = history(6)[1:]
+    assert history_contents(messages, session, "again", second) == ["a1", "u2", "a3", "u4", "a5"]
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("nonebot.adapters.onebot.v11")
+
+from qilianchat.chat.nickname_directory import DEFAULT_NICKNAME, NicknameDirectory
+
+
+class FakeBot:
+    """按顺序返回查询结果的Bot替身,结果为None时模拟查询失败"""
+
+    def __init__(self, results) -> None:
+        self.results = list(results)
+        self.calls = 0
+
+    async def call_api(self, api: str, **params):
+        self.calls += 1
+        result = self.results.pop(0)
+        if result is None:
+            raise RuntimeError("查询失败")
+        return result
+
+
+def test_expired_negative_entry_is_fetched_again():
+    async def main():
+        directory = NicknameDirectory(negative_ttl=300.0)
+        bot = FakeBot([None, {"nickname": "小明"}])
+        first = await directory.get_nick_name(bot, "10001")
+        cached = await directory.get_nick_name(bot, "10001")
+        directory.entries[("", "10001")].expire_time = 0.0
+        refetched = await directory.get_nick_name(bot, "10001")
+        return first, cached, refetched, bot.calls
+
+    first, cached, refetched, calls = asyncio.run(main())
+    assert first == cached == DEFAULT_NICKNAME
+    assert refetched == "小明"
+    assert calls == 2
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+import regex
+
+from qilianchat.preset.RegexProcess import RegexPipeline, RegexProcessor, RegexRule
+
+MYGO_PRESET = "Gemini!_It's_MyGO!!!!!_1.9.2版"
+MYGO_SAMPLES = [
+    "<thinking>先想一想</thinking>\n<content>你好 世界,今天 天气 不错。</content>",
+    "思维链内容[开始创作]\n『正文』在这里<disclaimer>免责声明</disclaimer>结束",
+    "<StatusBlock id=1>状态\n栏</StatusBlock>正文 中 文<npc response>npc</npc response>",
+    "```Start\n<story plot>剧情</story plot>\n<Safe>安全</Safe>```End",
+    "没有任何需要处理的内容 abc 中文  英文 text",
+]
+SYNTHETIC_TOKENS = ["a", "b", "c", "cat", " ", "\n", "end", "<b>", "</b>", "foo", "bar", "o", "中", "x"]
+
+
+def synthetic_pipeline() -> RegexPipeline:
+    def rule(name, pattern, replacement, count=0, markdown_only=False):
+        return RegexRule(
+            name, regex.compile(pattern, regex.VERSION1), replacement, count, markdown_only=markdown_only
+        )
+
+    return RegexPipeline("synthetic", [
+        rule("dollar", r"end$", "END"),
+        rule("multiline_dollar", r"(?m)x$", "X"),
+        rule("word_boundary", r"\bcat\b", "dog"),
+        rule("lookbehind", r"(?<=ab)c", "C"),
+        rule("lookahead", r"foo(?=bar)", "F"),
+        rule("lazy", r"<b>.*?</b>", "[b]"),
+        rule("count_one", r"o", "0", count=1),
+        rule("display_only", r"a+", "A", markdown_only=True),
+    ], None, ())
+
+
+def random_chunks(text: str, rng: random.Random) -> list:
+    """将文本随机切分为片段,包括空片段"""
+    cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, len(text))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def assert_stream_matches_batch(processor: RegexProcessor, pipeline: RegexPipeline, text: str, rng: random.Random):
+    expected = processor.process_display(pipeline, processor.process_output(pipeline, text))
+    chunkings = [[text], list(text)] + [random_chunks(text, rng) for _ in range(20)]
+    for chunks in chunkings:
+        stream = processor.stream_display(pipeline)
+        output = "".join(stream.feed(chunk) for chunk in chunks) + stream.flush()
+        assert output == expected, (text, chunks)
+
+
+def test_bundled_mygo_rules_match_batch_processing():
+    processor = RegexProcessor(timeout=None)
+    try:
+        pipeline = processor.get_patterns(MYGO_PRESET)
+    except FileNotFoundError:
+        pytest.skip("未附带MyGO预设的正则规则")
+    rng = random.Random(17)
+    for text in MYGO_SAMPLES:
+        assert_stream_matches_batch(processor, pipeline, text, rng)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_synthetic_rules_match_batch_processing(seed):
+    processor = RegexProcessor(timeout=None)
+    pipeline = synthetic_pipeline()
+    rng = random.Random(seed)
+    text = "".join(rng.choice(SYNTHETIC_TOKENS) for _ in range(rng.randint(0, 40)))
+    assert_stream_matches_batch(processor, pipeline, text, rng)
+
+
+@pytest.mark.parametrize("index", range(len(synthetic_pipeline().rules)))
+def test_each_synthetic_rule_matches_batch_processing(index):
+    processor = RegexProcessor(timeout=None)
+    rule = synthetic_pipeline().rules[index]
+    pipeline = RegexPipeline(rule.name, [rule], None, ())
+    rng = random.Random(index)
+    for _ in range(10):
+        text = "".join(rng.choice(SYNTHETIC_TOKENS) for _ in range(rng.randint(0, 40)))
+        assert_stream_matches_batch(processor, pipeline, text, rng)
+
+
+def test_preset_without_regex_directory_gets_empty_pipeline():
+    processor = RegexProcessor(timeout=None)
+    processor.get_patterns(MYGO_PRESET)
+    # 换用没有正则规则目录的预设(附带的Amk预设只有提示词,没有正则规则)
+    pipeline = processor.get_patterns("Amk_Hagemi_3.1")
+    assert len(pipeline) == 0
+    assert processor.get_patterns("Amk_Hagemi_3.1") is pipeline
+    assert processor.process_output(pipeline, " <thinking>x</thinking>正文 ") == "<thinking>x</thinking>正文"
+    stream = processor.stream_display(pipeline)
+    assert stream.feed(" 正文 ") + stream.flush() == "正文"
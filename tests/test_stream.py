@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from qilianchat.open_ai.open_ai import StreamError
+from stub_server import StubServer
+from test_client_pool import MESSAGES, make_client
+
+
+async def collect(open_ai) -> list:
+    """收集流式回复的所有片段"""
+    parts = []
+    async for text in open_ai.stream_chat(MESSAGES):
+        parts.append(text)
+    return parts
+
+
+def test_stream_returns_all_pieces():
+    async def main():
+        async with StubServer() as server:
+            open_ai = make_client(server)
+            parts = await collect(open_ai)
+            await open_ai.close()
+        return parts
+
+    assert asyncio.run(main()) == ["你好", "，", "世界"]
+
+
+def test_stream_error_is_raised_after_partial_reply():
+    async def main():
+        async with StubServer() as server:
+            server.fail_after = 1
+            open_ai = make_client(server)
+            parts = []
+            with pytest.raises(StreamError) as info:
+                async for text in open_ai.stream_chat(MESSAGES):
+                    parts.append(text)
+            await open_ai.close()
+        return parts, info.value
+
+    parts, error = asyncio.run(main())
+    # 错误不作为回复文本产出,已收到的片段不受影响
+    assert parts == ["你好"]
+    assert error.received
+    assert not any(part.startswith("错误") for part in parts)
+
+
+def test_stream_error_before_first_piece():
+    async def main():
+        async with StubServer() as server:
+            server.fail_after = 0
+            open_ai = make_client(server)
+            open_ai.max_retries = 0
+            with pytest.raises(StreamError) as info:
+                await collect(open_ai)
+            await open_ai.close()
+        return info.value
+
+    assert not asyncio.run(main()).received
+
+
+def test_stream_switches_key_after_auth_error():
+    async def main():
+        async with StubServer() as server:
+            server.statuses = {"bad": 401}
+            open_ai = make_client(server, keys=("bad", "good"))
+            parts = await collect(open_ai)
+            await open_ai.close()
+        return parts, [api_key for api_key, _ in server.requests]
+
+    parts, used_keys = asyncio.run(main())
+    assert parts == ["你好", "，", "世界"]
+    assert used_keys == ["bad", "good"]
+
+
+def test_stream_gives_up_when_every_key_fails():
+    async def main():
+        async with StubServer() as server:
+            server.statuses = {"bad-1": 503, "bad-2": 401}
+            open_ai = make_client(server, keys=("bad-1", "bad-2"))
+            with pytest.raises(StreamError):
+                await collect(open_ai)
+            await open_ai.close()
+        return [api_key for api_key, _ in server.requests]
+
+    # 每个密钥只尝试一次,全部失败后不再重试
+    assert sorted(asyncio.run(main())) == ["bad-1", "bad-2"]
@@ -2,6 +2,7 @@ import json
 from pathlib import Path
 from typing import Dict, List, Optional
 from ..character.character import Character
+from ..character.character_registry import CharacterRegistry
 
 class CharacterUtil:
     """角色工具类,用于管理角色卡和角色配置
@@ -12,6 +13,9 @@ class CharacterUtil:
         character_list (List[str]): 角色列表
         group_character_list (Dict[str, str]): 群聊角色映射
         private_character_list (Dict[str, str]): 私聊角色映射
+        registry (CharacterRegistry): 角色注册表,同一角色卡的会话共享一个角色对象
+        version (int): 角色配置的版本号,指定角色或重新扫描角色卡时递增,
+            会话的版本号与其不同时重新取得角色
     """
 
     def __init__(self) -> None:
@@ -21,6 +25,8 @@ class CharacterUtil:
         self.card_folder = self.base_path / "../data/character_cards/json"
         
         self.character_card_path: Dict[str, Path] = {}
+        self.registry = CharacterRegistry()
+        self.version = 0
         self.character_cards = self.get_character_card_list()
         
         try:
@@ -35,8 +41,13 @@ class CharacterUtil:
             raise ValueError(f"角色配置文件格式错误: {str(e)}")
 
     def set_init(self) -> None:
-        """重新初始化角色配置"""
-        self.get_character_list()
+        """重新扫描角色卡文件夹并重新读取角色配置
+
+        只更新角色卡路径和会话到角色的映射,不解析角色卡;角色卡在会话下次取得角色时
+        由注册表按文件状态决定是否重新解析。
+        """
+        self.character_cards = self._scan_card_folder()
+        self.version += 1
         try:
             with open(self.config_file, 'r', encoding='utf-8') as f:
                 config = json.load(f)
@@ -47,7 +58,9 @@ class CharacterUtil:
             print(f"重新初始化角色配置失败: {str(e)}")
 
     def get_character_card_list(self) -> List[str]:
-        """获取角色卡列表
+        """重新扫描角色卡文件夹并获取角色卡列表
+        
+        角色卡可能已被添加或替换,因此版本号递增,各会话下次收到消息时检查自己的角色卡。
         
         Returns:
             List[str]: 角色卡名称列表
@@ -56,13 +69,9 @@ class CharacterUtil:
             IOError: 读写文件失败
         """
         try:
-            character_list = []
-            
-            for file_path in self.card_folder.glob("*.json"):
-                character_name = file_path.stem
-                character_list.append(character_name)
-                self.character_card_path[character_name] = file_path
-                
+            character_list = self._scan_card_folder()
+            self.version += 1
+
             with open(self.config_file, 'r+', encoding='utf-8') as f:
                 config = json.load(f)
                 config["character_list"] = character_list
@@ -75,6 +84,21 @@ class CharacterUtil:
         except IOError as e:
             raise IOError(f"读写角色卡文件失败: {str(e)}") from e
 
+    def _scan_card_folder(self) -> List[str]:
+        """扫描角色卡文件夹,更新角色卡路径,已删除的角色卡从注册表中移除
+
+        Returns:
+            List[str]: 角色卡名称列表
+        """
+        character_card_path = {
+            file_path.stem: file_path for file_path in self.card_folder.glob("*.json")
+        }
+        for name, path in self.character_card_path.items():
+            if name not in character_card_path:
+                self.registry.invalidate(str(path))
+        self.character_card_path = character_card_path
+        return list(character_card_path)
+
     def get_character_list(self) -> Dict[str, Character]:
         """获取角色列表
         
@@ -83,7 +107,7 @@ class CharacterUtil:
         """
         character_list = {}
         for name, path in self.character_card_path.items():
-            character_list[name] = Character(str(path))
+            character_list[name] = self.registry.get(str(path))
         return character_list
 
     async def appoint_character(
@@ -119,7 +143,8 @@ class CharacterUtil:
                 f.seek(0)
                 json.dump(config, f, ensure_ascii=False, indent=4)
                 f.truncate()
-                
+
+            self.version += 1
             return "指定角色成功"
             
         except IOError as e:
@@ -137,7 +162,7 @@ class CharacterUtil:
             session_id: 会话ID
             
         Returns:
-            Character: 角色对象
+            Character: 角色对象,使用同一角色卡的会话共享同一个对象
         """
         character_name = (
             self.group_character_list.get(session_id, "Sakana")
@@ -145,7 +170,7 @@ class CharacterUtil:
             else self.private_character_list.get(session_id, "Sakana")
         )
         character_card_path = self.character_card_path[character_name]
-        return Character(str(character_card_path))
+        return self.registry.get(str(character_card_path))
 
     def get_character_name(
         self,
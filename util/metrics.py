@@ -0,0 +1,111 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Any
+
+
+class Metrics:
+    """性能指标记录类,按名称保存最近的采样值并生成统计摘要
+
+    Attributes:
+        window (int): 每个指标保留的最近采样数
+        samples (Dict[str, Deque[float]]): 指标名称到采样值的映射
+        counters (Dict[str, int]): 计数器
+    """
+
+    def __init__(self, window: int = 500) -> None:
+        """初始化指标记录器
+
+        Args:
+            window: 每个指标保留的最近采样数
+        """
+        self.window = window
+        self.samples: Dict[str, Deque[float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def record(self, name: str, value: float) -> None:
+        """记录一个采样值
+
+        Args:
+            name: 指标名称
+            value: 采样值
+        """
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append(value)
+
+    def record_since(self, name: str, start: float) -> float:
+        """记录从start(time.perf_counter())到现在经过的秒数
+
+        Args:
+            name: 指标名称
+            start: 起始时间
+
+        Returns:
+            float: 经过的秒数
+        """
+        elapsed = time.perf_counter() - start
+        self.record(name, elapsed)
+        return elapsed
+
+    def increase(self, name: str, value: int = 1) -> None:
+        """累加计数器
+
+        Args:
+            name: 计数器名称
+            value: 增加值
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_summary(self, name: str) -> Dict[str, float]:
+        """获取单个指标的统计摘要
+
+        Args:
+            name: 指标名称
+
+        Returns:
+            Dict[str, float]: 包含count/last/avg/p50/p95/max的字典,无采样时为空
+        """
+        samples = self.samples.get(name)
+        if not samples:
+            return {}
+        ordered = sorted(samples)
+        count = len(ordered)
+        return {
+            "count": count,
+            "last": samples[-1],
+            "avg": sum(ordered) / count,
+            "p50": ordered[int((count - 1) * 0.5)],
+            "p95": ordered[int((count - 1) * 0.95)],
+            "max": ordered[-1]
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取所有指标和计数器的统计信息
+
+        Returns:
+            Dict[str, Any]: 指标名称到摘要或计数的映射
+        """
+        stats: Dict[str, Any] = {
+            name: self.get_summary(name) for name in sorted(self.samples)
+        }
+        stats.update(sorted(self.counters.items()))
+        return stats
+
+    def format_stats(self) -> str:
+        """将统计信息格式化为便于阅读的文本
+
+        Returns:
+            str: 每行一个指标的文本
+        """
+        lines = []
+        for name, summary in self.get_stats().items():
+            if isinstance(summary, dict):
+                lines.append(
+                    f"{name}: n={summary['count']} last={summary['last']:.3f} "
+                    f"avg={summary['avg']:.3f} p50={summary['p50']:.3f} "
+                    f"p95={summary['p95']:.3f} max={summary['max']:.3f}"
+                )
+            else:
+                lines.append(f"{name}: {summary}")
+        return "\n".join(lines) if lines else "暂无统计数据"